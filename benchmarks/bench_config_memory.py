@@ -0,0 +1,55 @@
+"""
+Compare the memory held by the raw `yaml.safe_load` dict with the parsed Config model, for a generated config of
+50,000 package entries.
+
+    python benchmarks/bench_config_memory.py [n_envs] [pkgs_per_env]
+"""
+import gc
+import sys
+import tracemalloc
+
+import yaml
+
+from mipi_env_manager.config import Config
+
+
+def generate_config(n_envs, pkgs_per_env) -> str:
+    lines = ["environments:"]
+    for e in range(n_envs):
+        lines += [f"  env{e}:", "    setup:", "      py_version: 3.12", "      include_in_master: true", "    packages:"]
+        for p in range(pkgs_per_env):
+            if p % 2:
+                lines += [f"      pkg{p}:", "        source: github", f"        path: https://github.com/org/repo{p % 20}",
+                          "        version: 1.0.0", "        version_policy: compatible"]
+            else:
+                lines += [f"      pkg{p}:", "        source: pypi", "        version: 2.31.0",
+                          "        version_policy: exact"]
+    lines += ["setup:", "  outpath: out", "  environment_variables:", "    KEY: value"]
+    return "\n".join(lines)
+
+
+def main(n_envs=500, pkgs_per_env=100):
+    text = generate_config(n_envs, pkgs_per_env)
+    Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+    gc.collect()
+    tracemalloc.start()
+    raw = yaml.load(text, Loader=Loader)
+    gc.collect()
+    raw_size, _ = tracemalloc.get_traced_memory()
+
+    # measured after the raw dict is released, so interned strings first allocated by yaml are counted once
+    config = Config.from_dict(raw)
+    del raw
+    gc.collect()
+    model_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{n_envs * pkgs_per_env} packages in {n_envs} environments")
+    print(f"raw dict:     {raw_size / 2**20:8.1f} MiB")
+    print(f"config model: {model_size / 2**20:8.1f} MiB ({model_size / raw_size:.0%} of raw)")
+    return config
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:]))
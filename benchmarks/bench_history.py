@@ -0,0 +1,52 @@
+"""
+Time the resolution history over years of nightly publishes: each night records every environment, and a few pins
+move. Prints the time of a publish's transaction and of each query.
+
+    python benchmarks/bench_history.py [nights] [n_envs] [pkgs_per_env]
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+from mipi_env_manager.history import ResolutionHistory
+
+
+def requirements(n_envs, pkgs_per_env, versions):
+    return {f"env{e}": [f"pkg{p}=={versions[(e, p)]}" for p in range(pkgs_per_env)] for e in range(n_envs)}
+
+
+def main(nights=730, n_envs=300, pkgs_per_env=20):
+    rng = random.Random(0)
+    versions = {(e, p): 0 for e in range(n_envs) for p in range(pkgs_per_env)}
+    start = datetime.datetime(2024, 1, 1, 2, 0)
+    with tempfile.TemporaryDirectory() as tmp, ResolutionHistory(os.path.join(tmp, "history.sqlite")) as history:
+        records = []
+        for night in range(nights):
+            for key in rng.sample(sorted(versions), 25):
+                versions[key] += 1
+            t = time.perf_counter()
+            history.record(requirements(n_envs, pkgs_per_env, versions), complete=True,
+                           started=start + datetime.timedelta(days=night))
+            records.append(time.perf_counter() - t)
+        print(f"{nights} publishes of {n_envs} x {pkgs_per_env} pins, "
+              f"{os.path.getsize(os.path.join(tmp, 'history.sqlite')) / 2**20:.1f} MiB")
+        print(f"record: median {sorted(records)[len(records) // 2] * 1000:.1f} ms")
+
+        queries = {
+            "log": lambda: history.log("env7", "pkg3"),
+            "who (latest)": lambda: history.users("pkg3", "5"),
+            "who (a year ago)": lambda: history.users("pkg3", "1", at=(start + datetime.timedelta(days=365)).date()
+                                                      .isoformat()),
+            "diff": lambda: history.diff(history.resolve("100"), history.resolve("latest"), "env7"),
+        }
+        for name, query in queries.items():
+            t = time.perf_counter()
+            rows = query()
+            print(f"{name}: {(time.perf_counter() - t) * 1000:.2f} ms, {len(rows)} rows")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,124 @@
+import hashlib
+import io
+import json
+import os
+import posixpath
+import zipfile
+from typing import Dict, Iterable, Optional
+
+from mipi_env_manager.sinks import ZIP_DATE_TIME, OutputSink
+
+BUNDLE_DIR = "bundles"
+INDEX_FILE = "index.json"
+
+
+class BundleError(ValueError):
+    """
+    A bundle that does not match its index entry, or that would extract outside its destination
+    """
+
+
+def bundle_id(files: Dict[str, str]) -> str:
+    """
+    The hash of a bundle's file names and their hashes, so the same files always give the same bundle name
+    """
+    lines = "".join(f"{key} {sha256}\n" for key, sha256 in sorted(files.items()))
+    return hashlib.sha256(lines.encode("utf-8")).hexdigest()
+
+
+def build_bundle(contents: Dict[str, bytes]) -> bytes:
+    """
+    A zip of the files keyed by their path relative to the outpath. Entries are sorted and get a fixed timestamp, so
+    the same files always make the same bytes and an unchanged bundle is never rewritten
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for key in sorted(contents):
+            info = zipfile.ZipInfo(key, date_time=ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zf.writestr(info, contents[key])
+    return buffer.getvalue()
+
+
+class Bundles:
+    """
+    One compressed archive per environment folder, under `outpath/bundles/`, named by a hash of its contents, and an
+    index of them. A client reads `index.json`, then fetches and verifies a single file per environment instead of
+    each small file over a slow share. A bundle holds the environment's folder and the shared files its installers
+    call, with paths relative to the outpath, so it extracts to a working copy of that part of the outpath.
+    """
+
+    def __init__(self, outpath, sink: OutputSink):
+        self.outpath = outpath
+        self.sink = sink
+        self.index_path = os.path.join(outpath, BUNDLE_DIR, INDEX_FILE)
+        self.entries = {}
+
+    def add(self, env_name, shared_keys: Iterable[str] = ()) -> dict:
+        """
+        Bundle the files written to the environment's folder and `shared_keys`, read back from the sink
+        """
+        keys = {k for k in self.sink.artifacts if k.startswith(f"{env_name}/")} | set(shared_keys)
+        contents = {}
+        for key in sorted(keys):
+            text = self.sink.read_text(os.path.join(self.outpath, *key.split("/")))
+            if text is None:
+                raise ValueError(f"cannot bundle {key}, the output sink cannot read it back")
+            contents[key] = text.encode("utf-8")
+
+        files = {key: hashlib.sha256(content).hexdigest() for key, content in contents.items()}
+        name = f"{env_name}-{bundle_id(files)[:16]}.zip"
+        data = build_bundle(contents)
+        sha256 = self.sink.write_bytes(os.path.join(self.outpath, BUNDLE_DIR, name), data)
+        self.entries[env_name] = {"bundle": name, "sha256": sha256, "size": len(data), "files": files}
+        return self.entries[env_name]
+
+    def write_index(self, keep: Iterable[str] = ()):
+        """
+        Write the index of the bundles added. The previous entries of the environment folders in `keep`, published
+        earlier but not bundled by this run, are carried over. Bundles the index no longer lists are then removed
+        """
+        previous = load_index(self.sink.read_text(self.index_path))
+        environments = {name: previous[name] for name in keep if name in previous}
+        environments.update(self.entries)
+        self.sink.write_text(self.index_path, json.dumps({"environments": environments}, indent=2, sort_keys=True))
+        self.sink.prune(os.path.dirname(self.index_path),
+                        {INDEX_FILE} | {entry["bundle"] for entry in environments.values()})
+
+
+def load_index(text: Optional[str]) -> Dict[str, dict]:
+    """
+    The environments of an index, environment folder -> entry. Empty if there is no index yet
+    """
+    if not text:
+        return {}
+    try:
+        return json.loads(text).get("environments", {})
+    except json.JSONDecodeError:
+        return {}
+
+
+def verify_bundle(data: bytes, entry: dict):
+    if len(data) != entry["size"] or hashlib.sha256(data).hexdigest() != entry["sha256"]:
+        raise BundleError(f"{entry['bundle']} does not match its index entry")
+
+
+def extract_bundle(data: bytes, entry: dict, dest):
+    """
+    Verify a bundle against its index entry and extract it under `dest`, which then mirrors the outpath
+    """
+    verify_bundle(data, entry)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        names = zf.namelist()
+        for name in names:
+            normalised = posixpath.normpath(name)
+            if name.startswith("/") or normalised == ".." or normalised.startswith("../"):
+                raise BundleError(f"{entry['bundle']}: {name} is outside the bundle")
+        if set(names) != set(entry["files"]):
+            raise BundleError(f"{entry['bundle']} does not hold the files its index entry lists")
+        for name in names:
+            path = os.path.join(dest, *name.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written as text, like the publish does, so batch files get the platform's line endings
+            with open(path, "w") as f:
+                f.write(zf.read(name).decode("utf-8"))
@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import posixpath
+import subprocess
+import tempfile
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Tuple
+
+import requests
+
+from mipi_env_manager.config import CondaLockSpec
+from mipi_env_manager.metrics import METRICS
+from mipi_env_manager.sinks import OutputSink
+
+SPEC_DIR = "conda_specs"
+CHANNEL_DIR = "conda_channel"
+REPODATA_FILE = "repodata.json"
+# the fields of a solved record that conda reads from repodata.json
+REPODATA_FIELDS = ("name", "version", "build", "build_number", "depends", "constrains", "license", "license_family",
+                   "md5", "sha256", "size", "subdir", "timestamp", "noarch", "features", "track_features")
+
+
+class CondaSolveError(RuntimeError):
+    """
+    conda could not solve the base environment for a python version
+    """
+
+
+class CondaSolver(ABC):
+    """
+    Solves the base environment (python and pip) for a python version, returning the package records to install
+    in link order. Each record has at least `url` and `md5`.
+    """
+
+    @abstractmethod
+    def solve(self, py_version) -> List[dict]:
+        raise NotImplementedError  # pragma: no cover
+
+
+class CondaCliSolver(CondaSolver):
+    """
+    Solves with `conda create --dry-run --json` for the clients' platform. An empty package cache is used so that
+    conda reports the full record, url and hashes included, of every package rather than only the uncached ones.
+    """
+
+    def __init__(self, settings: CondaLockSpec):
+        self.settings = settings
+
+    def _command(self, prefix, py_version) -> List[str]:
+        command = [self.settings.conda_exe, "create", "--dry-run", "--json", "--yes", "--prefix", prefix,
+                   f"python={py_version}", "pip"]
+        for channel in self.settings.channels:
+            command += ["--channel", channel]
+        if self.settings.channels:
+            command.append("--override-channels")
+        return command
+
+    def solve(self, py_version) -> List[dict]:
+        with tempfile.TemporaryDirectory() as tmp:
+            env = {**os.environ, "CONDA_SUBDIR": self.settings.subdir, "CONDA_PKGS_DIRS": os.path.join(tmp, "pkgs")}
+            result = subprocess.run(self._command(os.path.join(tmp, "env"), py_version), capture_output=True,
+                                    text=True, env=env)
+        try:
+            data = json.loads(result.stdout)
+        except json.JSONDecodeError:
+            raise CondaSolveError(f"conda returned no json for python={py_version}: {result.stderr.strip()}")
+        if not data.get("success"):
+            raise CondaSolveError(f"could not solve python={py_version}: {data.get('message') or data.get('error')}")
+
+        fetch = {record["name"]: record for record in data["actions"].get("FETCH", [])}
+        records = []
+        for linked in data["actions"]["LINK"]:
+            if linked["name"] not in fetch:
+                raise CondaSolveError(f"conda did not report a download for {linked['name']}")
+            records.append(fetch[linked["name"]])
+        return records
+
+
+def explicit_spec_lines(records: List[dict], subdir) -> List[str]:
+    return [f"# platform: {subdir}", "@EXPLICIT"] + [f"{record['url']}#{record['md5']}" for record in records]
+
+
+def channel_spec_lines(records: List[dict], subdir) -> List[str]:
+    """
+    An explicit spec of the records in the local channel, each line `<subdir>/<file>#<md5>` relative to the channel.
+    create_env.bat turns them in to file urls wherever the outpath is mounted, so conda neither solves nor downloads
+    """
+    return [f"# platform: {subdir}", "@EXPLICIT"] + [f"{package_subdir(r)}/{package_file_name(r)}#{r['md5']}"
+                                                    for r in records]
+
+
+def spec_file_name(py_version, subdir) -> str:
+    return f"python-{py_version}-{subdir}.txt"
+
+
+class ExplicitSpecs:
+    """
+    The explicit conda specs of a publish run. Each distinct python version is solved once and its spec written
+    once, then shared by every environment that uses that version.
+    """
+
+    def __init__(self, outpath, settings: CondaLockSpec, solver: CondaSolver = None):
+        self.outpath = outpath
+        self.settings = settings
+        self.solver = solver or CondaCliSolver(settings)
+        self._specs = {}
+        self.records = {}
+
+    def get(self, py_version, write_lines) -> str:
+        """
+        The spec file for this python version, relative to outpath. Solves and writes it with `write_lines(path,
+        lines)` the first time the version is seen.
+        """
+        if py_version not in self._specs:
+            records = self.solver.solve(py_version)
+            name = spec_file_name(py_version, self.settings.subdir)
+            lines = (channel_spec_lines if self.settings.local_channel else explicit_spec_lines)(records,
+                                                                                                self.settings.subdir)
+            write_lines(os.path.join(self.outpath, SPEC_DIR, name), lines)
+            self.records[py_version] = records
+            self._specs[py_version] = f"{SPEC_DIR}\\{name}"
+        return self._specs[py_version]
+
+
+class ChannelError(RuntimeError):
+    """
+    A conda package could not be added to the local channel
+    """
+
+
+class PackageFetcher(ABC):
+    """
+    Downloads a conda package
+    """
+
+    @abstractmethod
+    def fetch(self, url) -> bytes:
+        raise NotImplementedError  # pragma: no cover
+
+
+class HttpPackageFetcher(PackageFetcher):
+
+    def __init__(self, timeout=(10.0, 300.0)):
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def fetch(self, url) -> bytes:
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+
+def package_file_name(record: dict) -> str:
+    return record.get("fn") or posixpath.basename(record["url"])
+
+
+def package_subdir(record: dict) -> str:
+    return record.get("subdir") or posixpath.basename(posixpath.dirname(record["url"]))
+
+
+def verify_package(record: dict, data: bytes):
+    if hashlib.md5(data).hexdigest() != record["md5"]:
+        raise ChannelError(f"{record['url']} does not match its md5")
+    if record.get("sha256") and hashlib.sha256(data).hexdigest() != record["sha256"]:
+        raise ChannelError(f"{record['url']} does not match its sha256")
+
+
+def load_repodata(text, subdir) -> dict:
+    try:
+        repodata = json.loads(text) if text else {}
+    except json.JSONDecodeError:
+        repodata = {}
+    repodata.setdefault("info", {"subdir": subdir})
+    repodata.setdefault("packages", {})
+    repodata.setdefault("packages.conda", {})
+    repodata.setdefault("repodata_version", 1)
+    return repodata
+
+
+class LocalChannel:
+    """
+    A conda channel under `outpath/conda_channel` holding every package of the solved base environments, so
+    create_env.bat can create environments with `--offline --override-channels` and never leave the LAN.
+
+    Each `<subdir>/repodata.json` is the channel's index. A package already in the index is neither downloaded nor
+    written again, and packages shared by several python versions are stored once. A publish that solved for every
+    environment prunes the channel to what it solved; one that built only some environments only adds to it, since
+    the others' installers still use their packages.
+    """
+
+    def __init__(self, outpath, sink: OutputSink, subdir, fetcher: PackageFetcher = None, workers=8):
+        self.root = os.path.join(outpath, CHANNEL_DIR)
+        self.sink = sink
+        self.subdir = subdir
+        self.fetcher = fetcher or HttpPackageFetcher()
+        self.workers = workers
+
+    def _repodata_path(self, subdir):
+        return os.path.join(self.root, subdir, REPODATA_FILE)
+
+    def add(self, records: Iterable[dict], prune=False) -> Tuple[int, int]:
+        """
+        Add the packages of the records missing from the channel and update its index, returning the number of
+        packages added and already present. With `prune`, packages not in `records` are removed from the index and
+        the channel
+        """
+        # noarch must always be indexed, or conda rejects the channel
+        subdirs = {self.subdir, "noarch"}
+        wanted: Dict[str, dict] = {}
+        for record in records:
+            subdirs.add(package_subdir(record))
+            wanted.setdefault(package_file_name(record), record)
+        repodata = {subdir: load_repodata(self.sink.read_text(self._repodata_path(subdir)), subdir)
+                    for subdir in sorted(subdirs)}
+
+        def indexed(fn, record):
+            index = repodata[package_subdir(record)]
+            return fn in index["packages"] or fn in index["packages.conda"]
+
+        missing = {fn: record for fn, record in wanted.items() if not indexed(fn, record)}
+
+        def fetch(record):
+            data = self.fetcher.fetch(record["url"])
+            verify_package(record, data)
+            return data
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            futures = {executor.submit(fetch, record): fn for fn, record in missing.items()}
+            for future in as_completed(futures):
+                fn = futures[future]
+                record = missing[fn]
+                try:
+                    data = future.result()
+                except (requests.RequestException, ChannelError) as e:
+                    raise ChannelError(f"could not add {fn} to the local channel: {e}")
+                subdir = package_subdir(record)
+                self.sink.write_bytes(os.path.join(self.root, subdir, fn), data)
+                entry = {key: record[key] for key in REPODATA_FIELDS if record.get(key) is not None}
+                entry.setdefault("depends", [])
+                entry["subdir"] = subdir
+                entry.setdefault("size", len(data))
+                repodata[subdir]["packages.conda" if fn.endswith(".conda") else "packages"][fn] = entry
+
+        removed = 0
+        if prune:
+            for index in repodata.values():
+                for key in ("packages", "packages.conda"):
+                    kept = {fn: entry for fn, entry in index[key].items() if fn in wanted}
+                    removed += len(index[key]) - len(kept)
+                    index[key] = kept
+        for subdir, index in repodata.items():
+            self.sink.write_text(self._repodata_path(subdir), json.dumps(index, indent=1, sort_keys=True))
+            if prune:
+                self.sink.prune(os.path.join(self.root, subdir),
+                                {REPODATA_FILE, *index["packages"], *index["packages.conda"]})
+        METRICS.inc("channel_packages_total", len(missing), status="added")
+        if removed:
+            METRICS.inc("channel_packages_total", removed, status="removed")
+        METRICS.inc("channel_packages_total", len(wanted) - len(missing), status="present")
+        return len(missing), len(wanted) - len(missing)
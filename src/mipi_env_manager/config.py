@@ -0,0 +1,665 @@
+import hashlib
+import json
+import os
+import re
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Iterator, Mapping, Optional, Tuple
+
+import yaml
+
+SOURCES = ("github", "pypi")
+VERSION_POLICIES = ("exact", "compatible")
+ON_DEADLINE = ("fail", "last_known")
+INSTALLERS = ("pip", "uv", "uv-sync")
+STATE_DIR = ".mipi"
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+
+class ConfigError(ValueError):
+    """
+    The setup file is invalid. Lists every problem found, not just the first.
+    """
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super().__init__("invalid config:\n" + "\n".join(f"  {e}" for e in self.errors))
+
+
+class StringPool:
+    """
+    Sources, policies, versions and repo urls repeat across thousands of packages, so share one string object each.
+    Like `sys.intern`, but scoped to a single parse and bounded, so streaming a huge config cannot grow it forever.
+    """
+
+    def __init__(self, max_size=1 << 16):
+        self.max_size = max_size
+        self._strings = {}
+
+    def __call__(self, value) -> Optional[str]:
+        if value is None:
+            return None
+        value = str(value)
+        shared = self._strings.get(value)
+        if shared is None:
+            if len(self._strings) >= self.max_size:
+                self._strings.clear()
+            self._strings[value] = shared = value
+        return shared
+
+
+@dataclass(frozen=True, slots=True)
+class PackageSpec:
+    """
+    A single dependency of an environment
+    """
+    name: str
+    source: str
+    version: Optional[str] = None
+    version_policy: Optional[str] = None
+    path: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, name, vals: dict, errors: list = None, where="", intern: StringPool = None) -> "PackageSpec":
+        raise_errors = errors is None
+        intern = intern or StringPool()
+        errors = [] if errors is None else errors
+        where = where or f"packages.{name}"
+
+        if not isinstance(vals, dict):
+            errors.append(f"{where}: expected a mapping, got {type(vals).__name__}")
+            vals = {}
+        source = vals.get("source")
+        if source not in SOURCES:
+            errors.append(f"{where}.source: must be one of {', '.join(SOURCES)}, got {source!r}")
+        policy = vals.get("version_policy")
+        if policy is not None and policy not in VERSION_POLICIES:
+            errors.append(f"{where}.version_policy: must be one of {', '.join(VERSION_POLICIES)}, got {policy!r}")
+        if source == "github" and not vals.get("path"):
+            errors.append(f"{where}.path: required for github packages")
+
+        if raise_errors and errors:
+            raise ConfigError(errors)
+        return cls(intern(name), intern(source), intern(vals.get("version")), intern(policy), intern(vals.get("path")))
+
+
+@dataclass(frozen=True, slots=True)
+class EnvironmentSpec:
+    """
+    A single environment: its python version, whether the master installers include it, and its packages.
+    `installer` is None when the environment uses the setup's installer.
+    """
+    name: str
+    py_version: str
+    include_in_master: bool
+    packages: Tuple[PackageSpec, ...]
+    installer: Optional[str] = None
+
+
+@dataclass(frozen=True, slots=True)
+class ResolutionSpec:
+    """
+    How release lookups behave: per request timeouts, retries with jittered exponential backoff on 5xx and connection
+    errors, and a deadline in seconds for the whole resolution phase. When the deadline is hit `on_deadline` either
+    fails the run ("fail") or uses the version resolved for that package by a previous run ("last_known").
+    """
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    retries: int = 3
+    backoff: float = 1.0
+    max_backoff: float = 30.0
+    deadline: Optional[float] = None
+    on_deadline: str = "fail"
+
+
+def normalise_repo_url(url) -> str:
+    return str(url).rstrip("/").removesuffix(".git")
+
+
+def canonical_package_name(name) -> str:
+    """
+    Package names compare like pip compares them: case-insensitive, with runs of "-", "_" and "." treated as one "-"
+    """
+    return re.sub(r"[-_.]+", "-", str(name)).lower()
+
+
+class EnvironmentIndex:
+    """
+    Which environments reference each package and each repo, to publish only the environments a change affects.
+    Environments can be added one at a time, so the index can be built while streaming.
+    """
+
+    def __init__(self):
+        self.by_package = {}
+        self.by_repo = {}
+
+    @classmethod
+    def from_environments(cls, environments) -> "EnvironmentIndex":
+        index = cls()
+        for env in environments:
+            index.add(env)
+        return index
+
+    def add(self, env: EnvironmentSpec):
+        for pkg in env.packages:
+            self.by_package.setdefault(canonical_package_name(pkg.name), set()).add(env.name)
+            if pkg.path is not None:
+                self.by_repo.setdefault(normalise_repo_url(pkg.path).lower(), set()).add(env.name)
+
+    def for_package(self, name) -> set:
+        return self.by_package.get(canonical_package_name(name), set())
+
+    def for_repo(self, url) -> set:
+        return self.by_repo.get(normalise_repo_url(url).lower(), set())
+
+
+@dataclass(frozen=True, slots=True)
+class MirrorSpec:
+    """
+    Local bare git mirrors used to list a repo's tags instead of the GitHub API. A repo's mirror is either listed in
+    `repos` by its url, or found under `root` as `<root>/<user>/<repo>.git`. All mirrors are refreshed in one
+    parallel fetch pass at the start of a publish, unless `refresh` is false.
+    """
+    root: Optional[str] = None
+    repos: Tuple[Tuple[str, str], ...] = ()
+    refresh: bool = True
+    workers: int = 8
+    fetch_timeout: float = 120.0
+
+    def path_for(self, user, repo) -> Optional[str]:
+        url = normalise_repo_url(f"https://github.com/{user}/{repo}")
+        for repo_url, path in self.repos:
+            if normalise_repo_url(repo_url) == url:
+                return path
+        if self.root is not None:
+            return os.path.join(self.root, user, f"{repo}.git")
+        return None
+
+
+@dataclass(frozen=True, slots=True)
+class CondaLockSpec:
+    """
+    When enabled, each distinct py_version is solved once by the publisher and create_env.bat installs the explicit
+    spec with `conda create --file`, so clients never run the conda solver. `subdir` is the clients' platform. With
+    `local_channel`, the solved packages are also copied in to a channel in the outpath that clients create from
+    offline.
+    """
+    enabled: bool = False
+    subdir: str = "win-64"
+    channels: Tuple[str, ...] = ()
+    conda_exe: str = "conda"
+    local_channel: bool = False
+
+
+@dataclass(frozen=True, slots=True)
+class VerifySpec:
+    """
+    When enabled, a publish installs each environment it built in to a throwaway virtualenv on the publishing host
+    before anything is written, and only writes the new generation if every install succeeds. `index_url` is the pip
+    index installed from, pip's own when None. `pythons` maps a py_version to the interpreter that creates its
+    virtualenvs; other versions use `python<py_version>` on the path.
+    """
+    enabled: bool = False
+    index_url: Optional[str] = None
+    workers: int = 4
+    timeout: float = 900.0
+    pythons: Tuple[Tuple[str, str], ...] = ()
+
+    def python_for(self, py_version) -> Optional[str]:
+        return dict(self.pythons).get(str(py_version))
+
+
+@dataclass(frozen=True, slots=True)
+class ScheduleSpec:
+    """
+    Scheduled runs of the master installers, spread across a window so the fleet does not start at once. Each host,
+    or each group of hosts, starts at an offset in the window taken from a hash of its name. Windows are minutes since
+    midnight and may wrap past it. Creates run in their own, usually off-peak, window on `create_days`.
+    """
+    enabled: bool = False
+    hosts: Tuple[str, ...] = ()
+    groups: Tuple[Tuple[str, Tuple[str, ...]], ...] = ()
+    update_window: Tuple[int, int] = (7 * 60, 9 * 60)
+    create_window: Tuple[int, int] = (1 * 60, 5 * 60)
+    create_days: Tuple[str, ...] = ("Sunday",)
+    variant: str = "prod"
+
+
+@dataclass(frozen=True, slots=True)
+class SetupSpec:
+    """
+    The setup shared by all environments. `outpath` is the first of `outpaths`, the target that state is kept in
+    """
+    outpath: object
+    environment_variables: Mapping[str, str]
+    resolution: ResolutionSpec = ResolutionSpec()
+    mirrors: MirrorSpec = MirrorSpec()
+    conda_lock: CondaLockSpec = CondaLockSpec()
+    installer: str = "pip"
+    telemetry_dir: Optional[str] = None
+    schedule: ScheduleSpec = ScheduleSpec()
+    outpaths: Tuple[str, ...] = ()
+    history_db: Optional[str] = None
+    constraints: bool = True
+    verify: VerifySpec = VerifySpec()
+
+
+@dataclass(frozen=True, slots=True)
+class ConfigFile:
+    """
+    One file of a config split across files: its path relative to the config's folder, its hash and the environments
+    it defines
+    """
+    key: str
+    sha256: str
+    environments: Tuple[str, ...]
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    The parsed and validated setup file. Immutable, so it can be shared by everything downstream of the parse.
+    `files` is only set for a config split across files, root file first.
+    """
+    environments: Mapping[str, EnvironmentSpec]
+    setup: SetupSpec
+    fingerprint: str
+    files: Tuple[ConfigFile, ...] = ()
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "Config":
+        """
+        Validate the whole raw `yaml.safe_load` dict in one pass and build the model
+        """
+        errors = []
+        intern = StringPool()
+        if not isinstance(raw, dict):
+            raise ConfigError([f"expected a mapping at the top level, got {type(raw).__name__}"])
+
+        environments = {}
+        raw_envs = raw.get("environments")
+        if not isinstance(raw_envs, dict):
+            errors.append("environments: expected a mapping of environment names")
+            raw_envs = {}
+        for env_name, env in raw_envs.items():
+            spec = _environment_from_dict(env_name, env, errors, intern)
+            if spec is not None:
+                environments[spec.name] = spec
+
+        setup = _setup_from_dict(raw.get("setup"), errors, intern)
+
+        if errors:
+            raise ConfigError(errors)
+        return cls(MappingProxyType(environments), setup, fingerprint(raw))
+
+
+def _environment_from_dict(env_name, env, errors, intern: StringPool) -> Optional[EnvironmentSpec]:
+    where = f"environments.{env_name}"
+    if not isinstance(env, dict):
+        errors.append(f"{where}: expected a mapping, got {type(env).__name__}")
+        return None
+
+    setup = env.get("setup")
+    if not isinstance(setup, dict):
+        errors.append(f"{where}.setup: expected a mapping")
+        setup = {}
+    if setup.get("py_version") is None:
+        errors.append(f"{where}.setup.py_version: required")
+    if not isinstance(setup.get("include_in_master"), bool):
+        errors.append(f"{where}.setup.include_in_master: must be true or false")
+    installer = setup.get("installer")
+    if installer is not None and installer not in INSTALLERS:
+        errors.append(f"{where}.setup.installer: must be one of {', '.join(INSTALLERS)}, got {installer!r}")
+
+    packages = env.get("packages") or {}
+    if not isinstance(packages, dict):
+        errors.append(f"{where}.packages: expected a mapping of package names")
+        packages = {}
+    specs = tuple(PackageSpec.from_dict(name, vals, errors, f"{where}.packages.{name}", intern)
+                  for name, vals in packages.items())
+
+    return EnvironmentSpec(str(env_name), intern(setup.get("py_version")), bool(setup.get("include_in_master")),
+                           specs, intern(installer))
+
+
+def _setup_from_dict(setup, errors, intern: StringPool) -> Optional[SetupSpec]:
+    if not isinstance(setup, dict):
+        errors.append("setup: expected a mapping")
+        return None
+    if "outpath" not in setup:
+        errors.append("setup.outpath: required")
+    outpaths = _outpaths_from_value(setup.get("outpath"), errors)
+    environment_variables = setup.get("environment_variables") or {}
+    if not isinstance(environment_variables, dict):
+        errors.append("setup.environment_variables: expected a mapping")
+        environment_variables = {}
+    environment_variables = {intern(k): intern(v) for k, v in environment_variables.items()}
+    resolution = _resolution_from_dict(setup.get("resolution") or {}, errors)
+    mirrors = _mirrors_from_dict(setup.get("mirrors") or {}, errors)
+    conda_lock = _conda_lock_from_dict(setup.get("conda_lock"), errors)
+    installer = setup.get("installer", "pip")
+    if installer not in INSTALLERS:
+        errors.append(f"setup.installer: must be one of {', '.join(INSTALLERS)}, got {installer!r}")
+    telemetry_dir = setup.get("telemetry_dir")
+    schedule = _schedule_from_dict(setup.get("schedule"), errors)
+    history_db = setup.get("history_db")
+    constraints = setup.get("constraints", True)
+    if not isinstance(constraints, bool):
+        errors.append(f"setup.constraints: expected true or false, got {constraints!r}")
+        constraints = True
+    verify = _verify_from_dict(setup.get("verify"), errors)
+    return SetupSpec(outpaths[0] if outpaths else setup.get("outpath"), MappingProxyType(environment_variables),
+                     resolution, mirrors, conda_lock, installer, None if telemetry_dir is None else str(telemetry_dir),
+                     schedule, outpaths, None if history_db is None else str(history_db), constraints, verify)
+
+
+def _outpaths_from_value(value, errors) -> Tuple[str, ...]:
+    """
+    `outpath` is one folder or a list of them, e.g. one file share per region
+    """
+    if value is None:
+        return ()
+    if not isinstance(value, list):
+        return (str(value),)
+    if not value:
+        errors.append("setup.outpath: expected a folder or a non empty list of folders")
+        return ()
+    outpaths = tuple(str(v) for v in value)
+    duplicates = sorted({p for p in outpaths if outpaths.count(p) > 1})
+    if duplicates:
+        errors.append(f"setup.outpath: listed more than once: {', '.join(duplicates)}")
+    return outpaths
+
+
+def _parse_window(value, where, errors, default) -> Tuple[int, int]:
+    """
+    "HH:MM-HH:MM" to minutes since midnight
+    """
+    match = re.fullmatch(r"(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})", str(value).strip())
+    if match is not None:
+        h1, m1, h2, m2 = map(int, match.groups())
+        if h1 < 24 and h2 < 24 and m1 < 60 and m2 < 60 and (h1, m1) != (h2, m2):
+            return h1 * 60 + m1, h2 * 60 + m2
+    errors.append(f"{where}: expected a window like \"07:00-09:00\", got {value!r}")
+    return default
+
+
+def _schedule_from_dict(schedule, errors) -> ScheduleSpec:
+    if schedule is None:
+        return ScheduleSpec()
+    if not isinstance(schedule, dict):
+        errors.append("setup.schedule: expected a mapping")
+        return ScheduleSpec()
+    unknown = set(schedule) - set(ScheduleSpec.__dataclass_fields__)
+    for field in sorted(unknown):
+        errors.append(f"setup.schedule.{field}: unknown option")
+
+    hosts = schedule.get("hosts") or []
+    if not isinstance(hosts, list):
+        errors.append("setup.schedule.hosts: expected a list of host names")
+        hosts = []
+    groups = schedule.get("groups") or {}
+    if not isinstance(groups, dict) or not all(isinstance(v, list) for v in groups.values()):
+        errors.append("setup.schedule.groups: expected a mapping of group name to a list of host names")
+        groups = {}
+    for name in list(hosts) + list(groups):
+        if not re.fullmatch(r"[A-Za-z0-9_.-]+", str(name)):
+            errors.append(f"setup.schedule: {name!r} is not a valid host or group name")
+
+    create_days = schedule.get("create_days", ["Sunday"])
+    if not isinstance(create_days, list) or not set(create_days) <= set(WEEKDAYS):
+        errors.append(f"setup.schedule.create_days: expected a list of {', '.join(WEEKDAYS)}")
+        create_days = ["Sunday"]
+    variant = schedule.get("variant", "prod")
+    if variant not in ("prod", "test"):
+        errors.append(f"setup.schedule.variant: must be one of prod, test, got {variant!r}")
+
+    default = ScheduleSpec()
+    return ScheduleSpec(
+        bool(schedule.get("enabled", True)),
+        tuple(str(h) for h in hosts),
+        tuple((str(g), tuple(str(h) for h in members)) for g, members in groups.items()),
+        _parse_window(schedule.get("update_window", "07:00-09:00"), "setup.schedule.update_window", errors,
+                      default.update_window),
+        _parse_window(schedule.get("create_window", "01:00-05:00"), "setup.schedule.create_window", errors,
+                      default.create_window),
+        tuple(create_days),
+        variant,
+    )
+
+
+def _conda_lock_from_dict(conda_lock, errors) -> CondaLockSpec:
+    """
+    `conda_lock: true` enables it with the defaults, or a mapping sets the options
+    """
+    if conda_lock is None or conda_lock is False:
+        return CondaLockSpec()
+    if conda_lock is True:
+        return CondaLockSpec(enabled=True)
+    if not isinstance(conda_lock, dict):
+        errors.append("setup.conda_lock: expected true, false or a mapping")
+        return CondaLockSpec()
+    channels = conda_lock.get("channels") or []
+    if not isinstance(channels, list):
+        errors.append("setup.conda_lock.channels: expected a list of channels")
+        channels = []
+    unknown = set(conda_lock) - set(CondaLockSpec.__dataclass_fields__)
+    for field in sorted(unknown):
+        errors.append(f"setup.conda_lock.{field}: unknown option")
+    return CondaLockSpec(bool(conda_lock.get("enabled", True)), str(conda_lock.get("subdir", "win-64")),
+                         tuple(str(c) for c in channels), str(conda_lock.get("conda_exe", "conda")),
+                         bool(conda_lock.get("local_channel", False)))
+
+
+def _verify_from_dict(verify, errors) -> VerifySpec:
+    """
+    `verify: true` enables it with the defaults, or a mapping sets the options
+    """
+    if verify is None or verify is False:
+        return VerifySpec()
+    if verify is True:
+        return VerifySpec(enabled=True)
+    if not isinstance(verify, dict):
+        errors.append("setup.verify: expected true, false or a mapping")
+        return VerifySpec()
+    unknown = set(verify) - set(VerifySpec.__dataclass_fields__)
+    for field in sorted(unknown):
+        errors.append(f"setup.verify.{field}: unknown option")
+    workers = verify.get("workers", 4)
+    if isinstance(workers, bool) or not isinstance(workers, int) or workers < 1:
+        errors.append(f"setup.verify.workers: must be an integer >= 1, got {workers!r}")
+        workers = 4
+    timeout = verify.get("timeout", 900.0)
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+        errors.append(f"setup.verify.timeout: must be a number > 0, got {timeout!r}")
+        timeout = 900.0
+    pythons = verify.get("pythons") or {}
+    if not isinstance(pythons, dict):
+        errors.append("setup.verify.pythons: expected a mapping of py_version to interpreter path")
+        pythons = {}
+    index_url = verify.get("index_url")
+    return VerifySpec(bool(verify.get("enabled", True)), None if index_url is None else str(index_url), workers,
+                      float(timeout), tuple((str(k), str(v)) for k, v in pythons.items()))
+
+
+def _mirrors_from_dict(mirrors, errors) -> MirrorSpec:
+    if not isinstance(mirrors, dict):
+        errors.append("setup.mirrors: expected a mapping")
+        return MirrorSpec()
+    repos = mirrors.get("repos") or {}
+    if not isinstance(repos, dict):
+        errors.append("setup.mirrors.repos: expected a mapping of repo url to mirror path")
+        repos = {}
+    workers = mirrors.get("workers", 8)
+    if isinstance(workers, bool) or not isinstance(workers, int) or workers < 1:
+        errors.append(f"setup.mirrors.workers: must be an integer >= 1, got {workers!r}")
+        workers = 8
+    unknown = set(mirrors) - set(MirrorSpec.__dataclass_fields__)
+    for field in sorted(unknown):
+        errors.append(f"setup.mirrors.{field}: unknown option")
+    root = mirrors.get("root")
+    return MirrorSpec(None if root is None else str(root), tuple((str(k), str(v)) for k, v in repos.items()),
+                      bool(mirrors.get("refresh", True)), workers, float(mirrors.get("fetch_timeout", 120.0)))
+
+
+def _resolution_from_dict(resolution, errors) -> ResolutionSpec:
+    if not isinstance(resolution, dict):
+        errors.append("setup.resolution: expected a mapping")
+        return ResolutionSpec()
+
+    values = {}
+    for field, type_ in (("connect_timeout", float), ("read_timeout", float), ("retries", int), ("backoff", float),
+                         ("max_backoff", float), ("deadline", float)):
+        if resolution.get(field) is None:
+            continue
+        value = resolution[field]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            errors.append(f"setup.resolution.{field}: must be a number >= 0, got {value!r}")
+            continue
+        values[field] = type_(value)
+
+    on_deadline = resolution.get("on_deadline", "fail")
+    if on_deadline not in ON_DEADLINE:
+        errors.append(f"setup.resolution.on_deadline: must be one of {', '.join(ON_DEADLINE)}, got {on_deadline!r}")
+    else:
+        values["on_deadline"] = on_deadline
+
+    unknown = set(resolution) - set(ResolutionSpec.__dataclass_fields__)
+    for field in sorted(unknown):
+        errors.append(f"setup.resolution.{field}: unknown option")
+    return ResolutionSpec(**values)
+
+
+def fingerprint(raw: dict) -> str:
+    """
+    A stable hash of the raw config, independent of key order
+    """
+    canonical = json.dumps(raw, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _EventComposer:
+    """
+    Builds yaml nodes from the parser's event stream one subtree at a time, so that a huge document never has to be
+    composed in full. Works with the C loader when it is available, which does not expose its own composer.
+    """
+
+    def __init__(self, stream):
+        self.loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)(stream)
+        self.anchors = {}
+
+    def close(self):
+        self.loader.dispose()
+
+    def expect(self, event_type):
+        event = self.loader.get_event()
+        if not isinstance(event, event_type):
+            raise ConfigError([f"expected {event_type.__name__}, got {type(event).__name__}"])
+        return event
+
+    def at(self, event_type) -> bool:
+        return isinstance(self.loader.peek_event(), event_type)
+
+    def compose(self):
+        event = self.loader.get_event()
+        if isinstance(event, yaml.AliasEvent):
+            return self.anchors[event.anchor]
+        if isinstance(event, yaml.ScalarEvent):
+            tag = event.tag
+            if tag is None or tag == "!":
+                tag = self.loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+            node = yaml.ScalarNode(tag, event.value, style=event.style)
+        elif isinstance(event, yaml.SequenceStartEvent):
+            tag = event.tag or self.loader.resolve(yaml.SequenceNode, None, event.implicit)
+            node = yaml.SequenceNode(tag, [])
+            while not self.at(yaml.SequenceEndEvent):
+                node.value.append(self.compose())
+            self.loader.get_event()
+        else:
+            tag = event.tag or self.loader.resolve(yaml.MappingNode, None, event.implicit)
+            node = yaml.MappingNode(tag, [])
+            while not self.at(yaml.MappingEndEvent):
+                node.value.append((self.compose(), self.compose()))
+            self.loader.get_event()
+        if event.anchor is not None:
+            self.anchors[event.anchor] = node
+        return node
+
+    def load(self):
+        return self.loader.construct_document(self.compose())
+
+    def skip(self):
+        depth = 0
+        while True:
+            event = self.loader.get_event()
+            if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+                depth += 1
+            elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                depth -= 1
+            if depth == 0:
+                return
+
+    def top_level_keys(self) -> Iterator[str]:
+        """
+        Yield each key of the top level mapping, leaving the parser positioned at its value. The caller must consume
+        the value with `load`, `skip` or by walking it.
+        """
+        self.expect(yaml.StreamStartEvent)
+        self.expect(yaml.DocumentStartEvent)
+        self.expect(yaml.MappingStartEvent)
+        while not self.at(yaml.MappingEndEvent):
+            yield self.load()
+
+
+def read_setup(stream) -> SetupSpec:
+    """
+    Read only the `setup` section of a config file, skipping over the environments without building them
+    """
+    composer = _EventComposer(stream)
+    try:
+        for key in composer.top_level_keys():
+            if key == "setup":
+                errors = []
+                setup = _setup_from_dict(composer.load(), errors, StringPool())
+                if errors:
+                    raise ConfigError(errors)
+                return setup
+            composer.skip()
+    finally:
+        composer.close()
+    raise ConfigError(["setup: expected a mapping"])
+
+
+def iter_environments(stream) -> Iterator[EnvironmentSpec]:
+    """
+    Yield the environments of a config file one at a time, straight from the yaml event stream. Each environment is
+    validated as it is read, so memory use does not grow with the number of environments.
+    """
+    composer = _EventComposer(stream)
+    intern = StringPool()
+    try:
+        for key in composer.top_level_keys():
+            if key != "environments":
+                composer.skip()
+                continue
+            composer.expect(yaml.MappingStartEvent)
+            while not composer.at(yaml.MappingEndEvent):
+                env_name = composer.load()
+                errors = []
+                spec = _environment_from_dict(env_name, composer.load(), errors, intern)
+                if errors:
+                    raise ConfigError(errors)
+                yield spec
+            composer.expect(yaml.MappingEndEvent)
+    finally:
+        composer.close()
+
+
+def fingerprint_stream(stream, chunk_size=1 << 16) -> str:
+    """
+    A hash of the raw bytes of a config file, read in chunks
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,280 @@
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from types import MappingProxyType
+from typing import Dict, Iterator, List, Optional
+
+import yaml
+
+from mipi_env_manager.config import (
+    STATE_DIR,
+    Config,
+    ConfigError,
+    ConfigFile,
+    EnvironmentSpec,
+    SetupSpec,
+    StringPool,
+    _environment_from_dict,
+    _setup_from_dict,
+    iter_environments,
+)
+from mipi_env_manager.sinks import open_temp_beside
+
+ROOT_FILE_NAMES = ("setup.yml", "setup.yaml")
+CACHE_FILE = "config_cache.json"
+
+
+def has_include(path) -> bool:
+    """
+    True if a config file has a top level `include:`. Only the unindented lines, the top level keys, are checked one
+    at a time, so a huge single file is neither parsed twice nor read in to memory
+    """
+    with open(path, "rb") as f:
+        return any(line[:7] == b"include" and re.match(rb"include\s*:", line) for line in f)
+
+
+def _json_safe(value) -> bool:
+    """
+    True if `value` round trips through json unchanged. yaml also gives dates and non string keys, which json would
+    turn in to strings
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return True
+    if isinstance(value, list):
+        return all(_json_safe(v) for v in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and _json_safe(v) for k, v in value.items())
+    return False
+
+
+def _file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parse_file(path) -> dict:
+    """
+    Parse one yaml file. Module level so that it can run in a worker process
+    """
+    with open(path, "rb") as f:
+        raw = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    return raw if raw is not None else {}
+
+
+class ConfigFiles:
+    """
+    A config split across files, so that each team can own its environments' files. Either a folder holding a root
+    `setup.yml` and any number of other yaml files, or a root file whose `include:` lists glob patterns relative to
+    it. Only the root file may have `setup`; any file may have `environments`.
+
+    Files are hashed individually. The parsed content of each file is cached in the outpath by its hash, so only
+    changed files are parsed again, in parallel, and the hashes tell a publish which environments changed. Files
+    whose content json cannot hold as it is, e.g. with yaml dates, are not cached and are always parsed.
+    """
+
+    def __init__(self, path, workers=None):
+        path = Path(path)
+        if path.is_dir():
+            roots = [path / name for name in ROOT_FILE_NAMES if (path / name).is_file()]
+            if not roots:
+                raise ConfigError([f"{path}: a config folder needs a {' or '.join(ROOT_FILE_NAMES)}"])
+            self.root, self.base, self.folder = roots[0], path, True
+        else:
+            self.root, self.base, self.folder = path, path.parent, False
+        self.workers = workers
+        self._root_raw = None
+
+    def key(self, path) -> str:
+        return Path(os.path.relpath(path, self.base)).as_posix()
+
+    def root_raw(self) -> dict:
+        if self._root_raw is None:
+            raw = _parse_file(self.root)
+            if not isinstance(raw, dict):
+                raise ConfigError([f"{self.key(self.root)}: expected a mapping at the top level"])
+            self._root_raw = raw
+        return self._root_raw
+
+    def files(self) -> List[Path]:
+        """
+        Every file of the config, root first, then the others in a stable order
+        """
+        if self.folder:
+            others = {p for pattern in ("*.yml", "*.yaml") for p in self.base.rglob(pattern)}
+            others.discard(self.root)
+            return [self.root] + sorted(others)
+
+        include = self.root_raw().get("include") or []
+        if isinstance(include, str):
+            include = [include]
+        files, errors = [self.root], []
+        for pattern in include:
+            matches = sorted(p for p in self.base.glob(str(pattern)) if p.is_file() and p != self.root)
+            if not matches:
+                errors.append(f"{self.key(self.root)}: include {pattern!r} matches no files")
+            files += [p for p in matches if p not in files]
+        if errors:
+            raise ConfigError(errors)
+        return files
+
+    def fingerprints(self) -> Dict[str, str]:
+        files = self.files()
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            return dict(zip(map(self.key, files), executor.map(_file_sha256, files)))
+
+    def fingerprint(self) -> str:
+        canonical = json.dumps(self.fingerprints(), sort_keys=True)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def setup_spec(self) -> SetupSpec:
+        errors = []
+        setup = _setup_from_dict(self.root_raw().get("setup"), errors, StringPool())
+        if errors:
+            raise ConfigError([f"{self.key(self.root)}: {e}" for e in errors])
+        return setup
+
+    def _parse_all(self, paths: List[Path]) -> List[dict]:
+        if len(paths) < 2 or self.workers == 1:
+            return [_parse_file(p) for p in paths]
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(_parse_file, paths))
+
+    def _load_cache(self, cache_path) -> dict:
+        try:
+            with open(cache_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_cache(self, cache_path, cache: dict):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        f, tmp_path = open_temp_beside(cache_path)
+        try:
+            with f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def load(self, use_cache=True, save_cache=True) -> Config:
+        """
+        Parse and validate every file, reporting every problem in every file together, including environments defined
+        in more than one file. With `save_cache` false the cache is read but not updated, for a run that publishes
+        nothing
+        """
+        setup = self.setup_spec()
+        fingerprints = self.fingerprints()
+        files = self.files()
+
+        cache_path = None
+        cache = {}
+        if use_cache and setup.outpath is not None:
+            cache_path = os.path.join(setup.outpath, STATE_DIR, CACHE_FILE)
+            cache = self._load_cache(cache_path)
+
+        raws = {self.key(self.root): self.root_raw()}
+        stale = [p for p in files[1:] if cache.get(self.key(p), {}).get("sha256") != fingerprints[self.key(p)]]
+        for path, raw in zip(stale, self._parse_all(stale)):
+            raws[self.key(path)] = raw
+        for path in files[1:]:
+            if self.key(path) not in raws:
+                raws[self.key(path)] = cache[self.key(path)]["raw"]
+
+        errors = []
+        intern = StringPool()
+        environments = {}
+        defined_in = {}
+        config_files = []
+        for path in files:
+            key = self.key(path)
+            raw = raws[key]
+            file_errors = []
+            if not isinstance(raw, dict):
+                file_errors.append(f"expected a mapping at the top level, got {type(raw).__name__}")
+                raw = {}
+            if path != self.root and "setup" in raw:
+                file_errors.append("setup: only allowed in the root file")
+            raw_envs = raw.get("environments") or {}
+            if not isinstance(raw_envs, dict):
+                file_errors.append("environments: expected a mapping of environment names")
+                raw_envs = {}
+            for env_name, env in raw_envs.items():
+                if str(env_name) in defined_in:
+                    file_errors.append(f"environments.{env_name}: already defined in {defined_in[str(env_name)]}")
+                    continue
+                defined_in[str(env_name)] = key
+                spec = _environment_from_dict(env_name, env, file_errors, intern)
+                if spec is not None:
+                    environments[spec.name] = spec
+            errors += [f"{key}: {e}" for e in file_errors]
+            config_files.append(ConfigFile(key, fingerprints[key], tuple(str(n) for n in raw_envs)))
+
+        if not defined_in:
+            errors.append("environments: no environments are defined in any file")
+        if errors:
+            raise ConfigError(errors)
+
+        if save_cache and cache_path is not None and stale:
+            self._save_cache(cache_path, {self.key(p): {"sha256": fingerprints[self.key(p)], "raw": raws[self.key(p)]}
+                                          for p in files[1:] if _json_safe(raws[self.key(p)])})
+        combined = hashlib.sha256(json.dumps(fingerprints, sort_keys=True).encode("utf-8")).hexdigest()
+        return Config(MappingProxyType(environments), setup, combined, tuple(config_files))
+
+    def raw(self) -> dict:
+        """
+        The files merged in to one raw config, as if it were a single file
+        """
+        environments = {}
+        for path in self.files():
+            raw = self.root_raw() if path == self.root else _parse_file(path)
+            environments.update((raw or {}).get("environments") or {})
+        return {"environments": environments, "setup": self.root_raw().get("setup")}
+
+    def iter_environments(self) -> Iterator[EnvironmentSpec]:
+        """
+        Stream the environments file by file. Only the names seen so far are kept, to report duplicates
+        """
+        seen = {}
+        for path in self.files():
+            with open(path, "rb") as f:
+                for spec in iter_environments(f):
+                    if spec.name in seen:
+                        raise ConfigError([f"{self.key(path)}: environments.{spec.name}: already defined in "
+                                           f"{seen[spec.name]}"])
+                    seen[spec.name] = self.key(path)
+                    yield spec
+
+
+def previous_fingerprints(path) -> Optional[dict]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def changed_environments(config: Config, previous: Optional[dict]) -> Optional[set]:
+    """
+    The environments whose files changed since `previous` (the record of the last publish). None means all of them:
+    nothing was recorded, the config is a single file, or the root file with the shared setup changed
+    """
+    if previous is None:
+        return None
+    if previous.get("fingerprint") == config.fingerprint:
+        return set()
+    if not config.files or previous.get("files", {}).get(config.files[0].key) != config.files[0].sha256:
+        return None
+    previous_files = previous.get("files", {})
+    return {env for f in config.files[1:] if previous_files.get(f.key) != f.sha256 for env in f.environments}
+
+
+def fingerprint_record(config: Config) -> dict:
+    return {"fingerprint": config.fingerprint, "files": {f.key: f.sha256 for f in config.files}}
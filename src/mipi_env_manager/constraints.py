@@ -0,0 +1,141 @@
+import hashlib
+import itertools
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.specifiers import SpecifierSet
+
+from mipi_env_manager.config import canonical_package_name
+from mipi_env_manager.spool import Spool
+
+CONSTRAINTS_FILE = "constraints.txt"
+
+
+@dataclass(frozen=True, slots=True)
+class PinConflict:
+    """
+    A package that environments pin in ways no single constraint satisfies, so it is left out of the constraints.
+    `pins` are each distinct pin, a version specifier or a github url, with the environments that use it
+    """
+    package: str
+    pins: Tuple[Tuple[str, Tuple[str, ...]], ...]
+
+    def describe(self) -> str:
+        return f"{self.package}: " + "; ".join(f"{pin} ({', '.join(envs)})" for pin, envs in self.pins)
+
+
+def _exact_version(specifier: SpecifierSet) -> Optional[str]:
+    exact = [s.version for s in specifier if s.operator in ("==", "===") and "*" not in s.version]
+    return exact[0] if len(exact) == 1 else None
+
+
+def merge_pins(package, pins: Dict[str, List[str]]) -> Tuple[Optional[str], Optional[PinConflict]]:
+    """
+    The constraint for a package from its pins across environments, or the conflict that stops it having one.
+    A package installed from github is never constrained. Environments that leave the package unpinned follow the
+    others. Different specifiers are merged when one exact pin satisfies every one of them, e.g. `==1.4.2` and
+    `~=1.4.0` give `==1.4.2`
+    """
+    urls = sorted(pin for pin in pins if pin.startswith("@"))
+    specifiers = sorted(pin for pin in pins if pin and not pin.startswith("@"))
+    if urls:
+        if specifiers or len(urls) > 1:
+            return None, PinConflict(package, tuple((pin, tuple(sorted(pins[pin]))) for pin in urls + specifiers))
+        return None, None
+    if not specifiers:
+        return None, None
+    if len(specifiers) == 1:
+        return f"{package}{specifiers[0]}", None
+
+    exact = {_exact_version(SpecifierSet(pin)) for pin in specifiers} - {None}
+    if len(exact) == 1:
+        version = exact.pop()
+        if all(SpecifierSet(pin).contains(version, prereleases=True) for pin in specifiers):
+            return f"{package}=={version}", None
+    return None, PinConflict(package, tuple((pin, tuple(sorted(pins[pin]))) for pin in specifiers))
+
+
+def constraints_by_package(lines: Iterable[str]) -> Dict[str, str]:
+    """
+    The constraint lines of constraints.txt by package, without its comments
+    """
+    return {canonical_package_name(Requirement(line).name): line for line in lines if line and not line.startswith("#")}
+
+
+def constraints_sha256(by_package: Dict[str, str], packages: Iterable[str]) -> str:
+    """
+    The sha256 of the constraints that apply to an environment, those of its `packages`, so an environment's stamp
+    only changes with the constraints of what it pins. A constraint on a dependency it only pulls in through other
+    packages reaches it at its next update for another reason
+    """
+    lines = sorted({by_package[name] for name in map(canonical_package_name, packages) if name in by_package})
+    return hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+
+class Constraints(Spool):
+    """
+    A team-wide pip constraints file from the union of every environment's pins. Each environment's requirements
+    are resolved on its own, so pip picks different versions of shared dependencies per environment and clients keep
+    many slightly different wheels of the same library. Installing with `-c constraints.txt` makes a dependency pinned
+    by any environment resolve to that version in every environment, which converges their transitive dependencies
+    and narrows pip's backtracking.
+
+    Only packages pinned consistently are constrained, so every environment's own requirements still satisfy the
+    constraints. Conflicting pins are reported and left out.
+
+    The pins are spooled to a temporary SQLite file as each environment is added and read back one package at a time,
+    so a streamed publish never holds every environment's pins in memory. Close it, or use it as a context manager, to
+    delete the file.
+    """
+
+    def __init__(self):
+        super().__init__("CREATE TABLE pins (package TEXT NOT NULL, pin TEXT NOT NULL, environment TEXT NOT NULL)",
+                         prefix="mipi-constraints-")
+
+    def add(self, env_name, requirements: Iterable[str]):
+        """
+        Add the requirement lines of an environment. Github packages are given by url, without a tag
+        """
+        rows = []
+        for line in requirements:
+            try:
+                requirement = Requirement(line)
+            except InvalidRequirement:
+                continue
+            if requirement.marker is not None:
+                continue
+            package = canonical_package_name(requirement.name)
+            pin = f"@ {requirement.url}" if requirement.url else str(requirement.specifier)
+            rows.append((package, pin, env_name))
+        with self.batch() as db:
+            db.executemany("INSERT INTO pins (package, pin, environment) VALUES (?, ?, ?)", rows)
+
+    def resolve(self) -> Tuple[List[str], List[PinConflict]]:
+        """
+        The constraint lines and the conflicting packages, both sorted by package
+        """
+        lines, conflicts = [], []
+        rows = self.db.execute("SELECT package, pin, environment FROM pins ORDER BY package, rowid")
+        for package, group in itertools.groupby(rows, key=lambda row: row[0]):
+            # pin -> environments
+            pins: Dict[str, List[str]] = {}
+            for _, pin, env_name in group:
+                pins.setdefault(pin, []).append(env_name)
+            line, conflict = merge_pins(package, pins)
+            if line is not None:
+                lines.append(line)
+            if conflict is not None:
+                conflicts.append(conflict)
+        return lines, conflicts
+
+    def render(self) -> Tuple[List[str], List[PinConflict]]:
+        """
+        The lines of constraints.txt, with the conflicts listed as comments, and the conflicts
+        """
+        lines, conflicts = self.resolve()
+        header = ["# generated by mipi publish-envs from the pins of every environment, do not edit"]
+        if conflicts:
+            header.append("# left out, pinned differently by different environments:")
+            header += [f"#   {conflict.describe()}" for conflict in conflicts]
+        return header + lines, conflicts
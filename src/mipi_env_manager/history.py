@@ -0,0 +1,276 @@
+import contextlib
+import datetime
+import os
+import re
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from mipi_env_manager.config import STATE_DIR, SetupSpec, canonical_package_name
+from mipi_env_manager.spool import Spool
+
+HISTORY_FILE = "history.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS publishes (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    config_sha256 TEXT,
+    complete INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS publishes_started ON publishes (started);
+
+CREATE TABLE IF NOT EXISTS pins (
+    id INTEGER PRIMARY KEY,
+    environment TEXT NOT NULL,
+    package TEXT NOT NULL,
+    version TEXT,
+    requirement TEXT NOT NULL,
+    added_in INTEGER NOT NULL REFERENCES publishes (id),
+    removed_in INTEGER REFERENCES publishes (id)
+);
+CREATE INDEX IF NOT EXISTS pins_current ON pins (environment) WHERE removed_in IS NULL;
+CREATE INDEX IF NOT EXISTS pins_environment ON pins (environment, package, added_in);
+CREATE INDEX IF NOT EXISTS pins_version ON pins (package, version, added_in);
+"""
+
+# a publish's pins, spooled until it is written to the history
+SPOOL_SCHEMA = """
+CREATE TABLE pins (
+    environment TEXT NOT NULL,
+    package TEXT NOT NULL,
+    version TEXT,
+    requirement TEXT NOT NULL,
+    PRIMARY KEY (environment, package)
+);
+CREATE TABLE recorded (environment TEXT PRIMARY KEY);
+"""
+
+# seconds to wait for another publish, e.g. a concurrent shard, to finish writing the history
+LOCK_TIMEOUT = 120.0
+
+_GITHUB_PIN = re.compile(r"^(?P<name>[^\s@]+) @ git\+\S+?(?:\.git)?(?:@(?P<tag>[^#]+))?(?:#egg=\S+)?$")
+_PYPI_PIN = re.compile(r"^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:==(?P<exact>\S+)|(?P<spec>[~<>!=]=?\S+))?$")
+
+
+def parse_pin(requirement) -> Tuple[str, Optional[str]]:
+    """
+    The package and version of a requirements.txt line: the tag of a github package, the version of an exact pypi pin,
+    the specifier of any other pypi pin (e.g. "~=1.0.0"), or None if it is not pinned
+    """
+    requirement = requirement.strip()
+    match = _GITHUB_PIN.match(requirement)
+    if match:
+        return canonical_package_name(match["name"]), match["tag"]
+    match = _PYPI_PIN.match(requirement)
+    if match:
+        return canonical_package_name(match["name"]), match["exact"] or match["spec"]
+    return canonical_package_name(requirement), None
+
+
+def history_path(setup: SetupSpec) -> str:
+    return setup.history_db or os.path.join(setup.outpath, STATE_DIR, HISTORY_FILE)
+
+
+class PublishRecord(Spool):
+    """
+    A publish being recorded by `ResolutionHistory.publishing`. Each environment's pins are spooled to a temporary
+    SQLite file as it is added, so no publish's requirements are held in memory, and written to the history in one
+    short transaction once the publish succeeds. Environments that were not added keep their pins, unless the publish
+    is marked `complete`, i.e. it covered every environment, when the pins of environments no longer in the config
+    are closed.
+    """
+
+    def __init__(self):
+        super().__init__(SPOOL_SCHEMA, prefix="mipi-history-")
+        self.id = None
+        self.complete = False
+
+    def add(self, environment, lines: Iterable[str]):
+        """
+        Record the requirements.txt lines of an environment built
+        """
+        pins = {}
+        for line in lines:
+            if line.strip():
+                package, version = parse_pin(line)
+                pins[package] = (version, line.strip())
+        with self.batch() as db:
+            db.execute("DELETE FROM pins WHERE environment = ?", (environment,))
+            db.executemany("INSERT INTO pins (environment, package, version, requirement) VALUES (?, ?, ?, ?)",
+                           [(environment, package, version, requirement)
+                            for package, (version, requirement) in pins.items()])
+            db.execute("INSERT OR IGNORE INTO recorded (environment) VALUES (?)", (environment,))
+
+
+class ResolutionHistory:
+    """
+    Every publish's resolved pins per environment, in SQLite. A pin is stored once, with the publish that added it
+    and the publish that replaced or removed it, so nightly publishes that change nothing add a single row and
+    queries over years of runs stay on the indexes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, isolation_level=None, timeout=LOCK_TIMEOUT)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextlib.contextmanager
+    def publishing(self, config_sha256=None, started: datetime.datetime = None) -> Iterator["PublishRecord"]:
+        """
+        Record one publish, one environment at a time as each is built. Nothing is written, or locked, until the block
+        exits, and nothing at all if it raises
+        """
+        started = (started or datetime.datetime.now()).isoformat(timespec="seconds")
+        publish = PublishRecord()
+        try:
+            yield publish
+            self._write(publish, config_sha256, started)
+        finally:
+            publish.close()
+
+    def _write(self, publish: PublishRecord, config_sha256, started):
+        """
+        Compare the spooled pins of each environment added with its current ones, in a single transaction
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("ATTACH DATABASE ? AS spool", (publish.path,))
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                publish.id = cursor.execute(
+                    "INSERT INTO publishes (started, config_sha256, complete) VALUES (?, ?, ?)",
+                    (started, config_sha256, int(publish.complete))).lastrowid
+                # close the pins an added environment changed or dropped, then add the ones it does not have open
+                cursor.execute("UPDATE pins SET removed_in = ? WHERE removed_in IS NULL "
+                               "AND environment IN (SELECT environment FROM spool.recorded) AND NOT EXISTS "
+                               "(SELECT 1 FROM spool.pins s WHERE s.environment = pins.environment "
+                               "AND s.package = pins.package AND s.requirement = pins.requirement)", (publish.id,))
+                cursor.execute("INSERT INTO pins (environment, package, version, requirement, added_in) "
+                               "SELECT s.environment, s.package, s.version, s.requirement, ? FROM spool.pins s "
+                               "WHERE NOT EXISTS (SELECT 1 FROM main.pins p WHERE p.environment = s.environment "
+                               "AND p.package = s.package AND p.removed_in IS NULL)", (publish.id,))
+                if publish.complete:
+                    cursor.execute("UPDATE pins SET removed_in = ? WHERE removed_in IS NULL AND environment NOT IN "
+                                   "(SELECT environment FROM spool.recorded)", (publish.id,))
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+        finally:
+            cursor.execute("DETACH DATABASE spool")
+
+    def record(self, requirements: Dict[str, Iterable[str]], config_sha256=None, complete=False,
+               started: datetime.datetime = None) -> int:
+        """
+        Record one publish, returning its id. `requirements` are the requirements.txt lines of each environment built.
+        See PublishRecord for `complete`
+        """
+        with self.publishing(config_sha256, started) as publish:
+            for environment, lines in requirements.items():
+                publish.add(environment, lines)
+            publish.complete = complete
+        return publish.id
+
+    def resolve(self, ref) -> int:
+        """
+        The id of a publish given as an id, "latest", or a date or time. A date or time means the last publish started
+        at or before it, a date meaning the end of that day
+        """
+        ref = str(ref).strip()
+        if ref.isdigit():
+            row = self.connection.execute("SELECT id FROM publishes WHERE id = ?", (int(ref),)).fetchone()
+        elif ref == "latest":
+            row = self.connection.execute("SELECT max(id) AS id FROM publishes").fetchone()
+        else:
+            try:
+                at = datetime.datetime.fromisoformat(ref)
+            except ValueError:
+                raise ValueError(f"{ref!r} is not a publish id, 'latest' or an ISO date or time")
+            if re.fullmatch(r"\d{4}-\d{2}-\d{2}", ref):
+                at += datetime.timedelta(days=1, microseconds=-1)
+            row = self.connection.execute("SELECT id FROM publishes WHERE started <= ? ORDER BY started DESC, id DESC "
+                                          "LIMIT 1", (at.isoformat(timespec="seconds"),)).fetchone()
+        if row is None or row["id"] is None:
+            raise ValueError(f"no publish matches {ref!r}")
+        return row["id"]
+
+    def publishes(self, limit=20) -> List[dict]:
+        rows = self.connection.execute(
+            "SELECT p.id, p.started, p.config_sha256, p.complete, "
+            "(SELECT count(*) FROM pins WHERE added_in = p.id) AS added, "
+            "(SELECT count(*) FROM pins WHERE removed_in = p.id) AS removed "
+            "FROM publishes p ORDER BY p.id DESC LIMIT ?", (limit,))
+        return [dict(row) for row in rows]
+
+    def log(self, environment, package=None) -> List[dict]:
+        """
+        Every pin an environment has had, oldest first, with when it was added and replaced
+        """
+        sql = ("SELECT pins.environment, pins.package, pins.version, pins.requirement, a.id AS added_in, "
+               "a.started AS added, r.id AS removed_in, r.started AS removed FROM pins "
+               "JOIN publishes a ON a.id = pins.added_in LEFT JOIN publishes r ON r.id = pins.removed_in "
+               "WHERE pins.environment = ?")
+        params = [environment]
+        if package is not None:
+            sql += " AND pins.package = ?"
+            params.append(canonical_package_name(package))
+        sql += " ORDER BY pins.added_in, pins.package"
+        return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def pins_at(self, publish_id, environment=None) -> Dict[Tuple[str, str], dict]:
+        """
+        (environment, package) -> pin, as published at a publish
+        """
+        sql = ("SELECT environment, package, version, requirement FROM pins "
+               "WHERE added_in <= ? AND (removed_in IS NULL OR removed_in > ?)")
+        params = [publish_id, publish_id]
+        if environment is not None:
+            sql += " AND environment = ?"
+            params.append(environment)
+        return {(row["environment"], row["package"]): dict(row) for row in self.connection.execute(sql, params)}
+
+    def diff(self, before, after, environment=None) -> List[dict]:
+        """
+        The pins added, removed and changed between two publishes
+        """
+        old, new = self.pins_at(before, environment), self.pins_at(after, environment)
+        rows = []
+        for key in sorted(old.keys() | new.keys()):
+            was, now = old.get(key), new.get(key)
+            if was is not None and now is not None and was["requirement"] == now["requirement"]:
+                continue
+            change = "added" if was is None else "removed" if now is None else "changed"
+            rows.append({"environment": key[0], "package": key[1], "change": change,
+                         "before": None if was is None else was["version"],
+                         "after": None if now is None else now["version"]})
+        return rows
+
+    def users(self, package, version, at=None) -> List[dict]:
+        """
+        The environments pinned to a version of a package at a publish, the latest by default. `version` may be a glob,
+        e.g. "2.3*"
+        """
+        publish_id = self.resolve(at if at is not None else "latest")
+        rows = self.connection.execute(
+            "SELECT environment, package, version, requirement FROM pins WHERE package = ? AND version GLOB ? "
+            "AND added_in <= ? AND (removed_in IS NULL OR removed_in > ?) ORDER BY environment",
+            (canonical_package_name(package), version, publish_id, publish_id))
+        return [dict(row) for row in rows]
+
+
+def format_table(rows: List[dict], columns: List[str]) -> str:
+    table = [columns] + [["" if row[c] is None else str(row[c]) for c in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    return "\n".join("  ".join(v.ljust(w) for v, w in zip(line, widths)).rstrip() for line in table)
@@ -1,13 +1,64 @@
+import contextlib
+import fnmatch
+import hashlib
+import heapq
+import json
 import os
+import random
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import yaml
 from packaging import version
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from pathlib import Path
 import click
 
+from mipi_env_manager.bundles import Bundles
+from mipi_env_manager.conda import CHANNEL_DIR, CondaSolver, ExplicitSpecs, LocalChannel, PackageFetcher
+from mipi_env_manager.constraints import CONSTRAINTS_FILE, Constraints, constraints_by_package, constraints_sha256
+from mipi_env_manager.config import (
+    Config,
+    EnvironmentIndex,
+    EnvironmentSpec,
+    MirrorSpec,
+    PackageSpec,
+    ResolutionSpec,
+    ScheduleSpec,
+    SetupSpec,
+    STATE_DIR,
+    canonical_package_name,
+    fingerprint_stream,
+    iter_environments,
+    normalise_repo_url,
+    read_setup,
+)
+from mipi_env_manager.config_files import (
+    ConfigFiles,
+    changed_environments,
+    fingerprint_record,
+    has_include,
+    previous_fingerprints,
+)
+from mipi_env_manager.history import PublishRecord, ResolutionHistory, format_table, history_path
+from mipi_env_manager.metrics import METRICS
+from mipi_env_manager.schedule import format_time, plan_schedule, start_boundary
+from mipi_env_manager.sinks import Artifact, DiskSink, FanOutSink, MemorySink, OutputSink
+from mipi_env_manager.spool import Spool
+from mipi_env_manager.sync import MANIFEST_FILE, SyncClient, format_results, load_manifest
+from mipi_env_manager.telemetry import TimingReport, format_rows, iter_records
+from mipi_env_manager.verify import (
+    VERIFIED_FILE,
+    SmokeInstaller,
+    VerificationError,
+    Verifier,
+    format_smoke_results,
+)
+from mipi_env_manager.webhook import ENV_WEBHOOK_SECRET, WebhookListener
+
 ENV_GHTOKEN = "GH_TOKEN"
 ENV_SETUP_PATH = "MIPI_DEVOPS_PATH"
 
@@ -32,25 +83,88 @@ class Setup(ABC):
     def get_config(self) -> dict:
         raise NotImplementedError  # pragma: no cover
 
+    def load_config(self, save_cache=True) -> Config:
+        """
+        The validated config. Override this to build it without going through one raw dict. `save_cache` is false
+        when nothing will be published, so a setup that caches what it parsed leaves its cache as it is
+        """
+        return Config.from_dict(self.get_config())
+
+    def get_setup_spec(self) -> SetupSpec:
+        return Config.from_dict(self.get_config()).setup
+
+    def iter_environments(self) -> Iterator[EnvironmentSpec]:
+        """
+        Yield the environments one at a time. Override this to avoid holding the whole config in memory.
+        """
+        yield from Config.from_dict(self.get_config()).environments.values()
+
+    def get_fingerprint(self) -> str:
+        return Config.from_dict(self.get_config()).fingerprint
+
 
 class YmlSetup(Setup):
     """
-    A yaml file used to determine the environments, dependencies and environment variables.
+    A yaml file used to determine the environments, dependencies and environment variables. The path may also be a
+    folder of yaml files, or a file that `include:`s others, see `ConfigFiles`.
     """
 
     def __init__(self, environ_path_name):
         self.environ_path_name = environ_path_name
+        # path -> whether the config there is split across files, checked once per path
+        self._split: Dict[str, bool] = {}
 
     def _get_path(self) -> Path:
         path = get_environ(self.environ_path_name)
         return Path(path)
 
+    def _get_files(self) -> ConfigFiles:
+        """
+        The config's files when it is split across several, otherwise None, in which case everything goes through
+        get_config. A missing path is left for get_config to report
+        """
+        path = os.environ.get(self.environ_path_name)
+        if path is None or not os.path.exists(path):
+            return None
+        if path not in self._split:
+            self._split[path] = os.path.isdir(path) or has_include(path)
+        return ConfigFiles(path) if self._split[path] else None
+
     def get_config(self) -> dict:
+        files = self._get_files()
+        if files is not None:
+            return files.raw()
         path = self._get_path()
         with open(path, "r") as f:
             content = yaml.safe_load(f)
         return content
 
+    def load_config(self, save_cache=True) -> Config:
+        files = self._get_files()
+        return super().load_config() if files is None else files.load(save_cache=save_cache)
+
+    def get_setup_spec(self) -> SetupSpec:
+        files = self._get_files()
+        if files is not None:
+            return files.setup_spec()
+        with open(self._get_path(), "rb") as f:
+            return read_setup(f)
+
+    def iter_environments(self) -> Iterator[EnvironmentSpec]:
+        files = self._get_files()
+        if files is not None:
+            yield from files.iter_environments()
+            return
+        with open(self._get_path(), "rb") as f:
+            yield from iter_environments(f)
+
+    def get_fingerprint(self) -> str:
+        files = self._get_files()
+        if files is not None:
+            return files.fingerprint()
+        with open(self._get_path(), "rb") as f:
+            return fingerprint_stream(f)
+
 
 class Auth(ABC):
     """
@@ -84,6 +198,12 @@ class GHPatAuth(Auth):
         }
 
 
+class ResolutionDeadlineExceeded(TimeoutError):
+    """
+    The deadline for the whole resolution phase of a publish run has passed
+    """
+
+
 class RepoRequest(ABC):
     """
     Request the repo releases from a repository. This is needed because when downloading a package from Github you
@@ -109,26 +229,240 @@ class GHRequest(RepoRequest):
     base_url = "https://api.github.com/repos"
     url_suffix = "releases"
 
-    def __init__(self, user_name: str, repo_name: str, auth: Auth):
+    def __init__(self, user_name: str, repo_name: str, auth: Auth, settings: ResolutionSpec = None, deadline=None):
         self.user_name = user_name
         self.repo_name = repo_name
         self.auth = auth
+        self.settings = settings or ResolutionSpec()
+        self.deadline = deadline  # time.monotonic() by which all resolution must finish
 
     @property
     def url(self):
         return f"{self.base_url}/{self.user_name}/{self.repo_name}/{self.url_suffix}"
 
+    def _remaining(self):
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise ResolutionDeadlineExceeded(f"resolution deadline passed before fetching {self.url}")
+        return remaining
+
+    def _timeout(self):
+        connect, read = self.settings.connect_timeout, self.settings.read_timeout
+        remaining = self._remaining()
+        if remaining is not None:
+            connect, read = min(connect, remaining), min(read, remaining)
+        return connect, read
+
+    def _backoff(self, attempt):
+        """
+        Sleep before the next attempt, using exponential backoff with full jitter
+        """
+        delay = random.uniform(0, min(self.settings.max_backoff, self.settings.backoff * 2 ** attempt))
+        remaining = self._remaining()
+        if remaining is not None and delay >= remaining:
+            raise ResolutionDeadlineExceeded(f"resolution deadline passed while retrying {self.url}")
+        time.sleep(delay)
+
     def get_repo_releases(self) -> list:
         # Define the API endpoint for listing all releases
 
-        # Make the GET request to the GitHub API
-        response = requests.get(self.url, headers=self.auth.get_headers())
-        response.raise_for_status()  # raise an error for bad responses
+        # Make the GET request to the GitHub API, retrying server errors and connection failures
+        for attempt in range(self.settings.retries + 1):
+            last_attempt = attempt == self.settings.retries
+            timeout = self._timeout()
+            try:
+                response = requests.get(self.url, headers=self.auth.get_headers(), timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                METRICS.inc("github_requests_total", status="error")
+                # a timeout cut short by the deadline means the deadline passed, so the caller can fall back
+                cut_short = isinstance(e, requests.Timeout) and timeout != (self.settings.connect_timeout,
+                                                                            self.settings.read_timeout)
+                if cut_short or (self.deadline is not None and time.monotonic() >= self.deadline):
+                    raise ResolutionDeadlineExceeded(f"resolution deadline passed while fetching {self.url}") from e
+                if last_attempt:
+                    raise
+            else:
+                METRICS.inc("github_requests_total", status=response.status_code)
+                METRICS.inc("github_bytes_downloaded_total", len(response.content))
+                if response.status_code < 500 or last_attempt:
+                    response.raise_for_status()  # raise an error for bad responses
+                    # Parse the JSON response (list of releases)
+                    return response.json()
+            self._backoff(attempt)
+
+
+class GitMirrorRequest(RepoRequest):
+    """
+    Lists the tags of a repository from a local bare git mirror, in the same shape as the GitHub releases API so
+    that GHTagReleases can choose between them. Runs at local disk speed and is not subject to API rate limits.
+    """
+
+    def __init__(self, mirror_path):
+        self.mirror_path = mirror_path
+
+    @property
+    def url(self):
+        return self.mirror_path
+
+    def get_repo_releases(self) -> list:
+        result = subprocess.run(["git", "--git-dir", self.mirror_path, "for-each-ref", "--format=%(refname:short)",
+                                 "refs/tags"], capture_output=True, text=True, check=True)
+        METRICS.inc("mirror_lookups_total")
+        return [{"tag_name": tag} for tag in result.stdout.split()]
+
+
+def refresh_mirrors(paths, workers=8, timeout=120.0) -> dict:
+    """
+    Fetch every mirror from its origin in parallel. Returns the error for each mirror that failed to refresh; those
+    mirrors are still used, with the tags they already have.
+    """
+    def fetch(path):
+        try:
+            subprocess.run(["git", "--git-dir", path, "fetch", "--prune", "--tags", "origin"], capture_output=True,
+                           text=True, check=True, timeout=timeout)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            METRICS.inc("mirror_fetches_total", status="error")
+            return path, (getattr(e, "stderr", None) or str(e)).strip()
+        METRICS.inc("mirror_fetches_total", status="ok")
+        return path, None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        errors = {path: error for path, error in pool.map(fetch, paths) if error is not None}
+    for path, error in errors.items():
+        print(f"warning: could not refresh mirror {path}, using the tags it already has: {error}")
+    return errors
+
+
+def resolved_state_name(shard=None) -> str:
+    """
+    The file a publish records its resolved versions in. A shard writes its own, so shards running at the same time
+    never read, change and rewrite the same file
+    """
+    if shard is None:
+        return "last_resolved.json"
+    return f"last_resolved.shard-{shard[0]}-of-{shard[1]}.json"
+
+
+class ReleaseResolver:
+    """
+    Fetches the releases of each repository at most once. A single resolver is shared by a publish run so that a
+    package used by several environments, or by both the test and prod installers, costs one request.
 
-        # Parse the JSON response (list of releases)
-        releases = response.json()
+    The resolver also enforces the deadline for the whole resolution phase, and remembers the version each package
+    resolved to in `state_path`, so that later runs can fall back to it when the deadline is hit.
+    """
+
+    def __init__(self, auth: Auth = None, settings: ResolutionSpec = None, state_path=None,
+                 mirrors: MirrorSpec = None, sink: OutputSink = None):
+        self.auth = auth
+        self.settings = settings or ResolutionSpec()
+        self.state_path = state_path
+        self.sink = sink or DiskSink(quiet=True)
+        self.mirrors = mirrors or MirrorSpec()
+        self._cache = {}
+        self._deadline = None
+        self._last_resolved = {}
+        for path in self._state_paths():
+            self._last_resolved.update(self._load_state(path))
+        self._resolved = {}
+
+    def _state_paths(self) -> List[str]:
+        """
+        The state files to fall back on: those of other runs next to `state_path`, then this run's own. Each shard
+        keeps its own file, so concurrent shards never overwrite each other's entries
+        """
+        if self.state_path is None:
+            return []
+        directory, name = os.path.split(self.state_path)
+        prefix = name.split(".")[0]
+        try:
+            others = sorted(n for n in os.listdir(directory) if n.startswith(prefix) and n.endswith(".json"))
+        except FileNotFoundError:
+            others = []
+        return [os.path.join(directory, n) for n in others if n != name] + [self.state_path]
+
+    def _load_state(self, path) -> dict:
+        content = self.sink.read_text(path)
+        try:
+            return {} if content is None else json.loads(content)
+        except json.JSONDecodeError:
+            return {}
+
+    def _get_deadline(self):
+        if self.settings.deadline is None:
+            return None
+        if self._deadline is None:
+            # the clock starts with the first request of the run
+            self._deadline = time.monotonic() + self.settings.deadline
+        return self._deadline
+
+    def _get_request(self, user, repo) -> RepoRequest:
+        mirror_path = self.mirrors.path_for(user, repo)
+        if mirror_path is not None and os.path.isdir(mirror_path):
+            return GitMirrorRequest(mirror_path)
+        return GHRequest(user, repo, self.auth or GHPatAuth(ENV_GHTOKEN), self.settings, self._get_deadline())
+
+    def _mirror_paths(self) -> List[str]:
+        paths = [path for _, path in self.mirrors.repos]
+        if self.mirrors.root is not None and os.path.isdir(self.mirrors.root):
+            for user in sorted(os.listdir(self.mirrors.root)):
+                user_dir = os.path.join(self.mirrors.root, user)
+                if os.path.isdir(user_dir):
+                    paths += [os.path.join(user_dir, name) for name in sorted(os.listdir(user_dir))
+                              if name.endswith(".git")]
+        return [path for path in dict.fromkeys(paths) if os.path.isdir(path)]
+
+    def refresh_mirrors(self) -> dict:
+        """
+        Bring every configured mirror up to date in a single parallel pass, before any lookups are made
+        """
+        if not self.mirrors.refresh:
+            return {}
+        return refresh_mirrors(self._mirror_paths(), self.mirrors.workers, self.mirrors.fetch_timeout)
+
+    def get_releases(self, user, repo) -> list:
+        key = (user, repo)
+        if key in self._cache:
+            METRICS.inc("release_cache_hits_total")
+            return self._cache[key]
+
+        METRICS.inc("release_cache_misses_total")
+        start = time.perf_counter()
+        releases = self._get_request(user, repo).get_repo_releases()
+        METRICS.observe("resolution_seconds", time.perf_counter() - start, repo=f"{user}/{repo}")
+        self._cache[key] = releases
         return releases
 
+    @staticmethod
+    def _package_key(user, repo, version_str):
+        return f"{user}/{repo}@{version_str}"
+
+    def record_resolved(self, user, repo, version_str, resolved):
+        self._resolved[self._package_key(user, repo, version_str)] = str(resolved)
+
+    def fallback(self, user, repo, version_str, error: ResolutionDeadlineExceeded) -> str:
+        """
+        The version to use when the deadline has passed. Re-raises unless configured to fall back, and a previous
+        run resolved this package.
+        """
+        last_known = self._last_resolved.get(self._package_key(user, repo, version_str))
+        if self.settings.on_deadline != "last_known" or last_known is None:
+            raise error
+        METRICS.inc("resolution_fallbacks_total")
+        print(f"resolution deadline passed, using last resolved version {last_known} for {user}/{repo}")
+        return last_known
+
+    def save_state(self):
+        """
+        Merge the versions resolved by this run in to the state file
+        """
+        if self.state_path is None or not self._resolved:
+            return
+        state = {**self._load_state(self.state_path), **self._resolved}
+        self.sink.write_text(self.state_path, json.dumps(state, indent=2, sort_keys=True))
+
 
 class Releases(ABC):
     """
@@ -242,15 +576,14 @@ class GHVersion(Version):
              some_package`v1.0.0`
     """
 
-    def __init__(self, user, repo, policy, version_str=None):
+    def __init__(self, user, repo, policy, version_str=None, resolver: ReleaseResolver = None):
         super().__init__(policy, version_str)
         self.repo = repo
         self.user = user
+        self.resolver = resolver or ReleaseResolver()
 
     def _get_releases(self):
-        auth = GHPatAuth(ENV_GHTOKEN)
-        req = GHRequest(self.user, self.repo, auth)  # TODO abstract this
-        releases = req.get_repo_releases()
+        releases = self.resolver.get_releases(self.user, self.repo)
         return GHTagReleases(releases, self.version_str)
 
     def format(self):
@@ -260,8 +593,13 @@ class GHVersion(Version):
             if self.policy == "exact":
                 return f"v{self.version_str}"
             elif self.policy == "compatible":
-                rel_obj = self._get_releases()  # TODO Abstrac this
-                return f"v{rel_obj.get_latest_patch()}"
+                try:
+                    rel_obj = self._get_releases()  # TODO Abstrac this
+                except ResolutionDeadlineExceeded as e:
+                    return f"v{self.resolver.fallback(self.user, self.repo, self.version_str, e)}"
+                latest = rel_obj.get_latest_patch()
+                self.resolver.record_resolved(self.user, self.repo, self.version_str, latest)
+                return f"v{latest}"
 
 
 class ReqString:
@@ -304,8 +642,8 @@ class GHReqString(ReqString):
     def add_path(self, path):
         self._add_part(f" @ git+{path}.git")
 
-    def add_tag(self, user, repo, policy, version_str):
-        tag = GHVersion(user, repo, policy, version_str).build()
+    def add_tag(self, user, repo, policy, version_str, resolver: ReleaseResolver = None):
+        tag = GHVersion(user, repo, policy, version_str, resolver).build()
         self._add_part(f"@{tag}")
 
     def add_egg(self, name):
@@ -352,9 +690,10 @@ class GHReqStringCreator(ReqStringCreator):
              `requests @ git+https://github.com/psf/requests.git@v2.23.3#egg=request`
     """
 
-    def __init__(self, name, policy, path, version_str=None):
+    def __init__(self, name, policy, path, version_str=None, resolver: ReleaseResolver = None):
         super().__init__(GHReqString(), name, policy, version_str)
         self.path = path
+        self.resolver = resolver
 
     def parse_path(self) -> List[str]:
         truncated_path = self.path.removeprefix("https://github.com/")
@@ -365,7 +704,7 @@ class GHReqStringCreator(ReqStringCreator):
         self._req_string.add_path(self.path)
         user, repo = self.parse_path()
         if self.version_str:  # TODO maybe move this condition
-            self._req_string.add_tag(user, repo, self.policy, self.version_str)
+            self._req_string.add_tag(user, repo, self.policy, self.version_str, self.resolver)
         self._req_string.add_egg(self.name)
 
         return self._req_string.build()
@@ -376,8 +715,16 @@ class PkgFactory(ABC):
     Factory to call the package string builder.
     """
 
-    @abstractmethod
+    def __init__(self, resolver: ReleaseResolver = None):
+        self.resolver = resolver
+
     def create(self, name, vals):
+        if not isinstance(vals, PackageSpec):
+            vals = PackageSpec.from_dict(name, vals)
+        return self._create(vals)
+
+    @abstractmethod
+    def _create(self, pkg: PackageSpec):
         raise NotImplementedError  # pragma: no cover
 
 
@@ -386,8 +733,8 @@ class PypiPkgFactory(PkgFactory):
     Factory to call the pypi package string builder.
     """
 
-    def create(self, name, vals):
-        return PyPiReqStringCreator(name, vals.get("version_policy"), vals.get("version"))
+    def _create(self, pkg: PackageSpec):
+        return PyPiReqStringCreator(pkg.name, pkg.version_policy, pkg.version)
 
 
 class GHPkgFactory(PkgFactory):
@@ -395,8 +742,8 @@ class GHPkgFactory(PkgFactory):
     Factory to call the github package string builder.
     """
 
-    def create(self, name, vals):
-        return GHReqStringCreator(name, vals.get("version_policy"), vals.get("path"), vals.get("version"))
+    def _create(self, pkg: PackageSpec):
+        return GHReqStringCreator(pkg.name, pkg.version_policy, pkg.path, pkg.version, self.resolver)
 
 
 class Dependancies():
@@ -404,30 +751,265 @@ class Dependancies():
     Creates the contents of the requirments.txt file
     """
 
-    def __init__(self, config):
+    def __init__(self, config: EnvironmentSpec, resolver: ReleaseResolver = None):
         self.config = config
+        self.resolver = resolver
         self.dict_ = {
             "github": GHPkgFactory,
             "pypi": PypiPkgFactory
         }
 
     def _read_dependencies(self):
-        return self.config["packages"]
+        return self.config.packages
+
+    def iter_strings(self) -> Iterator[str]:
+        """
+        loop through each dependancy in the environment config and create the call the correct creator, yielding
+        each line as it is resolved
+        """
+        for pkg in self._read_dependencies():
+            factory = self.dict_[pkg.source](self.resolver)
+            yield factory.create(pkg.name, pkg).req_string()
 
     def create_strings(self):
+        return "\n".join(self.iter_strings())
+
+    def iter_pins(self) -> Iterator[str]:
+        """
+        The requirements as configured, for the constraints file. Github packages are given by url without looking up
+        their tag, so nothing is resolved
+        """
+        for pkg in self._read_dependencies():
+            if pkg.source == "github":
+                yield f"{pkg.name} @ git+{pkg.path}.git"
+            else:
+                yield PypiPkgFactory(self.resolver).create(pkg.name, pkg).req_string()
+
+    def write_requirments(self, write_path, sink: OutputSink = None, record: list = None) -> str:
+        """
+        write the requirements.txt file, returning the sha256 of its contents. Each line is also appended to `record`,
+        if given
         """
-        loop through each dependancy in the environment config and create the call the correct creator
+        def lines():
+            for line in self.iter_strings():
+                if record is not None:
+                    record.append(line)
+                yield line
+
+        return (sink or DiskSink()).write_lines(write_path, lines())
+
+
+STAMP_FILE = "stamp.txt"
+RECONCILE_SCRIPT = "reconcile.py"
+# the files outside its own folder that an environment's installers call, included in its bundle
+BUNDLE_SHARED_FILES = ("set_environ.bat", "environment_variables.txt", RECONCILE_SCRIPT)
+CONFIG_FINGERPRINTS = "config_files.json"
+
+
+def manifest_lines(entries: Iterable[Tuple[str, dict]]) -> Iterator[str]:
+    """
+    The lines of manifest.json from (folder, entry) pairs sorted by folder, one entry at a time. The same text as
+    `json.dumps({"environments": dict(entries)}, indent=2, sort_keys=True)` for the flat entries a publish writes.
+    Each field is dumped on its own, as dumping with an indent leaves garbage cycles behind for every entry
+    """
+    yield "{"
+    previous = None
+    for folder, entry in entries:
+        if previous is None:
+            yield '  "environments": {'
+        else:
+            yield previous + ","
+        fields = [f"      {json.dumps(key)}: {json.dumps(entry[key])}" for key in sorted(entry)]
+        if not fields:
+            previous = f"    {json.dumps(folder)}: {{}}"
+            continue
+        yield f"    {json.dumps(folder)}: {{"
+        yield from (field + "," for field in fields[:-1])
+        yield fields[-1]
+        previous = "    }"
+    if previous is None:
+        yield '  "environments": {}'
+    else:
+        yield previous
+        yield "  }"
+    yield "}"
+
+
+def write_manifest(outpath, published: Iterable[Tuple[str, dict]], sink: OutputSink,
+                   keep: Callable[[str], bool] = None):
+    """
+    Write manifest.json: each environment folder published, with its stamp, for the machines that sync from the
+    outpath. `published` are (folder, entry) pairs sorted by folder, written as they are read. The previous entries of
+    the folders `keep` is true for, published earlier but not built by this run, are carried over
+    """
+    path = os.path.join(outpath, MANIFEST_FILE)
+    carried = []
+    if keep is not None:
+        previous = load_manifest(sink.read_text(path))
+        carried = sorted(((folder, entry) for folder, entry in previous.items() if keep(folder)),
+                         key=lambda item: item[0])
+    sink.write_lines(path, manifest_lines(heapq.merge(carried, published, key=lambda item: item[0])))
+
+
+class PublishLedger(Spool):
+    """
+    What a publish remembers about each environment as it goes through them: its position, whether it is in the
+    master installers, and the manifest entry of each folder built. Spooled to disk, so a streamed publish does not
+    grow with the number of environments
+    """
+
+    def __init__(self):
+        super().__init__("""
+            CREATE TABLE environments (
+                position INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                in_master INTEGER NOT NULL,
+                built INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX environments_name ON environments (name);
+            CREATE TABLE published (folder TEXT PRIMARY KEY, entry TEXT NOT NULL);
+        """, prefix="mipi-publish-")
+
+    def add(self, position, name, in_master=False):
+        self.db.execute("INSERT INTO environments (position, name, in_master) VALUES (?, ?, ?)",
+                        (position, name, int(in_master)))
+
+    def built(self, position):
+        self.db.execute("UPDATE environments SET built = 1 WHERE position = ?", (position,))
+
+    def publish(self, folder, entry: dict):
+        self.db.execute("INSERT OR REPLACE INTO published (folder, entry) VALUES (?, ?)", (folder, json.dumps(entry)))
+
+    def count(self, built=False) -> int:
+        return self.db.execute("SELECT count(*) FROM environments" + (" WHERE built" if built else "")).fetchone()[0]
+
+    def names(self, built=False) -> Iterator[str]:
+        for (name,) in self.db.execute("SELECT name FROM environments" + (" WHERE built" if built else "") +
+                                       " ORDER BY position"):
+            yield name
+
+    def master_installers(self) -> Iterator[Tuple[int, str]]:
+        yield from self.db.execute("SELECT position, name FROM environments WHERE in_master ORDER BY position")
+
+    def entries(self) -> Iterator[Tuple[str, dict]]:
+        """
+        The manifest entries of the folders built, sorted by folder
+        """
+        for folder, entry in self.db.execute("SELECT folder, entry FROM published ORDER BY folder"):
+            yield folder, json.loads(entry)
+
+    def all_published(self) -> bool:
+        """
+        Whether both folders of every environment were built, so no earlier manifest entry is carried over
+        """
+        return self.db.execute("SELECT count(*) FROM published").fetchone()[0] == 2 * self.count()
+
+    def carries_over(self, folder) -> bool:
         """
-        dependencies = []
-        for k, v in self._read_dependencies().items():
-            pkg = self.dict_[v["source"]]()
-            dependencies.append(pkg.create(k, v).req_string())
-        return "\n".join(dependencies)
+        Whether a folder belongs to an environment in the config but was not built by this publish
+        """
+        name = folder[:-len("_test")] if folder.endswith("_test") else None
+        in_config = self.db.execute("SELECT 1 FROM environments WHERE name IN (?, ?) LIMIT 1",
+                                    (folder, name)).fetchone()
+        built = self.db.execute("SELECT 1 FROM published WHERE folder = ?", (folder,)).fetchone()
+        return in_config is not None and built is None
+
+    def folders(self) -> Iterator[str]:
+        for name in self.names():
+            yield name
+            yield f"{name}_test"
+
+
+def generation_stamp(py_version, requirements_sha256, installer="pip", constraints_sha256=None) -> str:
+    """
+    A stamp of everything an installed environment depends on: its python, its requirements.txt, the installer backend
+    and the constraints of its packages in the constraints.txt it installs with, if any. `update_env.bat` exits
+    straight away when the stamp it recorded at the last successful install matches the published one.
+    """
+    content = f"py_version={py_version}\nrequirements={requirements_sha256}\ninstaller={installer}"
+    if constraints_sha256 is not None:
+        content += f"\nconstraints={constraints_sha256}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class InstallerBackend(ABC):
+    """
+    The commands an environment installer uses to install requirements.txt in to the activated environment
+    """
+    name = None
+
+    @abstractmethod
+    def install_commands(self, env_name, create_env, constraints=None) -> List[str]:
+        """
+        Commands run in order from the environment's folder. The installer stops at the first one that fails.
+        `constraints` is the path of a constraints file relative to that folder
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    @staticmethod
+    def _constraints_option(constraints) -> str:
+        return f' -c "{constraints}"' if constraints else ""
 
-    def write_requirments(self, write_path):
-        reqs = self.create_strings()
-        with open(write_path, "w") as f:
-            f.write(reqs)
+    def list_command(self) -> str:
+        return "python -m pip list"
+
+
+class PipInstaller(InstallerBackend):
+    """
+    Install with pip. A new environment force reinstalls everything
+    """
+    name = "pip"
+
+    def install_commands(self, env_name, create_env, constraints=None) -> List[str]:
+        force = " --force-reinstall" if create_env else ""
+        return [f"python -m pip install --upgrade -r requirements.txt{self._constraints_option(constraints)}{force}"]
+
+
+class UvInstaller(InstallerBackend):
+    """
+    Install with `uv pip`, which resolves and installs in parallel. uv is installed in to the environment with pip the
+    first time it is needed
+    """
+    name = "uv"
+    uv = 'python -m uv pip {} --python "%CONDA_PREFIX%\\python.exe"'
+
+    def _ensure_uv(self) -> str:
+        return "python -m uv --version >nul 2>&1 || python -m pip install uv"
+
+    def install_commands(self, env_name, create_env, constraints=None) -> List[str]:
+        reinstall = " --reinstall" if create_env else ""
+        return [self._ensure_uv(), f"{self.uv.format('install')} --upgrade -r requirements.txt"
+                                   f"{self._constraints_option(constraints)}{reinstall}"]
+
+    def list_command(self) -> str:
+        return self.uv.format("list")
+
+
+class UvSyncInstaller(UvInstaller):
+    """
+    Make the environment exactly match requirements.txt with `uv pip sync`, removing anything not required. sync does
+    not resolve dependencies, so requirements.txt is compiled to a full lock first. pip and uv are kept in the lock so
+    the installer can keep using them
+    """
+    name = "uv-sync"
+
+    def install_commands(self, env_name, create_env, constraints=None) -> List[str]:
+        lock = f'"%TEMP%\\mipi_{env_name}_lock.txt"'
+        return [self._ensure_uv(),
+                f"(type requirements.txt & echo. & echo pip& echo uv) | {self.uv.format('compile')} - --quiet "
+                f"-o {lock}{self._constraints_option(constraints)}",
+                f"{self.uv.format('sync')} {lock}"]
+
+
+INSTALLER_BACKENDS = {backend.name: backend for backend in (PipInstaller, UvInstaller, UvSyncInstaller)}
+
+
+def get_installer(name=None) -> InstallerBackend:
+    return INSTALLER_BACKENDS[name or "pip"]()
+
+
+# one jinja environment for every Bat, so each template is compiled once a run and not once per file written
+TEMPLATES = Environment(loader=FileSystemLoader(Path(__file__).parent / "templates"), autoescape=select_autoescape())
 
 
 class Bat(ABC):
@@ -435,23 +1017,23 @@ class Bat(ABC):
     Create a batch file from a jinja template
     """
 
-    def __init__(self, template, out_path):
+    def __init__(self, template, out_path, sink: OutputSink = None):
         self.template = template
         self.out_path = out_path
+        self.sink = sink or DiskSink()
 
     def _get_template(self):
-        env = Environment(loader=FileSystemLoader(Path(__file__).parent / "templates"), autoescape=select_autoescape())
-        return env.get_template(self.template)
+        return TEMPLATES.get_template(self.template)
 
     def _render_template(self, **kwargs):
+        start = time.perf_counter()
         temp = self._get_template()
         content = temp.render(**kwargs)
+        METRICS.observe("render_seconds", time.perf_counter() - start, template=self.template)
         return content
 
     def _save_file(self, content):
-        with open(self.out_path, "w") as f:
-            f.write(content)
-        print(f"file written to: {self.out_path}")
+        self.sink.write_text(self.out_path, content)
 
     @abstractmethod
     def extend_jinja_kwargs(self, **kwargs):
@@ -474,71 +1056,106 @@ class Bat(ABC):
 
 class SetEnvironBat(Bat):
     """
-    Create an batch file that runs other environment installer batch files
+    Create a batch file that applies the environment variables. The variables are written once to a manifest, and the
+    batch file only sets the ones whose value differs from the machine's, at most once per install session.
     """
-    def __init__(self, out_path):
+    manifest_name = "environment_variables.txt"
+
+    def __init__(self, out_path, sink: OutputSink = None):
         write_path = os.path.join(out_path, "set_environ.bat")
-        super().__init__("set_environ.bat.jinja", write_path)
+        self.manifest_path = os.path.join(out_path, self.manifest_name)
+        super().__init__("set_environ.bat.jinja", write_path, sink)
 
     def extend_jinja_kwargs(self, **kwargs):
+        environment_variables = kwargs.pop("environment_variables", {})
+        lines = [f"{k}={v}" for k, v in environment_variables.items()]
+        kwargs.update({"manifest_name": self.manifest_name,
+                       "manifest_sha256": self.sink.write_lines(self.manifest_path, lines)})
         return kwargs
 
+class ReconcileScript(Bat):
+    """
+    Create the python script create_env.bat runs to uninstall packages that a reused environment no longer requires
+    """
+
+    def __init__(self, out_path, sink: OutputSink = None):
+        super().__init__("reconcile.py.jinja", os.path.join(out_path, RECONCILE_SCRIPT), sink)
+
+    def extend_jinja_kwargs(self, **kwargs):
+        return kwargs
+
+
 class EnvBat(Bat):
     """
     Create an environment installer batch file
     """
 
-    def __init__(self, out_path, env_name, file_name):
+    def __init__(self, out_path, env_name, file_name, sink: OutputSink = None):
         template = "env_installer.bat.jinja"
         self.env_name = env_name
-        subdir_path = os.path.join(out_path, env_name)
-        self._maybe_create_subdir(subdir_path)
-        save_path = os.path.join(subdir_path, file_name)
-        super().__init__(template, save_path)
+        save_path = os.path.join(out_path, env_name, file_name)
+        super().__init__(template, save_path, sink)
 
-    def _maybe_create_subdir(self, save_path):
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
+    def _installer_kwargs(self, kwargs, create_env) -> dict:
+        """
+        Replace the `installer` name with the commands of its backend, pip if not given, installing with the
+        `constraints` file if given
+        """
+        installer = get_installer(kwargs.pop("installer", None))
+        constraints = kwargs.pop("constraints", None)
+        kwargs.update({"create_env": create_env,
+                       "install_commands": installer.install_commands(self.env_name, create_env, constraints),
+                       "list_command": installer.list_command()})
+        if create_env:
+            # an existing environment with the same python is reconciled in place, the way an update installs
+            kwargs.update({"reconcile_commands": installer.install_commands(self.env_name, False, constraints),
+                           "reconcile_script": RECONCILE_SCRIPT})
+        return kwargs
 
 
 class CreateEnvBat(EnvBat):
     """
     Create an environment installer batch file that creates a totally new environment
     """
-    def __init__(self, out_path, env_name):
-        super().__init__(out_path, env_name, "create_env.bat")
+    def __init__(self, out_path, env_name, sink: OutputSink = None):
+        super().__init__(out_path, env_name, "create_env.bat", sink)
 
     def extend_jinja_kwargs(self, **kwargs):
-        kwargs.update({"create_env": True})
-        return kwargs
+        return self._installer_kwargs(kwargs, create_env=True)
 
 
 class UpdateEnvBat(EnvBat):
     """
     Create an environment installer batch file that updates an existing environment
     """
-    def __init__(self, out_path, env_name):
-        super().__init__(out_path, env_name, "update_env.bat")
+    def __init__(self, out_path, env_name, sink: OutputSink = None):
+        super().__init__(out_path, env_name, "update_env.bat", sink)
 
     def extend_jinja_kwargs(self, **kwargs):
-        kwargs.update({"create_env": False})
-        return kwargs
+        return self._installer_kwargs(kwargs, create_env=False)
 
 class MasterEnvsBat(Bat):
     """
     Create an batch file that runs other environment installer batch files
     """
-    def __init__(self, out_path,file_name):
+    def __init__(self, out_path, file_name, sink: OutputSink = None):
         write_path = os.path.join(out_path, file_name)
-        super().__init__("master_installer.bat.jinja", write_path)
+        super().__init__("master_installer.bat.jinja", write_path, sink)
+
+    def create(self, **kwargs):
+        # a master installer calls every environment, so it is streamed to the sink as it renders
+        kwargs = self.extend_jinja_kwargs(**kwargs)
+        start = time.perf_counter()
+        self.sink.write_chunks(self.out_path, self._get_template().generate(**kwargs))
+        METRICS.observe("render_seconds", time.perf_counter() - start, template=self.template)
 
 
 class MasterUpdateEnvsBat(MasterEnvsBat):
     """
     Create an batch file that runs other batch files which each CREATE a new environment
     """
-    def __init__(self, out_path):
-        super().__init__(out_path, "master_update_envs.bat")
+    def __init__(self, out_path, sink: OutputSink = None):
+        super().__init__(out_path, "master_update_envs.bat", sink)
 
     def extend_jinja_kwargs(self, **kwargs):
         kwargs.update({"create_envs": False})
@@ -550,13 +1167,13 @@ class MasterUpdateEnvsBatTest(MasterEnvsBat):
     Create an batch file that runs other batch files which each CREATE a new environment
     """
 
-    def __init__(self, out_path):
-        super().__init__(out_path, "master_update_envs_test.bat")
+    def __init__(self, out_path, sink: OutputSink = None):
+        super().__init__(out_path, "master_update_envs_test.bat", sink)
 
     def extend_jinja_kwargs(self, **kwargs):
 
         _installers = kwargs.get("installers", [])
-        _test_installers =  [f"{e}_test" for e in _installers]
+        _test_installers =  (f"{e}_test" for e in _installers)
 
         kwargs.update({"create_envs": False,
                        "installers": _test_installers})
@@ -567,13 +1184,13 @@ class MasterCreateEnvsBatTest(MasterEnvsBat):
     Create an batch file that runs other batch files which each CREATE a new environment
     """
 
-    def __init__(self, out_path):
-        super().__init__(out_path, "master_create_envs_test.bat")
+    def __init__(self, out_path, sink: OutputSink = None):
+        super().__init__(out_path, "master_create_envs_test.bat", sink)
 
     def extend_jinja_kwargs(self, **kwargs):
 
         _installers = kwargs.get("installers", [])
-        _test_installers =  [f"{e}_test" for e in _installers]
+        _test_installers =  (f"{e}_test" for e in _installers)
 
         kwargs.update({"create_envs": True,
                        "installers": _test_installers})
@@ -584,90 +1201,797 @@ class MasterCreateEnvsBat(MasterEnvsBat):
     Create an batch file that runs other batch files which each CREATE a new environment
     """
 
-    def __init__(self, out_path):
-        super().__init__(out_path, "master_create_envs.bat")
+    def __init__(self, out_path, sink: OutputSink = None):
+        super().__init__(out_path, "master_create_envs.bat", sink)
 
     def extend_jinja_kwargs(self, **kwargs):
         kwargs.update({"create_envs": True})
         return kwargs
 
 
+def create_masters(outpath, variants, installers: Callable[[], Iterable[str]], sink: OutputSink = None):
+    """
+    Write the master create/update installers for each variant ("prod"/"test") that was built. `installers` gives the
+    installer folders in master order, afresh for each master installer
+    """
+    masters_to_create = set()
+    if "test" in variants:
+        masters_to_create.update({MasterCreateEnvsBatTest(outpath, sink), MasterUpdateEnvsBatTest(outpath, sink)})
+    if "prod" in variants:
+        masters_to_create.update({MasterCreateEnvsBat(outpath, sink), MasterUpdateEnvsBat(outpath, sink)})
+
+    for m in masters_to_create:
+        m.create(installers=installers())
+
+
+SCHEDULE_DIR = "schedules"
+
+
+class ScheduleTaskXml(Bat):
+    """
+    Create a Task Scheduler task definition that runs a master installer for one host or group
+    """
+
+    def __init__(self, out_path, unit, action, sink: OutputSink = None):
+        self.action = action
+        write_path = os.path.join(out_path, SCHEDULE_DIR, f"{unit}-{action}.xml")
+        super().__init__("schedule_task.xml.jinja", write_path, sink)
+
+    def extend_jinja_kwargs(self, **kwargs):
+        kwargs.update({"description": f"MiPi scheduled {self.action} of the conda environments"})
+        return kwargs
+
+
+class RegisterScheduleBat(Bat):
+    """
+    Create a batch file that registers the scheduled tasks of the machine it is run on
+    """
+    hosts_file = "hosts.txt"
+
+    def __init__(self, out_path, sink: OutputSink = None):
+        super().__init__("register_schedule.bat.jinja", os.path.join(out_path, SCHEDULE_DIR, "register_schedule.bat"),
+                         sink)
+
+    def extend_jinja_kwargs(self, **kwargs):
+        kwargs.update({"hosts_file": self.hosts_file, "task_folder": "mipi"})
+        return kwargs
+
+
+def create_schedules(outpath, spec: ScheduleSpec, sink: OutputSink = None):
+    """
+    Write each host's or group's staggered update and create tasks, the host -> schedule lookup and a manifest of
+    every start time
+    """
+    sink = sink or DiskSink()
+    suffix = "_test" if spec.variant == "test" else ""
+    update_installer = os.path.join(outpath, f"master_update_envs{suffix}.bat")
+    create_installer = os.path.join(outpath, f"master_create_envs{suffix}.bat")
+
+    plan = plan_schedule(spec)
+    for unit in plan:
+        ScheduleTaskXml(outpath, unit.unit, "update", sink).create(
+            start_boundary=start_boundary(unit.update_time), installer=update_installer, days=())
+        ScheduleTaskXml(outpath, unit.unit, "create", sink).create(
+            start_boundary=start_boundary(unit.create_time), installer=create_installer, days=spec.create_days)
+
+    schedule_dir = os.path.join(outpath, SCHEDULE_DIR)
+    sink.write_lines(os.path.join(schedule_dir, RegisterScheduleBat.hosts_file),
+                     (f"{host} {unit.unit}" for unit in plan for host in unit.hosts))
+    manifest = {host: {"schedule": unit.unit, "update": format_time(unit.update_time),
+                       "create": format_time(unit.create_time), "create_days": list(spec.create_days)}
+                for unit in plan for host in unit.hosts}
+    sink.write_text(os.path.join(schedule_dir, "schedule.json"), json.dumps(manifest, indent=2, sort_keys=True))
+    RegisterScheduleBat(outpath, sink).create()
+
+
+def parse_shard(value) -> tuple:
+    """
+    Parse a `i/n` shard specifier, where shards are numbered 1..n
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError(f"shard must be in the form i/n, got '{value}'")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"shard index must be between 1 and {count}, got '{value}'")
+    return index, count
+
+
+def env_in_shard(env_name, index, count) -> bool:
+    """
+    Deterministically assign an environment to a shard. Uses a stable hash so every host agrees on the partition.
+    """
+    digest = hashlib.sha1(env_name.encode("utf-8")).hexdigest()
+    return int(digest, 16) % count == index - 1
+
+
+class ShardManifest:
+    """
+    The record a shard leaves in the outpath, describing what it published, so that a final merge step can build
+    the master installers and set_environ.bat without re-running any shard.
+    """
+
+    dir_name = ".shards"
+
+    def __init__(self, outpath, index, count):
+        self.outpath = outpath
+        self.index = index
+        self.count = count
+
+    @property
+    def path(self):
+        return os.path.join(self.outpath, self.dir_name, f"shard-{self.index}-of-{self.count}.json")
+
+    def write(self, data: dict, sink: OutputSink = None):
+        (sink or DiskSink()).write_text(self.path, json.dumps({"shard": self.index, "count": self.count, **data},
+                                                              indent=2))
+
+    @classmethod
+    def load_all(cls, outpath) -> List[dict]:
+        shard_dir = os.path.join(outpath, cls.dir_name)
+        if not os.path.isdir(shard_dir):
+            return []
+        manifests = []
+        for name in sorted(os.listdir(shard_dir)):
+            if name.endswith(".json"):
+                with open(os.path.join(shard_dir, name), "r") as f:
+                    manifests.append(json.load(f))
+        return manifests
+
+
+def default_sink(outpaths, staged=False, keep_artifacts=True) -> OutputSink:
+    """
+    Write straight to disk, or render once and fan out when the setup lists several outpaths or the publish must be
+    `staged`, held back until it is verified. Only fanning out needs `artifacts` kept
+    """
+    if len(outpaths) > 1 or staged:
+        return FanOutSink(outpaths)
+    return DiskSink(keep_artifacts=keep_artifacts)
+
+
+def create_target_files(sink: OutputSink, variants, installers: Callable[[], Iterable[str]],
+                        schedule: ScheduleSpec = None):
+    """
+    Write the files that embed their target's own path: the master installers, which call each environment's
+    installer by its full path, and the schedules. `installers` gives the environment folder names, in master order
+    """
+    for target in sink.targets:
+        with sink.only(target):
+            create_masters(target, variants, lambda: (os.path.join(target, name) for name in installers()), sink)
+            if schedule is not None and schedule.enabled:
+                create_schedules(target, schedule, sink)
+
+
+def merge_shards(outpath, count=None, schedule: ScheduleSpec = None, outpaths=(),
+                 package_fetcher: PackageFetcher = None):
+    """
+    Assemble the master installers and set_environ.bat from the manifests written by every shard, and add the conda
+    packages they solved to the local channel. The manifests are read from `outpath`, and the files written to every
+    one of `outpaths`, if given
+    """
+    manifests = ShardManifest.load_all(outpath)
+    if count is None:
+        counts = {m["count"] for m in manifests}
+        if len(counts) != 1:
+            raise ValueError(f"expected shard manifests for exactly one shard count in {outpath}, found {sorted(counts)}")
+        count = counts.pop()
+    manifests = [m for m in manifests if m["count"] == count]
+
+    missing = set(range(1, count + 1)) - {m["shard"] for m in manifests}
+    if missing:
+        raise ValueError(f"missing manifests for shards {sorted(missing)} of {count}")
+    if len({m["config_sha256"] for m in manifests}) != 1:
+        raise ValueError("shards were published from different configs")
+
+    installers = sorted((position, path) for m in manifests for position, path in m["master_installers"])
+    variants = {v for m in manifests for v in m["master_variants"]}
+    published = {folder: entry for m in manifests for folder, entry in m.get("published", {}).items()}
+    environment_variables = manifests[0]["environment_variables"]
+    # every shard renders the same constraints from the whole config
+    constraint_lines = manifests[0].get("constraints")
+    channels = [m["conda_channel"] for m in manifests if m.get("conda_channel")]
+    # the channel is pruned to the shards' solves only if between them they built every environment
+    prune_channel = bool(channels) and len(channels) == len(manifests) and all(c.get("complete") for c in channels)
+
+    sink = default_sink(outpaths)
+    root = sink.begin(outpath)
+    try:
+        create_target_files(sink, variants, lambda: (os.path.relpath(path, outpath) for _, path in installers),
+                            schedule)
+        SetEnvironBat(root, sink).create(environment_variables=environment_variables)
+        ReconcileScript(root, sink).create()
+        if constraint_lines is not None:
+            sink.write_lines(os.path.join(root, CONSTRAINTS_FILE), constraint_lines)
+        if channels:
+            LocalChannel(root, sink, channels[0]["subdir"], package_fetcher).add(
+                [record for channel in channels for record in channel["records"]], prune=prune_channel)
+        write_manifest(root, sorted(published.items()), sink)
+        sink.commit()
+    finally:
+        sink.close()
+    return sink.statuses
+
+
+class EnvSelector:
+    """
+    Which environments a publish builds: those whose name matches any of the `envs` glob patterns, or that reference
+    any of the `packages` or `repos`. Everything when nothing is given. Each environment is matched on its own
+    packages, so nothing is kept across a streamed publish.
+    """
+
+    def __init__(self, envs=(), packages=(), repos=()):
+        self.envs = (envs,) if isinstance(envs, str) else tuple(envs or ())
+        self.packages = tuple(packages or ())
+        self.repos = tuple(repos or ())
+        # compared the way EnvironmentIndex compares them
+        self._package_names = {canonical_package_name(name) for name in self.packages}
+        self._repo_urls = {normalise_repo_url(url).lower() for url in self.repos}
+
+    @property
+    def selects_all(self) -> bool:
+        return not (self.envs or self.packages or self.repos)
+
+    def matches(self, env: EnvironmentSpec) -> bool:
+        if self.selects_all:
+            return True
+        if any(fnmatch.fnmatchcase(env.name, pattern) for pattern in self.envs):
+            return True
+        return any(canonical_package_name(pkg.name) in self._package_names
+                   or (pkg.path is not None and normalise_repo_url(pkg.path).lower() in self._repo_urls)
+                   for pkg in env.packages)
+
+
 class PublishInstallers:
     """
     Builds all batch installers and writes them to the computers file system
     """
 
-    def __init__(self, setup: Setup, test, prod, master, envs = None):
+    def __init__(self, setup: Setup, test, prod, master, envs = None, metrics_textfile=None, metrics_json=None,
+                 shard=None, stream=False, conda_solver: CondaSolver = None, sink: OutputSink = None,
+                 packages=(), repos=(), changed_only=False, bundles=False, record_history=False,
+                 package_fetcher: PackageFetcher = None, verify=True, smoke_installer: SmokeInstaller = None):
+        if changed_only and stream:
+            raise ValueError("changed_only needs the whole config loaded, it cannot be used when streaming")
+        if bundles and shard is not None:
+            raise ValueError("bundles include set_environ.bat, so they are not built by a shard")
         self.setup = setup
-        self.config = self.get_config()  # TODO i dont like having function calls in the init
+        self.changed_only = changed_only
+        self.bundles = bundles
+        self.record_history = record_history
+        self.conda_solver = conda_solver
+        self.package_fetcher = package_fetcher
+        # smoke install what was built before publishing it, when the setup enables it
+        self.verify = verify
+        self.smoke_installer = smoke_installer
+        # without a sink, one is picked for the setup's outpaths when publishing
+        self.sink = sink
+        self.stream = stream
+        # when streaming, environments are read from the setup file one at a time during publish
+        self.config = None if stream else self.get_config()  # TODO i dont like having function calls in the init
         self.test = test
         self.prod = prod
         self.master = master
         self.envs = envs
+        self.selector = EnvSelector(envs, packages, repos)
+        self.metrics_textfile = metrics_textfile
+        self.metrics_json = metrics_json
+        self.shard = shard
 
-    def get_config(self):
-        return self.setup.get_config()
+    def get_config(self) -> Config:
+        # a preview, or a publish in to an archive, leaves the config cache in the outpath alone
+        return self.setup.load_config(save_cache=self.sink is None or self.sink.on_disk)
 
-    def publish(self):
-        outpath =  self.config["setup"]["outpath"]
-        envs_master = self.config["environments"]
+    def _get_fingerprint(self) -> str:
+        return self.setup.get_fingerprint() if self.stream else self.config.fingerprint
 
-        # setup envs to include for single installers. User defined
-        if self.envs is not None:
-            envs_to_build = {env:vals for env, vals in envs_master.items() if env == self.envs}
-        else:
-            envs_to_build = envs_master
+    def publish(self) -> Dict[str, Artifact]:
+        """
+        Publish every artifact to the sink, returning them keyed by their path relative to the outpath. A streamed
+        publish straight to disk does not keep them, unless bundles are built from them
+        """
+        METRICS.reset()
+        setup = self.setup.get_setup_spec() if self.stream else self.config.setup
+        if self.sink is None:
+            self.sink = default_sink(setup.outpaths, staged=self.verify and setup.verify.enabled,
+                                     keep_artifacts=not self.stream or self.bundles)
+        status = "failed"
+        try:
+            environments = self.setup.iter_environments if self.stream else self.config.environments.values
+            with self._recording(setup) as history, PublishLedger() as ledger:
+                self._publish(setup, environments, ledger, history)
+            self.sink.commit()
+            status = "success"
+        finally:
+            self.sink.close()
+            # a failed publish is exported too, so it can be alerted on
+            self._export_metrics(status)
+        return self.sink.artifacts
+
+    @contextlib.contextmanager
+    def _recording(self, setup: SetupSpec) -> Iterator[Optional[PublishRecord]]:
+        """
+        The resolution history's record of this publish, written once everything is built and not at all if the
+        publish fails. None when the history is not recorded
+        """
+        if not self.record_history:
+            yield None
+            return
+        with ResolutionHistory(history_path(setup)) as history, \
+                history.publishing(self._get_fingerprint()) as record:
+            yield record
+
+    def _publish(self, setup: SetupSpec, environments: Callable[[], Iterable[EnvironmentSpec]],
+                 ledger: PublishLedger, history: PublishRecord = None):
+        """
+        A single pass over `environments()` builds everything, after a first pass that renders the constraints when
+        they are on. What is needed after the loop, the master installer inclusions and the manifest entries, goes to
+        the `ledger` on disk, so this works the same for an in memory config and a streamed one. Each environment's
+        pins are added to the `history` as it is built.
+        """
+        sink = self.sink
+        outpath = sink.begin(setup.outpath)
+        resolver = ReleaseResolver(settings=setup.resolution,
+                                   state_path=os.path.join(outpath, STATE_DIR, resolved_state_name(self.shard)),
+                                   mirrors=setup.mirrors, sink=sink)
+        resolver.refresh_mirrors()
+        conda_specs = ExplicitSpecs(outpath, setup.conda_lock, self.conda_solver) if setup.conda_lock.enabled else None
+        environment_variables = setup.environment_variables
+
+        # with changed_only, just the environments whose config files changed since the last publish are built
+        changed = None
+        fingerprints_path = os.path.join(outpath, STATE_DIR, CONFIG_FINGERPRINTS)
+        if self.changed_only:
+            changed = changed_environments(self.config, previous_fingerprints(fingerprints_path))
+
+        variants_built = set()
+        # environment folders to bundle, with the conda spec their create_env.bat uses
+        to_bundle = []
+        # (environment, py_version, requirements.txt content) of each environment built, to smoke install. Kept in
+        # memory, as not every sink can read its files back, and a verified publish is staged in memory anyway
+        verifying = self.verify and setup.verify.enabled
+        to_verify = []
+        # every environment's stamp covers the constraints that apply to it, so they are rendered first
+        constraint_lines = self._render_constraints(environments()) if setup.constraints else None
+        constraints = None if constraint_lines is None else constraints_by_package(constraint_lines)
+        for position, config in enumerate(environments()):
+            # a shard only owns its partition of the environments, for both building and master inclusion
+            owned = self.shard is None or env_in_shard(config.name, *self.shard)
+            # setup envs to include in master installers. always defined by setup, only run if user spefifies to
+            # create.
+            ledger.add(position, config.name, in_master=owned and config.include_in_master)
+            if not owned:
+                continue
+
+            # setup envs to include for single installers. User defined by name, package or repo
+            if not self.selector.matches(config) or (changed is not None and config.name not in changed):
+                continue
+            ledger.built(position)
+            requirements = [] if history is not None or verifying else None
+            built = self._build_env(outpath, config, resolver, conda_specs, setup.installer, setup.telemetry_dir,
+                                    ledger, requirements, constraints)
+            variants_built.update(built)
+            if history is not None and built:
+                history.add(config.name, requirements)
+            if built and verifying:
+                to_verify.append((config.name, config.py_version, "\n".join(requirements)))
+            if self.bundles:
+                conda_spec = conda_specs.get(config.py_version, sink.write_lines) if conda_specs and built else None
+                to_bundle += [(env_name, conda_spec) for env_name in built.values()]
+
+        resolver.save_state()
+        n_built = ledger.count(built=True)
+        METRICS.inc("environments_total", n_built, status="rebuilt")
+        METRICS.inc("environments_total", ledger.count() - n_built, status="skipped")
+        # the solved conda packages, for the local channel, which is pruned to them when every environment was built
+        conda_records = None
+        if conda_specs is not None and setup.conda_lock.local_channel:
+            conda_records = [record for records in conda_specs.records.values() for record in records]
+        solved_all = self.selector.selects_all and changed is None
 
-        # setup envs to include in master installers. always defined by setup, only run if user spefifies to create.
         # Only creates master/test as per user
-        if self.master:
-            envs_to_include_in_master_installer = []
-            for env_master, config in envs_master.items():
-                if config["setup"]["include_in_master"]:
-                    envs_to_include_in_master_installer.append(os.path.join(outpath, env_master))
-
-        masters_to_create = set()
-        for env, config in envs_to_build.items():
-
-            if self.test:
-                env_test = f"{env}_test"
-                CreateEnvBat(outpath, env_test).create(py_version=config["setup"]["py_version"], env_name=env_test,
-                                                       environment_variables=self.config.get("setup", {}).get("environment_variables", {}))
-                UpdateEnvBat(outpath, env_test).create(py_version=config["setup"]["py_version"], env_name=env_test)
-                deps = Dependancies(config)
-                path = os.path.join(outpath, env_test, "requirements.txt")
-                deps.write_requirments(path)
-
-                if self.master:
-                    masters_to_create.update({MasterCreateEnvsBatTest(outpath), MasterUpdateEnvsBatTest(outpath)})
-
-            if self.prod:
-                env_prod = env
-                CreateEnvBat(outpath, env_prod).create(py_version=config["setup"]["py_version"], env_name=env_prod,
-                                                       environment_variables=self.config.get("setup", {}).get("environment_variables", {}))
-                UpdateEnvBat(outpath, env_prod).create(py_version=config["setup"]["py_version"], env_name=env_prod)
-                deps = Dependancies(config)
-                path = os.path.join(outpath, env_prod, "requirements.txt")
-                deps.write_requirments(path)
-
-                if self.master:
-                    masters_to_create.update({MasterCreateEnvsBat(outpath), MasterUpdateEnvsBat(outpath)})
-
-        for m in masters_to_create:
-            m.create(environment_variables=self.config.get("setup", {}).get("environment_variables", {}),
-                     installers=envs_to_include_in_master_installer)
-        SetEnvironBat(outpath).create(environment_variables=self.config.get("setup", {}).get("environment_variables", {}))
+        master_variants = variants_built if self.master else set()
+        if self.shard is not None:
+            ShardManifest(outpath, *self.shard).write(sink=sink, data={
+                "config_sha256": self._get_fingerprint(),
+                "environments": list(ledger.names(built=True)),
+                "master_variants": sorted(master_variants),
+                "master_installers": [(position, os.path.join(outpath, name))
+                                      for position, name in ledger.master_installers()],
+                "environment_variables": dict(environment_variables),
+                "published": dict(ledger.entries()),
+                "constraints": constraint_lines,
+                "conda_channel": None if conda_records is None else {"subdir": setup.conda_lock.subdir,
+                                                                     "records": conda_records,
+                                                                     "complete": solved_all},
+            })
+        else:
+            create_target_files(sink, master_variants, lambda: (name for _, name in ledger.master_installers()),
+                                setup.schedule)
+            SetEnvironBat(outpath, sink).create(environment_variables=environment_variables)
+            ReconcileScript(outpath, sink).create()
+            if constraint_lines is not None:
+                sink.write_lines(os.path.join(outpath, CONSTRAINTS_FILE), constraint_lines)
+            if conda_records is not None:
+                LocalChannel(outpath, sink, setup.conda_lock.subdir, self.package_fetcher).add(conda_records,
+                                                                                              prune=solved_all)
+            # earlier entries are only read back when some folders of the config were not built
+            write_manifest(outpath, ledger.entries(), sink,
+                           keep=None if ledger.all_published() else ledger.carries_over)
+            if self.bundles:
+                self._write_bundles(outpath, to_bundle, set(ledger.folders()), constraint_lines is not None)
+        if to_verify:
+            self._verify(setup, outpath, to_verify, constraint_lines)
+        # record what is now published, unless some environments were left out and are not up to date
+        if self.shard is None and self.selector.selects_all:
+            record = fingerprint_record(self.config) if self.config else {"fingerprint": self._get_fingerprint()}
+            sink.write_text(fingerprints_path, json.dumps(record, indent=2, sort_keys=True))
+        if history is not None:
+            history.complete = self.shard is None and self.selector.selects_all and changed is None
+
+    def _render_constraints(self, environments: Iterable[EnvironmentSpec]) -> List[str]:
+        """
+        The lines of constraints.txt from the pins of every environment, built or not, so each shard and selective
+        publish writes the same file
+        """
+        with Constraints() as constraints:
+            for config in environments:
+                constraints.add(config.name, Dependancies(config).iter_pins())
+            lines, conflicts = constraints.render()
+        METRICS.inc("constraint_conflicts_total", len(conflicts))
+        for conflict in conflicts:
+            print(f"warning: {conflict.describe()}, left out of {CONSTRAINTS_FILE}")
+        return lines
+
+    def _verify(self, setup: SetupSpec, outpath, to_verify, constraint_lines: List[str] = None):
+        """
+        Smoke install the requirements of each environment built. Everything has been rendered but nothing written
+        yet, so raising VerificationError keeps the previous generation published. What passed is only remembered in
+        the outpath when the sink writes there
+        """
+        constraints = None if constraint_lines is None else "\n".join(constraint_lines)
+        cache_path = os.path.join(outpath, STATE_DIR, VERIFIED_FILE) if self.sink.on_disk else None
+        results = Verifier(setup.verify, cache_path, self.smoke_installer).verify(to_verify, constraints)
+        for result in results:
+            METRICS.inc("verify_total", status=result.status)
+        print(format_smoke_results(results))
+        failed = [result for result in results if result.status == "failed"]
+        if failed:
+            raise VerificationError(failed)
+
+    def _write_bundles(self, outpath, to_bundle, all_folders, constraints=False):
+        """
+        Bundle each environment folder built with the shared files its installers call. Environments that were not
+        built this run keep their earlier bundles in the index
+        """
+        bundles = Bundles(outpath, self.sink)
+        for env_name, conda_spec in to_bundle:
+            shared = list(BUNDLE_SHARED_FILES) + ([CONSTRAINTS_FILE] if constraints else [])
+            if conda_spec is not None:
+                shared.append(conda_spec.replace("\\", "/"))
+            bundles.add(env_name, shared)
+        bundles.write_index(keep=all_folders - set(bundles.entries))
+
+    def _build_env(self, outpath, config: EnvironmentSpec, resolver, conda_specs: ExplicitSpecs = None,
+                   installer="pip", telemetry_dir=None, ledger: PublishLedger = None,
+                   requirements: List[str] = None, constraints: Dict[str, str] = None) -> Dict[str, str]:
+        """
+        Write the installers and requirements.txt for the test and/or prod variants of one environment, returning
+        the variants built and their environment names. Each variant's manifest entry is added to the `ledger`, and
+        the environment's requirements.txt lines are appended to `requirements`. With `constraints`, the lines of
+        constraints.txt by package, the installers install with the outpath's constraints.txt and the stamp covers
+        those of its lines that apply to the environment
+        """
+        variants = []
+        if self.test:
+            variants.append(("test", f"{config.name}_test"))
+        if self.prod:
+            variants.append(("prod", config.name))
+
+        sink = self.sink
+        conda_spec = conda_specs.get(config.py_version, sink.write_lines) if conda_specs and variants else None
+        conda_channel = CHANNEL_DIR if conda_spec and conda_specs.settings.local_channel else None
+        installer = config.installer or installer
+        constraints_path = None
+        applied_sha256 = None
+        if constraints is not None:
+            constraints_path = f"..\\{CONSTRAINTS_FILE}"
+            applied_sha256 = constraints_sha256(constraints, (pkg.name for pkg in config.packages))
+        for variant, env_name in variants:
+            CreateEnvBat(outpath, env_name, sink).create(py_version=config.py_version, env_name=env_name,
+                                                   conda_spec=conda_spec, conda_channel=conda_channel,
+                                                   installer=installer, telemetry_dir=telemetry_dir,
+                                                   constraints=constraints_path)
+            UpdateEnvBat(outpath, env_name, sink).create(py_version=config.py_version, env_name=env_name,
+                                                   installer=installer, telemetry_dir=telemetry_dir,
+                                                   constraints=constraints_path)
+            deps = Dependancies(config, resolver)
+            path = os.path.join(outpath, env_name, "requirements.txt")
+            # both variants resolve to the same requirements, so they are recorded once
+            record = requirements if variant == variants[0][0] else None
+            requirements_sha256 = deps.write_requirments(path, sink, record)
+            stamp = generation_stamp(config.py_version, requirements_sha256, installer, applied_sha256)
+            sink.write_lines(os.path.join(outpath, env_name, STAMP_FILE), [stamp])
+            if ledger is not None:
+                entry = {"environment": config.name, "variant": variant, "py_version": config.py_version,
+                         "stamp": stamp, "include_in_master": config.include_in_master, "installer": installer}
+                if constraints is not None:
+                    entry["constraints"] = CONSTRAINTS_FILE
+                ledger.publish(env_name, entry)
+        return dict(variants)
+
+    def _export_metrics(self, status="success"):
+        METRICS.finish(status)
+        if self.metrics_textfile:
+            METRICS.write_prometheus(self.metrics_textfile)
+        if self.metrics_json:
+            METRICS.write_json(self.metrics_json)
+
+
+def _parse_shard_option(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def preview(setup: Setup, test=True, prod=True, master=True, **kwargs) -> Dict[str, Artifact]:
+    """
+    Publish in to memory and return every artifact, path relative to the outpath -> content and sha256. Nothing is
+    written to disk, so nothing is smoke installed either. Compare it with `sinks.read_tree(outpath)` using
+    `sinks.diff_artifacts` to see what a config change would publish.
+    """
+    return PublishInstallers(setup, test, prod, master, sink=MemorySink(), verify=False, **kwargs).publish()
 
 
 @click.command()
 @click.option('--test', is_flag = True, help = "If true, writes the test installers")
 @click.option('--prod', is_flag = True, help = "If true, writes the prod installers")
 @click.option('--master', is_flag = True, help = "If true, writes the master installers")
-@click.option('--env', required = False, help = "specify the name of the environment to create installers for")
-def main(test, prod, master, env):
+@click.option('--env', 'envs', multiple = True,
+              help = "only create installers for environments with this name or glob, e.g. 'lab_*'. Repeatable")
+@click.option('--package', 'packages', multiple = True,
+              help = "only create installers for environments that use this package. Repeatable")
+@click.option('--repo', 'repos', multiple = True,
+              help = "only create installers for environments that use this github repo url. Repeatable")
+@click.option('--metrics-textfile', required = False, type = click.Path(dir_okay = False),
+              help = "write run metrics to this prometheus textfile-collector file (*.prom)")
+@click.option('--metrics-json', required = False, type = click.Path(dir_okay = False),
+              help = "write run metrics to this json file")
+@click.option('--shard', required = False, callback = _parse_shard_option,
+              help = "i/n, only publish the i-th of n deterministic partitions of the environments. "
+                     "Master installers are built afterwards by `mipi merge`")
+@click.option('--stream', is_flag = True,
+              help = "read environments from the setup file one at a time instead of loading it all in to memory")
+@click.option('--changed', is_flag = True,
+              help = "only create installers for environments whose config files changed since the last publish")
+@click.option('--bundles', is_flag = True,
+              help = "also write one archive per environment, and an index of them, to outpath/bundles")
+@click.option('--no-history', is_flag = True, help = "do not record the resolved pins in the resolution history")
+@click.option('--no-verify', is_flag = True, help = "publish without the smoke install, even if setup.verify is on")
+def main(test, prod, master, envs, packages, repos, metrics_textfile, metrics_json, shard, stream, changed, bundles,
+         no_history, no_verify):
+    if changed and stream:
+        raise click.UsageError("--changed cannot be used with --stream")
+    if bundles and shard is not None:
+        raise click.UsageError("--bundles cannot be used with --shard")
+    setup = YmlSetup(ENV_SETUP_PATH)
+    publisher = PublishInstallers(setup, test, prod, master, envs, metrics_textfile, metrics_json, shard, stream,
+                                  packages=packages, repos=repos, changed_only=changed, bundles=bundles,
+                                  record_history=not no_history, verify=not no_verify)
+    try:
+        publisher.publish()
+    except VerificationError as e:
+        raise click.ClickException(str(e))
+    _raise_for_failed_targets(publisher.sink.statuses)
+
+
+def _raise_for_failed_targets(statuses):
+    failed = [status.target for status in statuses.values() if not status.ok]
+    if failed:
+        raise click.ClickException(f"publishing to {', '.join(failed)} failed, the other targets are up to date")
+
+
+@click.command()
+@click.option('--count', required = False, type = int, help = "number of shards to expect, if several were published")
+def merge(count):
+    """
+    build the master installers and set_environ.bat from all shard manifests
+    """
+    config = YmlSetup(ENV_SETUP_PATH).load_config()
+    try:
+        statuses = merge_shards(config.setup.outpath, count, config.setup.schedule, config.setup.outpaths)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    _raise_for_failed_targets(statuses)
+
+
+@click.command()
+@click.argument('drop_dir', type = click.Path(exists = True, file_okay = False))
+@click.option('--by-step', is_flag = True, help = "aggregate each step over all environments instead of per environment")
+@click.option('--step', 'steps', multiple = True, help = "only report these steps, e.g. --step total --step install")
+@click.option('--json', 'as_json', is_flag = True, help = "print the report as json")
+def timings(drop_dir, by_step, steps, as_json):
+    """
+    report percentiles of the installer timings collected in DROP_DIR (setup.telemetry_dir)
+    """
+    rows = TimingReport().add(iter_records(drop_dir)).rows(by_env=not by_step)
+    if steps:
+        rows = [row for row in rows if row["step"] in steps]
+    click.echo(json.dumps(rows, indent=2) if as_json else format_rows(rows))
+
+
+@click.command()
+@click.argument('outpath', type = click.Path(exists = True, file_okay = False))
+@click.option('--workers', default = 4, show_default = True, type = click.IntRange(min = 1),
+              help = "environments to install at the same time")
+@click.option('--env', 'envs', multiple = True,
+              help = "sync environment folders with this name or glob, e.g. 'lab_*_test', instead of the master ones. "
+                     "Repeatable")
+@click.option('--variant', type = click.Choice(["prod", "test"]), default = "prod", show_default = True,
+              help = "which master installers' environments to sync")
+@click.option('--state-dir', type = click.Path(file_okay = False),
+              help = "where this machine records what it installed, defaults to %LOCALAPPDATA%\\mipi\\sync")
+@click.option('--dry-run', is_flag = True, help = "only print what would be installed")
+@click.option('--json', 'as_json', is_flag = True, help = "print the results as json")
+def sync(outpath, workers, envs, variant, state_dir, dry_run, as_json):
+    """
+    install the environments published to OUTPATH that changed since this machine last installed them
+    """
+    client = SyncClient(outpath, state_dir, workers, envs=envs, variant=variant)
+    try:
+        results = client.sync(dry_run)
+    except FileNotFoundError as e:
+        raise click.ClickException(str(e))
+    if as_json:
+        click.echo(json.dumps([{"folder": r.folder, "action": r.action, "status": r.status,
+                                "seconds": round(r.seconds, 2), "returncode": r.returncode, "log": r.log_path}
+                               for r in results], indent=2))
+    else:
+        click.echo(format_results(results))
+    failed = [r.folder for r in results if r.status == "failed"]
+    if failed:
+        raise click.ClickException(f"{len(failed)} environment(s) failed to install: {', '.join(failed)}")
+
+
+@click.command()
+@click.option('--host', default = "127.0.0.1", show_default = True, help = "address to listen on")
+@click.option('--port', default = 8787, show_default = True, type = int, help = "port to listen on")
+@click.option('--delay', default = 30.0, show_default = True, type = float,
+              help = "seconds without a new release event before publishing")
+@click.option('--max-delay', default = 300.0, show_default = True, type = float,
+              help = "longest a release event waits to be published during a burst of events")
+@click.option('--test', is_flag = True, help = "If true, writes the test installers")
+@click.option('--prod', is_flag = True, help = "If true, writes the prod installers")
+@click.option('--master', is_flag = True, help = "If true, writes the master installers")
+def listen(host, port, delay, max_delay, test, prod, master):
+    """
+    republish the environments that use a repo when github sends a release webhook for it
+    """
+    try:
+        secret = get_environ(ENV_WEBHOOK_SECRET)
+    except EnvironmentError as e:
+        raise click.ClickException(f"{e}, it must match the webhook's secret")
     setup = YmlSetup(ENV_SETUP_PATH)
-    publisher = PublishInstallers(setup, test, prod, master, env)
-    publisher.publish()
+
+    def republish(repos):
+        click.echo(f"republishing the environments that use {', '.join(sorted(repos))}")
+        publisher = PublishInstallers(setup, test, prod, master, repos=sorted(repos), record_history=True)
+        publisher.publish()
+        _raise_for_failed_targets(publisher.sink.statuses)
+
+    def load_index():
+        return EnvironmentIndex.from_environments(setup.load_config().environments.values())
+
+    listener = WebhookListener(secret, republish, load_index, host, port, delay, max_delay)
+    click.echo(f"listening for github release webhooks on http://{host}:{listener.address[1]}")
+    try:
+        listener.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
+
+
+@click.group()
+@click.option('--db', type = click.Path(dir_okay = False),
+              help = "the history database, defaults to setup.history_db or outpath/.mipi/history.sqlite")
+@click.pass_context
+def history(ctx, db):
+    """
+    query the resolved pins recorded by every publish
+    """
+    ctx.obj = db
+
+
+def _open_history(db) -> ResolutionHistory:
+    if db is None:
+        db = history_path(YmlSetup(ENV_SETUP_PATH).load_config().setup)
+    if not os.path.exists(db):
+        raise click.ClickException(f"there is no resolution history at {db}")
+    return ResolutionHistory(db)
+
+
+def _echo_rows(rows, columns, as_json):
+    click.echo(json.dumps(rows, indent=2) if as_json else format_table(rows, columns))
+
+
+@history.command("publishes")
+@click.option('--limit', default = 20, show_default = True, type = int, help = "most recent publishes to list")
+@click.option('--json', 'as_json', is_flag = True, help = "print as json")
+@click.pass_obj
+def history_publishes(db, limit, as_json):
+    """
+    list publishes, newest first, with the number of pins each added and removed
+    """
+    with _open_history(db) as h:
+        _echo_rows(h.publishes(limit), ["id", "started", "complete", "added", "removed"], as_json)
+
+
+@history.command("log")
+@click.argument('environment')
+@click.option('--package', help = "only this package")
+@click.option('--json', 'as_json', is_flag = True, help = "print as json")
+@click.pass_obj
+def history_log(db, environment, package, as_json):
+    """
+    every version ENVIRONMENT has had of its packages, with when it was added and replaced
+    """
+    with _open_history(db) as h:
+        _echo_rows(h.log(environment, package), ["package", "version", "added_in", "added", "removed_in", "removed"],
+                   as_json)
+
+
+@history.command("diff")
+@click.argument('before')
+@click.argument('after', default = "latest")
+@click.option('--env', 'environment', help = "only this environment")
+@click.option('--json', 'as_json', is_flag = True, help = "print as json")
+@click.pass_obj
+def history_diff(db, before, after, environment, as_json):
+    """
+    the pins that changed between two publishes, each a publish id, 'latest', or an ISO date or time
+    """
+    with _open_history(db) as h:
+        try:
+            rows = h.diff(h.resolve(before), h.resolve(after), environment)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        _echo_rows(rows, ["environment", "package", "change", "before", "after"], as_json)
+
+
+@history.command("who")
+@click.argument('package')
+@click.argument('version')
+@click.option('--at', help = "a publish id or an ISO date or time, defaults to the latest publish")
+@click.option('--json', 'as_json', is_flag = True, help = "print as json")
+@click.pass_obj
+def history_who(db, package, version, at, as_json):
+    """
+    the environments pinned to VERSION of PACKAGE, e.g. `who requests v2.32.3` or `who requests "2.3*"`
+    """
+    with _open_history(db) as h:
+        try:
+            rows = h.users(package, version, at)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        _echo_rows(rows, ["environment", "package", "version"], as_json)
+
+
+@click.group()
+def cli():
+    """
+    MiPi environment manager
+    """
+
+
+cli.add_command(main, "publish-envs")
+cli.add_command(merge)
+cli.add_command(timings)
+cli.add_command(sync)
+cli.add_command(history)
+cli.add_command(listen)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,187 @@
+import json
+import math
+import os
+import tempfile
+import time
+from pathlib import Path
+
+METRIC_PREFIX = "mipi_publish"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    "github_requests_total": "GitHub API requests made, by HTTP status code",
+    "github_bytes_downloaded_total": "Bytes downloaded from the GitHub API",
+    "release_cache_hits_total": "Release lookups answered from the in-run cache",
+    "release_cache_misses_total": "Release lookups that required a request",
+    "resolution_seconds": "Time taken to fetch the releases of a repository",
+    "resolution_fallbacks_total": "Packages that used the last resolved version because the deadline passed",
+    "mirror_lookups_total": "Release lookups answered from a local git mirror",
+    "mirror_fetches_total": "Local git mirror refreshes, by status",
+    "render_seconds": "Time taken to render a jinja template",
+    "environments_total": "Environments rebuilt or skipped by this run",
+    "files_total": "Files written, left unchanged or removed by this run",
+    "verify_total": "Environments smoke installed before publishing, by status",
+    "channel_packages_total": "Conda packages of the local channel, added by this run or already present",
+    "constraint_conflicts_total": "Packages left out of constraints.txt because environments pin them differently",
+    "targets_total": "Output targets published to, by status",
+    "duration_seconds": "Wall clock duration of the publish run, by how it ended",
+    "last_run_timestamp_seconds": "Unix time at which the publish run finished, by how it ended",
+}
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    inner = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+    return "{" + inner + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Histogram:
+    """
+    A cumulative histogram with fixed bucket bounds, as used by prometheus.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {_format_value(b): c for b, c in zip(self.buckets, self.counts)},
+        }
+
+
+class PublishMetrics:
+    """
+    Counters, gauges and histograms collected during a single publish run. Exported as a prometheus
+    textfile-collector file and/or json at the end of the run.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._started = time.perf_counter()
+
+    def inc(self, name, value=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = _label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = _label_key(labels)
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+
+    def get(self, name, **labels):
+        """
+        Return the current value of a counter or gauge, 0 if it has not been recorded
+        """
+        key = _label_key(labels)
+        for store in (self.counters, self.gauges):
+            if name in store and key in store[name]:
+                return store[name][key]
+        return 0
+
+    def finish(self, status="success"):
+        """
+        Record the duration and end of the run, labelled with how it ended, "success" or "failed"
+        """
+        self.set("duration_seconds", time.perf_counter() - self._started, status=status)
+        self.set("last_run_timestamp_seconds", time.time(), status=status)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+            for name in sorted(store):
+                full = f"{METRIC_PREFIX}_{name}"
+                lines.append(f"# HELP {full} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {full} {kind}")
+                for key in sorted(store[name]):
+                    lines.append(f"{full}{_format_labels(key)} {_format_value(store[name][key])}")
+        for name in sorted(self.histograms):
+            full = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {full} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {full} histogram")
+            for key in sorted(self.histograms[name]):
+                hist = self.histograms[name][key]
+                for bound, count in zip(hist.buckets, hist.counts):
+                    le = (("le", _format_value(bound)),)
+                    lines.append(f"{full}_bucket{_format_labels(key, le)} {count}")
+                lines.append(f"{full}_bucket{_format_labels(key, (('le', '+Inf'),))} {hist.count}")
+                lines.append(f"{full}_sum{_format_labels(key)} {_format_value(hist.sum)}")
+                lines.append(f"{full}_count{_format_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        def series(store, fmt):
+            return {name: [{"labels": dict(key), "value": fmt(val)} for key, val in sorted(vals.items())]
+                    for name, vals in sorted(store.items())}
+
+        return {
+            "counters": series(self.counters, lambda v: v),
+            "gauges": series(self.gauges, lambda v: v),
+            "histograms": series(self.histograms, lambda h: h.to_dict()),
+        }
+
+    def write_prometheus(self, path):
+        _atomic_write(path, self.to_prometheus())
+
+    def write_json(self, path):
+        _atomic_write(path, json.dumps(self.to_dict(), indent=2))
+
+
+def _atomic_write(path, content):
+    """
+    The node exporter textfile collector may read the file at any time, so write to a temp file in the same
+    directory and rename it in to place. mkstemp creates the file readable by its owner only, so it is given the mode
+    a plain open() would have, for a collector running as another user.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp, 0o666 & ~umask)
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+METRICS = PublishMetrics()
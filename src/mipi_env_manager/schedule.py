@@ -0,0 +1,56 @@
+import hashlib
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from mipi_env_manager.config import ScheduleSpec
+
+DAY_SECONDS = 24 * 60 * 60
+# a fixed start date keeps the generated task xml identical between publishes
+START_DATE = "2024-01-01"
+
+
+@dataclass(frozen=True, slots=True)
+class UnitSchedule:
+    """
+    When one host, or one group of hosts, runs the master update and create installers, as seconds since midnight
+    """
+    unit: str
+    hosts: Tuple[str, ...]
+    update_time: int
+    create_time: int
+
+
+def window_seconds(window: Tuple[int, int]) -> int:
+    start, end = window
+    return ((end - start) % (24 * 60)) * 60
+
+
+def offset_in_window(name, window: Tuple[int, int], salt="") -> int:
+    """
+    A deterministic start time, in seconds since midnight, spread evenly over the window by a hash of the name.
+    Host names are compared case-insensitively, as Windows does
+    """
+    digest = hashlib.sha256(f"{salt}{name.lower()}".encode("utf-8")).digest()
+    offset = int.from_bytes(digest[:8], "big") % window_seconds(window)
+    return (window[0] * 60 + offset) % DAY_SECONDS
+
+
+def plan_schedule(spec: ScheduleSpec) -> List[UnitSchedule]:
+    """
+    One schedule per group, shared by its hosts, and one per host that is not in a group. Update and create times are
+    hashed separately, so hosts that update together do not also create together
+    """
+    grouped = {h.lower() for _, members in spec.groups for h in members}
+    units = [(group, members) for group, members in spec.groups]
+    units += [(host, (host,)) for host in spec.hosts if host.lower() not in grouped]
+    return [UnitSchedule(unit, tuple(hosts), offset_in_window(unit, spec.update_window, "update:"),
+                         offset_in_window(unit, spec.create_window, "create:"))
+            for unit, hosts in units]
+
+
+def format_time(seconds) -> str:
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def start_boundary(seconds) -> str:
+    return f"{START_DATE}T{format_time(seconds)}"
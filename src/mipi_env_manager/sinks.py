@@ -0,0 +1,523 @@
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+import zipfile
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import IO, Dict, Iterable, List, Optional, Tuple
+
+from mipi_env_manager.metrics import METRICS
+
+# zip entries get a fixed timestamp, so the same artifacts always make the same archive
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+@dataclass(frozen=True, slots=True)
+class Artifact:
+    """
+    A file produced by a publish. `content` is only kept by sinks that hold the files in memory. `binary` files, like
+    archives, are written byte for byte instead of as text
+    """
+    sha256: str
+    size: int
+    content: Optional[bytes] = None
+    binary: bool = False
+
+    @property
+    def text(self) -> Optional[str]:
+        return None if self.content is None or self.binary else self.content.decode("utf-8")
+
+
+@dataclass(frozen=True, slots=True)
+class TargetStatus:
+    """
+    The outcome of writing a publish to one of several targets
+    """
+    target: str
+    written: int = 0
+    unchanged: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+    removed: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class OutputSink(ABC):
+    """
+    Where a publish writes its files. Writers pass full paths under the root given to `begin`, and every file
+    written is recorded in `artifacts`, keyed by its path relative to the root with "/" separators.
+    """
+
+    # whether the files end up in the outpath on disk, where state kept between publishes is read back from
+    on_disk = False
+
+    def __init__(self):
+        self.root = None
+        self.artifacts: Dict[str, Artifact] = {}
+        # the outcome per target, for sinks that write to several
+        self.statuses: Dict[str, TargetStatus] = {}
+
+    def begin(self, root) -> str:
+        """
+        Start a publish in to `root` (the setup's outpath), returning the root to build paths on
+        """
+        self.root = root
+        self.artifacts = {}
+        return root
+
+    @property
+    def targets(self) -> Tuple[str, ...]:
+        """
+        The roots that files embedding their own root's path, like the master installers, are rendered for
+        """
+        return (self.root,)
+
+    def only(self, target):
+        """
+        Within this context, writes are for `target` alone
+        """
+        return contextlib.nullcontext()
+
+    def commit(self):
+        """
+        Called once every file of a successful publish has been written
+        """
+
+    def close(self):
+        pass
+
+    def key(self, path) -> str:
+        if self.root is None:
+            return str(path).replace(os.sep, "/")
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def write_lines(self, path, lines: Iterable[str]) -> str:
+        """
+        Write newline separated lines as they are generated, returning the sha256 of the content
+        """
+        def chunks():
+            for i, line in enumerate(lines):
+                yield line if i == 0 else f"\n{line}"
+
+        return self.write_chunks(path, chunks())
+
+    def write_chunks(self, path, chunks: Iterable[str]) -> str:
+        """
+        Write text as it is generated, e.g. by a streamed template, returning the sha256 of the content
+        """
+        artifact = self._write(path, chunks)
+        self._record(self.key(path), artifact)
+        return artifact.sha256
+
+    def _record(self, key, artifact: Artifact):
+        self.artifacts[key] = artifact
+
+    def write_text(self, path, content: str) -> str:
+        return self.write_lines(path, [content])
+
+    def write_bytes(self, path, data: bytes) -> str:
+        """
+        Write binary content, e.g. an archive, returning its sha256
+        """
+        artifact = self._write_bytes(path, data)
+        self._record(self.key(path), artifact)
+        return artifact.sha256
+
+    @abstractmethod
+    def _write(self, path, chunks: Iterable[str]) -> Artifact:
+        raise NotImplementedError  # pragma: no cover
+
+    @abstractmethod
+    def _write_bytes(self, path, data: bytes) -> Artifact:
+        raise NotImplementedError  # pragma: no cover
+
+    @abstractmethod
+    def read_text(self, path) -> Optional[str]:
+        """
+        The content of a file written earlier, None if there is none
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def prune(self, directory, keep: Iterable[str]):
+        """
+        Remove the files directly in `directory` that are not named in `keep`, left there by earlier publishes. Sinks
+        that only hold what this run wrote have nothing to remove
+        """
+
+
+class DiskSink(OutputSink):
+    """
+    Write to the file system. Each file is streamed to a temp file next to its path, hashed as it goes, and only moved
+    in to place if the content differs from the existing file, so unchanged files keep their modified time.
+    Without `keep_artifacts`, the files written are not recorded in `artifacts`, so a streamed publish holds nothing
+    per file.
+    """
+
+    on_disk = True
+
+    def __init__(self, quiet=False, keep_artifacts=True):
+        super().__init__()
+        self.quiet = quiet
+        self.keep_artifacts = keep_artifacts
+
+    def _record(self, key, artifact: Artifact):
+        if self.keep_artifacts:
+            super()._record(key, artifact)
+
+    def _write(self, path, chunks: Iterable[str]) -> Artifact:
+        artifact, unchanged = write_if_changed(path, chunks)
+        status = "unchanged" if unchanged else "written"
+        METRICS.inc("files_total", status=status)
+        if not self.quiet:
+            print(f"file {'unchanged:' if unchanged else 'written to:'} {path}")
+        return artifact
+
+    def _write_bytes(self, path, data: bytes) -> Artifact:
+        unchanged = write_bytes_if_changed(path, data)
+        METRICS.inc("files_total", status="unchanged" if unchanged else "written")
+        if not self.quiet:
+            print(f"file {'unchanged:' if unchanged else 'written to:'} {path}")
+        return Artifact(hashlib.sha256(data).hexdigest(), len(data), binary=True)
+
+    def read_text(self, path) -> Optional[str]:
+        try:
+            with open(path, "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def prune(self, directory, keep: Iterable[str]):
+        for path in prune_dir(directory, keep):
+            METRICS.inc("files_total", status="removed")
+            if not self.quiet:
+                print(f"file removed: {path}")
+
+
+class MemorySink(OutputSink):
+    """
+    Keep every file in memory, e.g. to preview what a config change would publish without touching disk
+    """
+
+    def begin(self, root) -> str:
+        # nothing is written, so a setup without an outpath can still be previewed
+        return super().begin(root if root is not None else ".")
+
+    def _write(self, path, chunks: Iterable[str]) -> Artifact:
+        content = "".join(chunks).encode("utf-8")
+        METRICS.inc("files_total", status="written")
+        return Artifact(hashlib.sha256(content).hexdigest(), len(content), content)
+
+    def _write_bytes(self, path, data: bytes) -> Artifact:
+        METRICS.inc("files_total", status="written")
+        return Artifact(hashlib.sha256(data).hexdigest(), len(data), data, binary=True)
+
+    def read_text(self, path) -> Optional[str]:
+        artifact = self.artifacts.get(self.key(path))
+        return None if artifact is None else artifact.text
+
+
+class ZipSink(OutputSink):
+    """
+    Write every file in to one zip archive, streaming each entry as it is generated
+    """
+
+    def __init__(self, zip_path):
+        super().__init__()
+        self.zip_path = zip_path
+        self._zip = None
+
+    def begin(self, root) -> str:
+        root = super().begin(root if root is not None else ".")
+        self._zip = zipfile.ZipFile(self.zip_path, "w", compression=zipfile.ZIP_DEFLATED)
+        return root
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def _write(self, path, chunks: Iterable[str]) -> Artifact:
+        info = zipfile.ZipInfo(self.key(path), date_time=ZIP_DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        digest = hashlib.sha256()
+        size = 0
+        with self._zip.open(info, "w") as f:
+            for text in chunks:
+                data = text.encode("utf-8")
+                f.write(data)
+                digest.update(data)
+                size += len(data)
+        METRICS.inc("files_total", status="written")
+        return Artifact(digest.hexdigest(), size)
+
+    def _write_bytes(self, path, data: bytes) -> Artifact:
+        info = zipfile.ZipInfo(self.key(path), date_time=ZIP_DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self._zip.writestr(info, data)
+        METRICS.inc("files_total", status="written")
+        return Artifact(hashlib.sha256(data).hexdigest(), len(data), binary=True)
+
+    def read_text(self, path) -> Optional[str]:
+        # entries cannot be read back while the archive is being written
+        return None
+
+
+class FanOutSink(OutputSink):
+    """
+    Publish to several targets, e.g. one file share per region. Every file is rendered once in to memory, then
+    `commit` writes them to all targets concurrently. Each target only receives the files whose content differs from
+    what it already holds, and a target that is slow or fails does not hold up the others; see `statuses`.
+
+    The first target is the primary: paths are built on it, and state from earlier publishes is read back from it.
+    Files written inside `only(target)` go to that target alone.
+    """
+
+    on_disk = True
+
+    def __init__(self, targets, workers=8, quiet=False):
+        super().__init__()
+        if not targets:
+            raise ValueError("FanOutSink needs at least one target")
+        self._targets = tuple(targets)
+        self.workers = workers
+        self.quiet = quiet
+        self._current = None
+        self._own: Dict[str, Dict[str, Artifact]] = {}
+        # (directory key, names to keep), pruned on every target once it has been written
+        self._prunes: List[Tuple[str, frozenset]] = []
+
+    @property
+    def targets(self) -> Tuple[str, ...]:
+        return self._targets
+
+    def begin(self, root) -> str:
+        self._own = {target: {} for target in self._targets}
+        self._prunes = []
+        self.statuses = {}
+        return super().begin(self._targets[0])
+
+    @contextlib.contextmanager
+    def only(self, target):
+        self._current = target
+        try:
+            yield
+        finally:
+            self._current = None
+
+    def key(self, path) -> str:
+        if self._current is None:
+            return super().key(path)
+        return os.path.relpath(path, self._current).replace(os.sep, "/")
+
+    def _record(self, key, artifact: Artifact):
+        if self._current is None:
+            self.artifacts[key] = artifact
+        else:
+            self._own[self._current][key] = artifact
+
+    def _write(self, path, chunks: Iterable[str]) -> Artifact:
+        content = "".join(chunks).encode("utf-8")
+        return Artifact(hashlib.sha256(content).hexdigest(), len(content), content)
+
+    def _write_bytes(self, path, data: bytes) -> Artifact:
+        return Artifact(hashlib.sha256(data).hexdigest(), len(data), data, binary=True)
+
+    def read_text(self, path) -> Optional[str]:
+        key = self.key(path)
+        artifact = self._own.get(self._current, {}).get(key) or self.artifacts.get(key)
+        if artifact is not None:
+            return artifact.text
+        try:
+            with open(path, "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def prune(self, directory, keep: Iterable[str]):
+        self._prunes.append((self.key(directory), frozenset(keep)))
+
+    def _write_target(self, target) -> TargetStatus:
+        start = time.perf_counter()
+        files = {**self.artifacts, **self._own[target]}
+        # files in the environment folders go first and the top level master installers last, so a target never
+        # has a master installer calling an environment it has not received yet
+        nested = sorted(k for k in files if "/" in k)
+        top = sorted(k for k in files if "/" not in k)
+
+        def write(key):
+            # the content is already hashed, so an unchanged file is only read, never written, on the target
+            path = os.path.join(target, *key.split("/"))
+            if files[key].binary:
+                return write_bytes_if_changed(path, files[key].content)
+            if file_sha256(path) == files[key].sha256:
+                return True
+            return write_if_changed(path, [files[key].text])[1]
+
+        written = unchanged = removed = 0
+        try:
+            os.makedirs(target, exist_ok=True)
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for keys in (nested, top):
+                    for was_unchanged in executor.map(write, keys):
+                        unchanged += was_unchanged
+                        written += not was_unchanged
+            # only once everything new is in place, so nothing still referenced is removed first
+            for key, keep in self._prunes:
+                removed += len(prune_dir(os.path.join(target, *key.split("/")), keep))
+        except OSError as e:
+            return TargetStatus(target, written, unchanged, time.perf_counter() - start, str(e), removed)
+        return TargetStatus(target, written, unchanged, time.perf_counter() - start, removed=removed)
+
+    def commit(self):
+        with ThreadPoolExecutor(max_workers=len(self._targets)) as executor:
+            statuses = list(executor.map(self._write_target, self._targets))
+        self.statuses = {status.target: status for status in statuses}
+        for status in statuses:
+            METRICS.inc("files_total", status.written, status="written")
+            METRICS.inc("files_total", status.unchanged, status="unchanged")
+            if status.removed:
+                METRICS.inc("files_total", status.removed, status="removed")
+            METRICS.inc("targets_total", status="ok" if status.ok else "failed")
+            if not self.quiet:
+                print(format_status(status))
+        self.artifacts.update(self._own[self._targets[0]])
+
+
+def format_status(status: TargetStatus) -> str:
+    if not status.ok:
+        return f"target {status.target}: failed after {status.seconds:.1f}s: {status.error}"
+    removed = f", {status.removed} removed" if status.removed else ""
+    return (f"target {status.target}: {status.written} written, {status.unchanged} unchanged{removed} "
+            f"in {status.seconds:.1f}s")
+
+
+def open_temp_beside(path, binary=False) -> Tuple[IO, str]:
+    """
+    Open a new temp file in the directory of `path`, to be moved on to it, returning the file and its path. Each temp
+    file has its own name, so concurrent shards writing the same path never write to one file. mkstemp creates it
+    readable by its owner only, so it is given the mode a plain open() would have
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or ".", prefix=f".{name}.", suffix=".tmp")
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+    return os.fdopen(fd, "wb" if binary else "w"), tmp_path
+
+
+def write_if_changed(path, chunks: Iterable[str]) -> Tuple[Artifact, bool]:
+    """
+    Stream the content to a temp file next to `path`, hashing it as it goes, and only move it in to place if it
+    differs from the existing file. Returns the artifact and whether the file was left unchanged
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    f, tmp_path = open_temp_beside(path)
+    try:
+        with f:
+            for text in chunks:
+                f.write(text)
+                data = text.encode("utf-8")
+                digest.update(data)
+                size += len(data)
+        unchanged = file_sha256(path) == digest.hexdigest()
+        if unchanged:
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return Artifact(digest.hexdigest(), size), unchanged
+
+
+def write_bytes_if_changed(path, data: bytes) -> bool:
+    """
+    Write binary content unless the existing file already holds it, returning whether it was left unchanged
+    """
+    try:
+        with open(path, "rb") as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+                return True
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    f, tmp_path = open_temp_beside(path, binary=True)
+    try:
+        with f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return False
+
+
+def prune_dir(directory, keep: Iterable[str]) -> List[str]:
+    """
+    Remove the files directly in `directory` that are not named in `keep`, returning their paths
+    """
+    keep = set(keep)
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+    removed = []
+    for name in names:
+        path = os.path.join(directory, name)
+        if name not in keep and os.path.isfile(path):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def file_sha256(path, chunk_size=1 << 16) -> Optional[str]:
+    digest = hashlib.sha256()
+    try:
+        with open(path, "r") as f:
+            for chunk in iter(lambda: f.read(chunk_size), ""):
+                digest.update(chunk.encode("utf-8"))
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def read_tree(root) -> Dict[str, Artifact]:
+    """
+    The artifacts already published under `root`, with their content, to diff a preview against
+    """
+    artifacts = {}
+    for dir_path, _, file_names in os.walk(root):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            key = os.path.relpath(path, root).replace(os.sep, "/")
+            try:
+                with open(path, "r") as f:
+                    content = f.read().encode("utf-8")
+                binary = False
+            except UnicodeDecodeError:
+                with open(path, "rb") as f:
+                    content = f.read()
+                binary = True
+            artifacts[key] = Artifact(hashlib.sha256(content).hexdigest(), len(content), content, binary)
+    return artifacts
+
+
+def diff_artifacts(before: Dict[str, Artifact], after: Dict[str, Artifact]) -> Dict[str, Tuple[str, ...]]:
+    """
+    The paths added, removed and changed between two sets of artifacts, compared by hash
+    """
+    return {
+        "added": tuple(sorted(after.keys() - before.keys())),
+        "removed": tuple(sorted(before.keys() - after.keys())),
+        "changed": tuple(sorted(k for k in before.keys() & after.keys() if before[k].sha256 != after[k].sha256)),
+    }
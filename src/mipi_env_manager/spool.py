@@ -0,0 +1,44 @@
+import contextlib
+import os
+import shutil
+import sqlite3
+import tempfile
+
+
+class Spool:
+    """
+    A throwaway SQLite file for state a publish gathers per environment, so a streamed publish keeps it on disk instead
+    of in memory however many environments the config has. Nothing is journaled or synced, and the file is deleted on
+    close. Use it as a context manager, or close it.
+    """
+
+    def __init__(self, schema: str, prefix="mipi-spool-"):
+        self._dir = tempfile.mkdtemp(prefix=prefix)
+        self.path = os.path.join(self._dir, "spool.sqlite")
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.executescript(schema)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Run the statements in the block as one transaction, as each statement is its own transaction otherwise
+        """
+        self.db.execute("BEGIN")
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def close(self):
+        self.db.close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,292 @@
+import fnmatch
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST_FILE = "manifest.json"
+STATE_FILE = "state.json"
+LOG_DIR = "logs"
+# what the installers record inside an environment after a successful install
+INSTALLED_STAMP = os.path.join("conda-meta", "mipi_stamp.txt")
+
+
+def load_manifest(text: Optional[str]) -> Dict[str, dict]:
+    """
+    The environments of a published manifest.json, environment folder -> entry. Empty if there is none yet
+    """
+    if not text:
+        return {}
+    try:
+        return json.loads(text).get("environments", {})
+    except json.JSONDecodeError:
+        return {}
+
+
+def default_state_dir() -> str:
+    """
+    Where a machine records what it has installed: %LOCALAPPDATA%\\mipi\\sync on Windows, next to set_environ.bat's
+    record, and $XDG_STATE_HOME/mipi/sync elsewhere
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    else:
+        base = os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state")
+    return os.path.join(base, "mipi", "sync")
+
+
+def default_envs_dirs() -> List[str]:
+    """
+    Where installed environments are looked for, in the order the published installers look: %MIPI_CONDA_ENVS_DIR%,
+    the envs next to conda, then the user's own conda installs
+    """
+    home = os.path.expanduser("~")
+    dirs = [os.environ.get("MIPI_CONDA_ENVS_DIR")]
+    if os.environ.get("CONDA_EXE"):
+        dirs.append(os.path.join(os.path.dirname(os.path.dirname(os.environ["CONDA_EXE"])), "envs"))
+    dirs += [os.path.join(home, ".conda", "envs"), os.path.join(home, "miniconda3", "envs"),
+             os.path.join(home, "anaconda3", "envs")]
+    return [d for d in dirs if d]
+
+
+@dataclass(frozen=True, slots=True)
+class Installed:
+    """
+    An environment found installed on this machine: its prefix, the stamp its last successful install recorded, if
+    any, and its python version, if conda-meta lists it
+    """
+    prefix: str
+    stamp: Optional[str]
+    py_version: Optional[str]
+
+    @classmethod
+    def find(cls, folder, envs_dirs: List[str]) -> Optional["Installed"]:
+        for envs_dir in envs_dirs:
+            prefix = os.path.join(envs_dir, folder)
+            if os.path.isdir(os.path.join(prefix, "conda-meta")):
+                return cls(prefix, _read_stamp(os.path.join(prefix, INSTALLED_STAMP)), _conda_python(prefix))
+        return None
+
+    def has_python(self, py_version) -> bool:
+        """
+        Whether the installed python is `py_version`, e.g. 3.12.4 is 3.12. True when it is not known, as the
+        installers check it again before reusing the environment
+        """
+        return self.py_version is None or f"{self.py_version}.".startswith(f"{py_version}.")
+
+
+def _read_stamp(path) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _conda_python(prefix) -> Optional[str]:
+    # conda-meta has a python-<version>-<build>.json record of the environment's python
+    for name in os.listdir(os.path.join(prefix, "conda-meta")):
+        match = re.match(r"python-(\d+(?:\.\d+)*)-.*\.json$", name)
+        if match:
+            return match.group(1)
+    return None
+
+
+@dataclass(frozen=True, slots=True)
+class SyncResult:
+    """
+    The outcome of installing one environment folder
+    """
+    folder: str
+    action: str
+    status: str
+    seconds: float
+    returncode: Optional[int]
+    log_path: str
+
+
+class EnvRunner(ABC):
+    """
+    The commands that create or update one published environment on this machine
+    """
+
+    @abstractmethod
+    def commands(self, folder, entry: dict, action) -> List[List[str]]:
+        """
+        Commands run in order from the environment's published folder. The install stops at the first one that fails
+        """
+        raise NotImplementedError  # pragma: no cover
+
+
+class BatRunner(EnvRunner):
+    """
+    Run the published create_env.bat or update_env.bat, as the master installers do. Their closing `pause` returns
+    straight away, since nothing is read from stdin
+    """
+
+    def commands(self, folder, entry: dict, action) -> List[List[str]]:
+        return [["cmd", "/c", f"{action}_env.bat"]]
+
+
+class CondaRunner(EnvRunner):
+    """
+    Install with conda and pip directly, for machines that cannot run the batch installers, e.g. Linux servers.
+    Installs the published requirements.txt, with the outpath's constraints.txt if the environment was published with
+    it, then records the stamp in the environment as the installers do; set_environ.bat is not applied
+    """
+
+    def __init__(self, conda_exe=None):
+        self.conda_exe = conda_exe or os.environ.get("CONDA_EXE") or "conda"
+
+    def commands(self, folder, entry: dict, action) -> List[List[str]]:
+        python = [self.conda_exe, "run", "--name", folder, "python"]
+        pip = python + ["-m", "pip", "install", "--upgrade", "-r", "requirements.txt"]
+        if entry.get("constraints"):
+            pip += ["-c", os.path.join("..", entry["constraints"])]
+        stamp = python + ["-c", "import os, shutil, sys; shutil.copy('stamp.txt', "
+                                f"os.path.join(sys.prefix, {INSTALLED_STAMP!r}))"]
+        if action == "update":
+            return [pip, stamp]
+        return [[self.conda_exe, "create", "--name", folder, "-y", f"python={entry['py_version']}", "pip"],
+                pip + ["--force-reinstall"], stamp]
+
+
+def default_runner() -> EnvRunner:
+    return BatRunner() if os.name == "nt" else CondaRunner()
+
+
+class SyncClient:
+    """
+    Keep a machine's environments up to date with a published outpath. Reads the outpath's manifest.json, compares
+    each environment's stamp with the one recorded inside the installed environment, in conda-meta, at its last
+    successful install, and only runs the installers of the environments that changed, `workers` at a time. The
+    installed environments are looked for in `envs_dirs`, like the installers look for them.
+
+    By default the environments in the master installers of `variant` are synced, like a master update; `envs` glob
+    patterns pick environment folders by name instead. An environment that is not installed here, or whose python
+    version changed, is created; otherwise it is updated. Whatever installed it, a master installer, the
+    environment's own installer or an earlier sync, an environment already at the published stamp is left alone.
+    """
+
+    def __init__(self, outpath, state_dir=None, workers=4, runner: EnvRunner = None, envs=(), variant="prod",
+                 envs_dirs: List[str] = None):
+        self.outpath = outpath
+        self.state_dir = state_dir or default_state_dir()
+        self.workers = workers
+        self.runner = runner or default_runner()
+        self.envs = tuple(envs)
+        self.variant = variant
+        self.envs_dirs = default_envs_dirs() if envs_dirs is None else list(envs_dirs)
+        self._lock = threading.Lock()
+
+    @property
+    def state_path(self):
+        return os.path.join(self.state_dir, STATE_FILE)
+
+    def manifest(self) -> Dict[str, dict]:
+        try:
+            with open(os.path.join(self.outpath, MANIFEST_FILE), "r") as f:
+                manifest = load_manifest(f.read())
+        except FileNotFoundError:
+            raise FileNotFoundError(f"{self.outpath} has no {MANIFEST_FILE}, it was not published by this version")
+        return manifest
+
+    def load_state(self) -> Dict[str, dict]:
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_state(self, state: dict):
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def selects(self, folder, entry: dict) -> bool:
+        if self.envs:
+            return any(fnmatch.fnmatchcase(folder, pattern) for pattern in self.envs)
+        return entry.get("variant") == self.variant and bool(entry.get("include_in_master"))
+
+    def plan(self) -> List[Tuple[str, dict, str]]:
+        """
+        The environment folders to install, with their manifest entry and whether to create or update them
+        """
+        planned = []
+        for folder, entry in sorted(self.manifest().items()):
+            if not self.selects(folder, entry):
+                continue
+            installed = Installed.find(folder, self.envs_dirs)
+            if installed is not None and installed.stamp == entry["stamp"]:
+                continue
+            update = installed is not None and installed.has_python(entry["py_version"])
+            planned.append((folder, entry, "update" if update else "create"))
+        return planned
+
+    def _run(self, folder, entry: dict, action) -> SyncResult:
+        log_path = os.path.join(self.state_dir, LOG_DIR, f"{folder}.log")
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        start = time.perf_counter()
+        returncode = None
+        with open(log_path, "w") as log:
+            try:
+                for command in self.runner.commands(folder, entry, action):
+                    log.write(f"> {' '.join(command)}\n")
+                    log.flush()
+                    returncode = subprocess.run(command, cwd=os.path.join(self.outpath, folder),
+                                                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT).returncode
+                    if returncode != 0:
+                        break
+            except OSError as e:
+                log.write(f"{e}\n")
+                returncode = None
+        status = "ok" if returncode == 0 else "failed"
+        return SyncResult(folder, action, status, time.perf_counter() - start, returncode, log_path)
+
+    def _record(self, result: SyncResult, entry: dict):
+        """
+        Save an environment's result as soon as it finishes, as a record of what this machine's syncs did. Which
+        environments are planned is taken from the environments themselves, not from this record
+        """
+        with self._lock:
+            state = self.load_state()
+            record = dict(state.get(result.folder, {}))
+            if result.status == "ok":
+                record.update(stamp=entry["stamp"], py_version=entry["py_version"])
+            record.update(action=result.action, status=result.status, seconds=round(result.seconds, 2),
+                          finished=time.strftime("%Y-%m-%dT%H:%M:%S"), log=result.log_path)
+            state[result.folder] = record
+            self._save_state(state)
+
+    def sync(self, dry_run=False) -> List[SyncResult]:
+        """
+        Install every changed environment, returning a result per environment in the order planned. With `dry_run`
+        nothing is run and each result has the status "planned"
+        """
+        planned = self.plan()
+        if dry_run:
+            return [SyncResult(folder, action, "planned", 0.0, None, "") for folder, _, action in planned]
+
+        def install(item):
+            folder, entry, action = item
+            result = self._run(folder, entry, action)
+            self._record(result, entry)
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            return list(executor.map(install, planned))
+
+
+def format_results(results: List[SyncResult]) -> str:
+    if not results:
+        return "every environment is up to date"
+    return "\n".join(f"{r.folder}: {r.action} {r.status}" + (f" in {r.seconds:.1f}s" if r.status != "planned" else "")
+                     + (f", see {r.log_path}" if r.status == "failed" else "") for r in results)
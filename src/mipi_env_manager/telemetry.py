@@ -0,0 +1,110 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+PERCENTILES = (50, 90, 99)
+
+
+class TimingRecord:
+    """
+    One line written by an installer: how long a step of installing an environment took on one machine.
+    Lines are `env,action,step,status,centiseconds,host`
+    """
+    __slots__ = ("env", "action", "step", "status", "seconds", "host")
+
+    def __init__(self, env, action, step, status, seconds, host):
+        self.env = env
+        self.action = action
+        self.step = step
+        self.status = status
+        self.seconds = seconds
+        self.host = host
+
+    @classmethod
+    def parse(cls, line) -> "TimingRecord":
+        """
+        Returns None for a malformed line, e.g. one cut short by a machine that lost the share mid write
+        """
+        fields = line.strip().split(",")
+        if len(fields) != 6 or not fields[4].isdigit():
+            return None
+        env, action, step, status, centiseconds, host = fields
+        return cls(env, action, step, status, int(centiseconds) / 100, host)
+
+
+def read_records(path) -> List[TimingRecord]:
+    try:
+        with open(path, errors="replace") as f:
+            return [r for r in map(TimingRecord.parse, f) if r is not None]
+    except OSError:
+        return []
+
+
+def iter_records(drop_dir, workers=16) -> Iterator[TimingRecord]:
+    """
+    Read every timing file in the drop directory. The drop directory is usually a network share holding thousands of
+    small files, so they are read in parallel
+    """
+    with os.scandir(drop_dir) as entries:
+        paths = [e.path for e in entries if e.is_file() and e.name.endswith(".csv")]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for records in executor.map(read_records, paths):
+            yield from records
+
+
+def percentile(sorted_values: List[float], pct) -> float:
+    """
+    Nearest rank percentile of already sorted values
+    """
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class TimingReport:
+    """
+    Durations grouped by (environment, action, step), summarised as count, failures and percentiles
+    """
+
+    def __init__(self):
+        self.durations: Dict[Tuple[str, str, str], List[float]] = {}
+        self.failures: Dict[Tuple[str, str, str], int] = {}
+
+    def add(self, records: Iterable[TimingRecord]) -> "TimingReport":
+        for record in records:
+            key = (record.env, record.action, record.step)
+            self.durations.setdefault(key, []).append(record.seconds)
+            if record.status == "fail":
+                self.failures[key] = self.failures.get(key, 0) + 1
+        return self
+
+    def rows(self, by_env=True) -> List[dict]:
+        """
+        One row per environment, action and step, or per action and step over all environments. Slowest p90 first
+        """
+        groups = {}
+        for (env, action, step), durations in self.durations.items():
+            key = (env if by_env else "*", action, step)
+            group = groups.setdefault(key, ([], [0]))
+            group[0].extend(durations)
+            group[1][0] += self.failures.get((env, action, step), 0)
+
+        rows = []
+        for (env, action, step), (durations, failures) in groups.items():
+            durations.sort()
+            row = {"env": env, "action": action, "step": step, "count": len(durations), "failures": failures[0],
+                   "max": durations[-1]}
+            row.update({f"p{p}": percentile(durations, p) for p in PERCENTILES})
+            rows.append(row)
+        return sorted(rows, key=lambda r: (-r["p90"], r["env"], r["action"], r["step"]))
+
+
+def format_rows(rows: List[dict]) -> str:
+    columns = ["env", "action", "step", "count", "failures"] + [f"p{p}" for p in PERCENTILES] + ["max"]
+
+    def cell(value):
+        return f"{value:.2f}" if isinstance(value, float) else str(value)
+
+    table = [columns] + [[cell(row[c]) for c in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    return "\n".join("  ".join(v.ljust(w) for v, w in zip(line, widths)).rstrip() for line in table)
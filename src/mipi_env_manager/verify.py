@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from mipi_env_manager.config import VerifySpec
+
+VERIFIED_FILE = "verified.json"
+# the end of a failed install's output kept in its result
+OUTPUT_TAIL = 2000
+
+
+@dataclass(frozen=True, slots=True)
+class SmokeResult:
+    """
+    The outcome of installing one environment's requirements in to a throwaway virtualenv. `status` is "ok",
+    "failed", or "cached" when the same requirements were verified by an earlier publish
+    """
+    environment: str
+    key: str
+    status: str
+    seconds: float = 0.0
+    output: str = ""
+
+
+class VerificationError(RuntimeError):
+    """
+    Some environments failed their smoke install, so the new generation was not published
+    """
+
+    def __init__(self, failed: List[SmokeResult]):
+        self.failed = failed
+        super().__init__(f"smoke install failed for {', '.join(r.environment for r in failed)}, nothing was "
+                         "published:\n" + "\n".join(f"{r.environment}:\n{r.output}" for r in failed))
+
+
+class SmokeInstaller:
+    """
+    The commands that create a virtualenv and install requirements in to it with pip, from the configured index
+    """
+
+    def __init__(self, settings: VerifySpec):
+        self.settings = settings
+
+    def python(self, py_version) -> Optional[str]:
+        return self.settings.python_for(py_version) or shutil.which(f"python{py_version}")
+
+    def commands(self, python, venv, requirements, constraints=None) -> List[List[str]]:
+        venv_python = os.path.join(venv, "Scripts" if os.name == "nt" else "bin", "python")
+        pip = [venv_python, "-m", "pip", "install", "--disable-pip-version-check", "--no-input", "-r", requirements]
+        if constraints is not None:
+            pip += ["-c", constraints]
+        if self.settings.index_url is not None:
+            pip += ["--index-url", self.settings.index_url]
+        return [[python, "-m", "venv", venv], pip]
+
+
+class Verifier:
+    """
+    Smoke install the requirements of the environments a publish built, `settings.workers` at a time, each in a
+    fresh virtualenv that is deleted afterwards. Successes are recorded in `cache_path` by a hash of the python
+    version, the requirements, the constraints and the index, so requirements that already installed with the same
+    constraints are never installed again.
+    Failures are not recorded, so they are retried by the next publish. Without a `cache_path` nothing is recorded.
+    """
+
+    def __init__(self, settings: VerifySpec, cache_path, installer: SmokeInstaller = None):
+        self.settings = settings
+        self.cache_path = cache_path
+        self.installer = installer or SmokeInstaller(settings)
+
+    def key(self, py_version, requirements, constraints=None) -> str:
+        constraints_sha256 = "" if constraints is None else hashlib.sha256(constraints.encode("utf-8")).hexdigest()
+        content = (f"py_version={py_version}\nindex_url={self.settings.index_url or ''}\n"
+                   f"constraints={constraints_sha256}\n{requirements}")
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def load_cache(self) -> Dict[str, dict]:
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_cache(self, cache: dict):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def _install(self, environment, py_version, requirements, constraints, key) -> SmokeResult:
+        start = time.perf_counter()
+        python = self.installer.python(py_version)
+        if python is None:
+            return SmokeResult(environment, key, "failed", 0.0,
+                               f"no python {py_version} on this host, set it in setup.verify.pythons")
+        with tempfile.TemporaryDirectory(prefix="mipi-verify-") as tmp:
+            requirements_path = os.path.join(tmp, "requirements.txt")
+            with open(requirements_path, "w") as f:
+                f.write(requirements)
+            constraints_path = None
+            if constraints is not None:
+                constraints_path = os.path.join(tmp, "constraints.txt")
+                with open(constraints_path, "w") as f:
+                    f.write(constraints)
+            output = []
+            for command in self.installer.commands(python, os.path.join(tmp, "venv"), requirements_path,
+                                                   constraints_path):
+                try:
+                    result = subprocess.run(command, cwd=tmp, stdin=subprocess.DEVNULL, capture_output=True,
+                                            text=True, timeout=self.settings.timeout)
+                except subprocess.TimeoutExpired:
+                    output.append(f"> {' '.join(command)}\ntimed out after {self.settings.timeout:g}s")
+                    break
+                except OSError as e:
+                    output.append(f"> {' '.join(command)}\n{e}")
+                    break
+                output.append(f"> {' '.join(command)}\n{result.stdout}{result.stderr}")
+                if result.returncode != 0:
+                    break
+            else:
+                return SmokeResult(environment, key, "ok", time.perf_counter() - start)
+        return SmokeResult(environment, key, "failed", time.perf_counter() - start,
+                           "".join(output)[-OUTPUT_TAIL:].strip())
+
+    def verify(self, environments: List[Tuple[str, str, str]], constraints: str = None) -> List[SmokeResult]:
+        """
+        Install each (environment, py_version, requirements) not verified before, returning a result per
+        environment in the order given
+        """
+        cache = self.load_cache()
+        results: Dict[int, SmokeResult] = {}
+        pending = []
+        for i, (environment, py_version, requirements) in enumerate(environments):
+            key = self.key(py_version, requirements, constraints)
+            if key in cache:
+                results[i] = SmokeResult(environment, key, "cached")
+            else:
+                pending.append((i, (environment, py_version, requirements, constraints, key)))
+
+        with ThreadPoolExecutor(max_workers=max(1, self.settings.workers)) as executor:
+            for (i, _), result in zip(pending, executor.map(lambda job: self._install(*job[1]), pending)):
+                results[i] = result
+
+        passed = {r.key: {"environment": r.environment, "verified": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                          "seconds": round(r.seconds, 2)} for r in results.values() if r.status == "ok"}
+        if passed and self.cache_path is not None:
+            self._save_cache({**cache, **passed})
+        return [results[i] for i in range(len(environments))]
+
+
+def format_smoke_results(results: List[SmokeResult]) -> str:
+    return "\n".join(f"verify {r.environment}: {r.status}" + (f" in {r.seconds:.1f}s" if r.status != "cached" else "")
+                     for r in results)
@@ -0,0 +1,202 @@
+import hashlib
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Set, Tuple
+
+from mipi_env_manager.config import EnvironmentIndex
+
+ENV_WEBHOOK_SECRET = "MIPI_WEBHOOK_SECRET"
+SIGNATURE_HEADER = "X-Hub-Signature-256"
+EVENT_HEADER = "X-GitHub-Event"
+# the release actions that can change which tag is the latest
+RELEASE_ACTIONS = ("published", "released", "unpublished", "deleted")
+# GitHub caps webhook payloads at 25 MB
+MAX_BODY = 25 * 2**20
+
+
+def verify_signature(secret: bytes, body: bytes, header) -> bool:
+    """
+    Check GitHub's `X-Hub-Signature-256: sha256=<hex hmac of the body>`, in constant time
+    """
+    if not header or not header.startswith("sha256="):
+        return False
+    expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(header[len("sha256="):], expected)
+
+
+class Coalescer:
+    """
+    Collects the repos of release events and publishes them together, once no event has arrived for `delay` seconds
+    or `max_delay` seconds after the first event of the batch, whichever is sooner. A burst of releases, e.g. a
+    monorepo tagging several packages, makes one publish. Publishes run one at a time on a worker thread, and events
+    that arrive during a publish make up the next batch.
+    """
+
+    def __init__(self, publish: Callable[[Set[str]], None], delay=30.0, max_delay=300.0):
+        self.publish = publish
+        self.delay = delay
+        self.max_delay = max_delay
+        self.batches = 0
+        self.failures = 0
+        self._pending = set()
+        self._first = self._last = 0.0
+        self._busy = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="mipi-republish", daemon=True)
+        self._thread.start()
+
+    def add(self, repo):
+        with self._cond:
+            now = time.monotonic()
+            if not self._pending:
+                self._first = now
+            self._last = now
+            self._pending.add(repo)
+            self._cond.notify_all()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if self._pending:
+                    wait = min(self._last + self.delay, self._first + self.max_delay) - time.monotonic()
+                    if wait <= 0 or self._stopped:
+                        break
+                    self._cond.wait(wait)
+                elif self._stopped:
+                    return None
+                else:
+                    self._cond.wait()
+            batch, self._pending = self._pending, set()
+            self._busy = True
+            return batch
+
+    def _run(self):
+        while (batch := self._next_batch()) is not None:
+            try:
+                self.publish(batch)
+            except Exception as e:
+                self.failures += 1
+                print(f"republishing {', '.join(sorted(batch))} failed: {e}")
+            with self._cond:
+                self.batches += 1
+                self._busy = False
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout=None) -> bool:
+        """
+        Wait until every event received has been published
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def close(self):
+        """
+        Publish anything pending straight away, then stop
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+class WebhookListener:
+    """
+    A small HTTP server for GitHub `release` webhooks. A signed release event of a repo that some environments use
+    queues a publish of just those environments; `publish` is called with the set of repo urls of each coalesced
+    batch. `index_loader` returns the EnvironmentIndex of the config, and is called again after each publish, so
+    config changes are picked up.
+    """
+
+    def __init__(self, secret, publish: Callable[[Set[str]], None], index_loader: Callable[[], EnvironmentIndex],
+                 host="127.0.0.1", port=8787, delay=30.0, max_delay=300.0, quiet=False):
+        self.secret = secret.encode("utf-8") if isinstance(secret, str) else secret
+        self.publish = publish
+        self.index_loader = index_loader
+        self.index = index_loader()
+        self.quiet = quiet
+        self.coalescer = Coalescer(self._publish_batch, delay, max_delay)
+        self.server = ThreadingHTTPServer((host, port), _WebhookHandler)
+        self.server.listener = self
+        self._thread = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.server.server_address[:2]
+
+    def _publish_batch(self, repos: Set[str]):
+        try:
+            self.publish(repos)
+        finally:
+            self.index = self.index_loader()
+
+    def handle(self, event, signature, body: bytes) -> Tuple[int, dict]:
+        """
+        The response status and json body for one delivery
+        """
+        if not verify_signature(self.secret, body, signature):
+            return 401, {"error": f"missing or invalid {SIGNATURE_HEADER}"}
+        if event == "ping":
+            return 200, {"ok": "pong"}
+        if event != "release":
+            return 200, {"ignored": f"{event} event"}
+        try:
+            payload = json.loads(body)
+            action = payload["action"]
+            repo = payload["repository"]["html_url"]
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": "not a release payload"}
+        if action not in RELEASE_ACTIONS:
+            return 200, {"ignored": f"{action} release"}
+        environments = self.index.for_repo(repo)
+        if not environments:
+            return 200, {"ignored": f"no environment uses {repo}"}
+        self.coalescer.add(repo)
+        return 202, {"queued": repo, "environments": sorted(environments)}
+
+    def start(self):
+        """
+        Serve on a background thread, e.g. in tests
+        """
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mipi-webhook", daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        """
+        Stop accepting events, then publish anything still pending
+        """
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+        self.server.server_close()
+        self.coalescer.close()
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            self._reply(413, {"error": "payload too large"})
+            return
+        body = self.rfile.read(length)
+        self._reply(*self.server.listener.handle(self.headers.get(EVENT_HEADER), self.headers.get(SIGNATURE_HEADER),
+                                                 body))
+
+    def _reply(self, status, reply: dict):
+        content = json.dumps(reply).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if not self.server.listener.quiet:
+            super().log_message(format, *args)
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from mipi_env_manager.main import YmlSetup, GHRequest
+
+TEST_CONFIG = Path(__file__).parent / "test_dependencies.yml"
+
+
+@pytest.fixture
+def use_config(monkeypatch, tmp_path):
+    """
+    A function that serves a raw config dict to every YmlSetup in place of the setup file, publishing to tmp_path,
+    and returns it. Tests change the config by editing the dict. MIPI_DEVOPS_PATH points at test_dependencies.yml
+    """
+    monkeypatch.setenv("MIPI_DEVOPS_PATH", str(TEST_CONFIG))
+
+    def use(config: dict) -> dict:
+        config["setup"]["outpath"] = str(tmp_path)
+        monkeypatch.setattr(YmlSetup, "get_config", lambda self: config)
+        return config
+
+    return use
+
+
+@pytest.fixture
+def config(use_config, monkeypatch):
+    """
+    test_dependencies.yml, publishing to tmp_path, with every github repo released up to v1.0.1. A test module that
+    needs more sets it up in its own `config` fixture, built on this one
+    """
+    with open(TEST_CONFIG, "r") as f:
+        config = use_config(yaml.safe_load(f))
+    monkeypatch.setattr(GHRequest, "get_repo_releases", lambda self: [{"tag_name": "v1.0.1"}])
+    return config
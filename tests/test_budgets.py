@@ -0,0 +1,83 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from mipi_env_manager.main import YmlSetup, GHRequest, GitMirrorRequest, PublishInstallers
+from mipi_env_manager.sinks import DiskSink, file_sha256
+
+BUDGETS = yaml.safe_load((Path(__file__).parent / "budgets.yml").read_text())
+
+
+class CountingSink(DiskSink):
+    """
+    A disk sink that records which files each publish actually created or replaced
+    """
+
+    def __init__(self):
+        super().__init__(quiet=True)
+        self.written = []
+
+    def _write(self, path, chunks):
+        before = file_sha256(path)
+        artifact = super()._write(path, chunks)
+        if artifact.sha256 != before:
+            self.written.append(path)
+        return artifact
+
+
+@pytest.fixture
+def release_fetches(monkeypatch):
+    """
+    Count every call in to the RepoRequest layer, answering them without the network
+    """
+    calls = []
+
+    def counted(self):
+        calls.append(type(self).__name__)
+        return [{"tag_name": "v1.0.0"}, {"tag_name": "v1.0.1"}]
+
+    monkeypatch.setattr(GHRequest, "get_repo_releases", counted)
+    monkeypatch.setattr(GitMirrorRequest, "get_repo_releases", counted)
+    return calls
+
+
+def generate_config(environments, packages, repos) -> dict:
+    envs = {}
+    for e in range(environments):
+        pkgs = {}
+        for p in range(packages):
+            if p % 3 == 2:
+                pkgs[f"pypi_{p}"] = {"source": "pypi", "version": "1.0.0"}
+            else:
+                pkgs[f"gh_{p}"] = {"source": "github", "path": f"https://github.com/org/repo{p % repos}",
+                                   "version": "1.0", "version_policy": "compatible"}
+        envs[f"env{e}"] = {"setup": {"py_version": "3.12", "include_in_master": e % 2 == 0}, "packages": pkgs}
+    return {"environments": envs, "setup": {"outpath": None, "environment_variables": {"key": "val"}}}
+
+
+def load_config(budget) -> dict:
+    if "generate" in budget:
+        return generate_config(**budget["generate"])
+    return yaml.safe_load((Path(__file__).parent / budget["config"]).read_text())
+
+
+@pytest.mark.parametrize("name", sorted(BUDGETS))
+def test_publish_within_budget(name, release_fetches, use_config):
+    budget = BUDGETS[name]
+    use_config(load_config(budget))
+
+    def publish():
+        sink = CountingSink()
+        PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), budget["test"], budget["prod"], budget["master"],
+                          sink=sink).publish()
+        return sink
+
+    first = publish()
+    assert len(release_fetches) <= budget["release_fetches"], f"{name}: release fetches over budget"
+    assert len(first.written) <= budget["files_written"], f"{name}: files written over budget"
+
+    del release_fetches[:]
+    second = publish()
+    assert len(second.written) <= budget["rerun_files_written"], f"{name}: unchanged publish rewrote {second.written}"
+    assert len(release_fetches) <= budget["release_fetches"]
@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import pytest
+
+from mipi_env_manager.bundles import BundleError, extract_bundle, load_index
+from mipi_env_manager.main import YmlSetup, PublishInstallers, preview
+
+
+@pytest.fixture
+def config(config, tmp_path):
+    config["setup"]["outpath"] = str(tmp_path / "out")
+    return config
+
+
+def publish(config, **kwargs):
+    """
+    Publish with bundles and return the index
+    """
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True, bundles=True, **kwargs).publish()
+    return load_index((Path(config["setup"]["outpath"]) / "bundles" / "index.json").read_text())
+
+
+def test_one_bundle_per_environment(config, tmp_path):
+    index = publish(config)
+
+    assert sorted(index) == ["myenv", "myenv2", "myenv2_test", "myenv_test"]
+    entry = index["myenv"]
+    assert sorted(entry["files"]) == ["constraints.txt", "environment_variables.txt", "myenv/create_env.bat",
+                                      "myenv/requirements.txt", "myenv/stamp.txt", "myenv/update_env.bat",
+                                      "reconcile.py", "set_environ.bat"]
+    data = (tmp_path / "out" / "bundles" / entry["bundle"]).read_bytes()
+    extract_bundle(data, entry, tmp_path / "client")
+    assert ((tmp_path / "client" / "myenv" / "requirements.txt").read_text()
+            == (tmp_path / "out" / "myenv" / "requirements.txt").read_text())
+
+
+def test_bundle_only_changes_with_its_contents(config, tmp_path):
+    before = publish(config)
+    mtime = (tmp_path / "out" / "bundles" / before["myenv"]["bundle"]).stat().st_mtime_ns
+
+    config["environments"]["myenv2"]["setup"]["py_version"] = "3.11"
+    after = publish(config)
+    assert after["myenv"] == before["myenv"]
+    assert (tmp_path / "out" / "bundles" / after["myenv"]["bundle"]).stat().st_mtime_ns == mtime
+    assert after["myenv2"]["bundle"] != before["myenv2"]["bundle"]
+    # the bundle the index no longer lists is removed
+    assert sorted(p.name for p in (tmp_path / "out" / "bundles").iterdir()) == \
+        sorted(["index.json"] + [entry["bundle"] for entry in after.values()])
+
+
+def test_partial_publish_keeps_other_bundles(config):
+    before = publish(config)
+    after = publish(config, envs=["myenv"])
+    assert after == before
+
+    del config["environments"]["myenv2"]
+    assert sorted(publish(config, envs=["myenv"])) == ["myenv", "myenv_test"]
+
+
+def test_bundle_is_verified(config, tmp_path):
+    entry = publish(config)["myenv"]
+    data = (tmp_path / "out" / "bundles" / entry["bundle"]).read_bytes()
+    with pytest.raises(BundleError):
+        extract_bundle(data[:-1] + b"x", entry, tmp_path / "client")
+    assert not (tmp_path / "client").exists()
+
+
+def test_bundles_are_optional(config):
+    assert not any(key.startswith("bundles/") for key in preview(YmlSetup("MIPI_DEVOPS_PATH")))
+    with pytest.raises(ValueError):
+        PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True, shard=(1, 2), bundles=True)
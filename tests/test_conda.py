@@ -0,0 +1,193 @@
+import hashlib
+import json
+import subprocess
+
+import pytest
+
+from mipi_env_manager.conda import (ChannelError, CondaCliSolver, CondaSolveError, CondaSolver, LocalChannel,
+                                    PackageFetcher, explicit_spec_lines)
+from mipi_env_manager.config import CondaLockSpec
+from mipi_env_manager.main import YmlSetup, PublishInstallers, merge_shards
+from mipi_env_manager.sinks import DiskSink
+
+
+def record(name, version):
+    return {"name": name, "version": version, "md5": f"md5-{name}",
+            "url": f"https://repo.anaconda.com/pkgs/main/win-64/{name}-{version}-0.conda"}
+
+
+class FakeSolver(CondaSolver):
+
+    def __init__(self):
+        self.calls = []
+
+    def solve(self, py_version):
+        self.calls.append(py_version)
+        return [record("python", py_version), record("pip", "24.0")]
+
+
+@pytest.fixture
+def config(config):
+    config["setup"]["conda_lock"] = True
+    return config
+
+
+def test_explicit_spec_lines():
+    lines = explicit_spec_lines([record("python", "3.12")], "win-64")
+    assert lines == ["# platform: win-64", "@EXPLICIT",
+                     "https://repo.anaconda.com/pkgs/main/win-64/python-3.12-0.conda#md5-python"]
+
+
+def test_spec_solved_once_per_py_version(config, tmp_path):
+    solver = FakeSolver()
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, False, conda_solver=solver).publish()
+
+    # myenv and myenv2, test and prod, all share python 3.12
+    assert solver.calls == ["3.12"]
+    spec = (tmp_path / "conda_specs" / "python-3.12-win-64.txt").read_text().splitlines()
+    assert spec[1] == "@EXPLICIT"
+    assert len(spec) == 4
+
+    create = (tmp_path / "myenv" / "create_env.bat").read_text()
+    assert '--file "%~dp0..\\conda_specs\\python-3.12-win-64.txt"' in create
+    assert "python=3.12 pip" not in create
+
+
+def test_no_spec_without_conda_lock(config, tmp_path):
+    config["setup"]["conda_lock"] = False
+    solver = FakeSolver()
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, False, conda_solver=solver).publish()
+    assert solver.calls == []
+    assert "python=3.12 pip" in (tmp_path / "myenv" / "create_env.bat").read_text()
+
+
+def test_cli_solver_orders_records_by_link(monkeypatch):
+    output = {"success": True, "actions": {
+        "FETCH": [record("pip", "24.0"), record("python", "3.12")],
+        "LINK": [{"name": "python"}, {"name": "pip"}],
+    }}
+    seen = {}
+
+    def run(command, env, **kwargs):
+        seen.update(command=command, env=env)
+        return subprocess.CompletedProcess(command, 0, json.dumps(output), "")
+
+    monkeypatch.setattr(subprocess, "run", run)
+    solver = CondaCliSolver(CondaLockSpec(True, channels=("conda-forge",)))
+    assert [r["name"] for r in solver.solve("3.12")] == ["python", "pip"]
+    assert seen["env"]["CONDA_SUBDIR"] == "win-64"
+    assert "--override-channels" in seen["command"]
+
+
+def test_cli_solver_reports_failure(monkeypatch):
+    output = {"success": False, "message": "nothing provides python 9.9"}
+    monkeypatch.setattr(subprocess, "run",
+                        lambda command, **kwargs: subprocess.CompletedProcess(command, 1, json.dumps(output), ""))
+    with pytest.raises(CondaSolveError, match="nothing provides"):
+        CondaCliSolver(CondaLockSpec(True)).solve("9.9")
+
+
+class FakeFetcher(PackageFetcher):
+
+    def __init__(self):
+        self.urls = []
+
+    def fetch(self, url):
+        self.urls.append(url)
+        return url.encode("utf-8")
+
+
+class ChannelSolver(CondaSolver):
+    """
+    Records whose md5 matches what FakeFetcher downloads. pip is noarch and shared by every python version
+    """
+
+    def solve(self, py_version):
+        return [channel_record("python", py_version, "win-64"), channel_record("pip", "24.0", "noarch")]
+
+
+def channel_record(name, version, subdir):
+    url = f"https://repo.anaconda.com/pkgs/main/{subdir}/{name}-{version}-0.conda"
+    return {"name": name, "version": version, "build": "0", "build_number": 0, "depends": [], "subdir": subdir,
+            "url": url, "md5": hashlib.md5(url.encode("utf-8")).hexdigest()}
+
+
+def read_repodata(tmp_path, subdir):
+    return json.loads((tmp_path / "conda_channel" / subdir / "repodata.json").read_text())
+
+
+def test_local_channel_creates_offline(config, tmp_path):
+    config["setup"]["conda_lock"] = {"local_channel": True}
+    fetcher = FakeFetcher()
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, False, conda_solver=ChannelSolver(),
+                      package_fetcher=fetcher).publish()
+
+    assert sorted(fetcher.urls) == [channel_record("pip", "24.0", "noarch")["url"],
+                                    channel_record("python", "3.12", "win-64")["url"]]
+    python = channel_record("python", "3.12", "win-64")["url"]
+    assert (tmp_path / "conda_channel" / "win-64" / "python-3.12-0.conda").read_bytes() == python.encode("utf-8")
+    assert list(read_repodata(tmp_path, "win-64")["packages.conda"]) == ["python-3.12-0.conda"]
+    assert read_repodata(tmp_path, "noarch")["packages.conda"]["pip-24.0-0.conda"]["subdir"] == "noarch"
+    spec = (tmp_path / "conda_specs" / "python-3.12-win-64.txt").read_text().splitlines()
+    assert spec == ["# platform: win-64", "@EXPLICIT",
+                    f"win-64/python-3.12-0.conda#{channel_record('python', '3.12', 'win-64')['md5']}",
+                    f"noarch/pip-24.0-0.conda#{channel_record('pip', '24.0', 'noarch')['md5']}"]
+
+    create = (tmp_path / "myenv" / "create_env.bat").read_text()
+    # the spec's lines are made in to file urls of the channel, so conda runs no solver
+    assert '("%~dp0..\\conda_specs\\python-3.12-win-64.txt")' in create
+    assert "echo %MIPI_CONDA_CHANNEL_URL%/%%L" in create
+    assert 'conda create --name myenv -y --offline --file "%MIPI_CONDA_SPEC%"' in create
+    assert "--channel" not in create
+
+
+def test_local_channel_only_adds_new_packages(config, tmp_path):
+    config["setup"]["conda_lock"] = {"local_channel": True}
+
+    def publish(**kwargs):
+        fetcher = FakeFetcher()
+        PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, False, conda_solver=ChannelSolver(),
+                          package_fetcher=fetcher, **kwargs).publish()
+        return fetcher.urls
+
+    publish()
+    config["environments"]["myenv2"]["setup"]["py_version"] = "3.11"
+    # pip is already in the channel
+    assert publish() == [channel_record("python", "3.11", "win-64")["url"]]
+    assert sorted(read_repodata(tmp_path, "win-64")["packages.conda"]) == ["python-3.11-0.conda",
+                                                                           "python-3.12-0.conda"]
+
+    # a selective publish keeps the packages of the environments it did not build
+    config["environments"]["myenv"]["setup"]["py_version"] = "3.11"
+    assert publish(envs=["myenv"]) == []
+    assert (tmp_path / "conda_channel" / "win-64" / "python-3.12-0.conda").exists()
+
+    # a full publish prunes the channel to what it solved
+    publish()
+    assert sorted(read_repodata(tmp_path, "win-64")["packages.conda"]) == ["python-3.11-0.conda"]
+    assert sorted(p.name for p in (tmp_path / "conda_channel" / "win-64").iterdir()) == ["python-3.11-0.conda",
+                                                                                         "repodata.json"]
+    assert list(read_repodata(tmp_path, "noarch")["packages.conda"]) == ["pip-24.0-0.conda"]
+
+
+def test_local_channel_rejects_corrupt_package(tmp_path):
+    record = dict(channel_record("python", "3.12", "win-64"), md5="0" * 32)
+    with pytest.raises(ChannelError, match="does not match its md5"):
+        LocalChannel(str(tmp_path), DiskSink(quiet=True), "win-64", FakeFetcher()).add([record])
+    assert not (tmp_path / "conda_channel" / "win-64" / "python-3.12-0.conda").exists()
+
+
+def test_merge_builds_local_channel_of_every_shard(config, tmp_path):
+    config["setup"]["conda_lock"] = {"local_channel": True}
+    for index in (1, 2):
+        PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, True, shard=(index, 2),
+                          conda_solver=ChannelSolver(), package_fetcher=FakeFetcher()).publish()
+    assert not (tmp_path / "conda_channel").exists()
+    (tmp_path / "conda_channel" / "win-64").mkdir(parents=True)
+    (tmp_path / "conda_channel" / "win-64" / "python-3.10-0.conda").write_text("solved for by an earlier publish")
+    fetcher = FakeFetcher()
+    merge_shards(str(tmp_path), package_fetcher=fetcher)
+    assert len(fetcher.urls) == 2
+    assert "python-3.12-0.conda" in read_repodata(tmp_path, "win-64")["packages.conda"]
+    # between them the shards built every environment, so the channel holds only what they solved
+    assert not (tmp_path / "conda_channel" / "win-64" / "python-3.10-0.conda").exists()
@@ -0,0 +1,69 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from mipi_env_manager.config import Config, ConfigError, PackageSpec
+
+
+@pytest.fixture
+def raw_config():
+    with open(Path(__file__).parent / "test_dependencies.yml", "r") as f:
+        return yaml.safe_load(f)
+
+
+def test_from_dict(raw_config):
+    config = Config.from_dict(raw_config)
+    assert list(config.environments) == ["myenv", "myenv2"]
+    env = config.environments["myenv"]
+    assert env.py_version == "3.12"
+    assert env.include_in_master is True
+    assert env.packages[3] == PackageSpec("my_pkg4", "github", "1.0.0", "compatible", "https://github.com/psf/requests")
+    assert dict(config.setup.environment_variables) == {"env_key": "env_val"}
+
+
+def test_model_is_immutable(raw_config):
+    config = Config.from_dict(raw_config)
+    with pytest.raises(AttributeError):
+        config.environments["myenv"].py_version = "3.11"
+    with pytest.raises(TypeError):
+        config.environments["other"] = None
+
+
+def test_repeated_strings_are_shared(raw_config):
+    config = Config.from_dict(raw_config)
+    paths = [p.path for env in config.environments.values() for p in env.packages if p.source == "github"]
+    assert len({id(p) for p in paths}) == 1
+
+
+def test_fingerprint_ignores_key_order(raw_config):
+    reordered = {"setup": raw_config["setup"], "environments": raw_config["environments"]}
+    assert Config.from_dict(reordered).fingerprint == Config.from_dict(raw_config).fingerprint
+
+
+def test_reports_every_error_at_once(raw_config):
+    raw_config["environments"]["myenv"]["packages"]["my_pkg"]["source"] = "conda"
+    raw_config["environments"]["myenv"]["packages"]["my_pkg2"]["version_policy"] = "newest"
+    del raw_config["environments"]["myenv2"]["packages"]["my_pkg"]["path"]
+    del raw_config["environments"]["myenv2"]["setup"]["include_in_master"]
+
+    with pytest.raises(ConfigError) as e:
+        Config.from_dict(raw_config)
+    assert e.value.errors == [
+        "environments.myenv.packages.my_pkg.source: must be one of github, pypi, got 'conda'",
+        "environments.myenv.packages.my_pkg2.version_policy: must be one of exact, compatible, got 'newest'",
+        "environments.myenv2.setup.include_in_master: must be true or false",
+        "environments.myenv2.packages.my_pkg.path: required for github packages",
+    ]
+
+
+def test_outpath_list(raw_config):
+    raw_config["setup"]["outpath"] = ["//emea/envs", "//amer/envs"]
+    setup = Config.from_dict(raw_config).setup
+    assert setup.outpath == "//emea/envs"
+    assert setup.outpaths == ("//emea/envs", "//amer/envs")
+
+    raw_config["setup"]["outpath"] = ["//emea/envs", "//emea/envs"]
+    with pytest.raises(ConfigError) as e:
+        Config.from_dict(raw_config)
+    assert e.value.errors == ["setup.outpath: listed more than once: //emea/envs"]
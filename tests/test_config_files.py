@@ -0,0 +1,150 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager import config_files
+from mipi_env_manager.config import ConfigError
+from mipi_env_manager.config_files import ConfigFiles, changed_environments, fingerprint_record
+from mipi_env_manager.main import YmlSetup, GHRequest, main
+from mipi_env_manager.metrics import METRICS
+
+
+def env_yaml(*names, py_version="3.12"):
+    lines = ["environments:"]
+    for name in names:
+        lines += [f"  {name}:", "    setup:", f"      py_version: {py_version}", "      include_in_master: true",
+                  "    packages:", "      requests:", "        source: pypi"]
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    root = tmp_path / "config"
+    (root / "team_a").mkdir(parents=True)
+    (root / "team_b").mkdir()
+    (root / "setup.yml").write_text(f"setup:\n  outpath: {tmp_path / 'out'}\n  environment_variables: {{}}\n")
+    (root / "team_a" / "lab.yml").write_text(env_yaml("lab", "lab2"))
+    (root / "team_b" / "web.yaml").write_text(env_yaml("web"))
+    monkeypatch.setenv("MIPI_DEVOPS_PATH", str(root))
+    monkeypatch.setattr(GHRequest, "get_repo_releases", lambda self: [{"tag_name": "v1.0.1"}])
+    return root
+
+
+def test_load_folder(config_dir):
+    config = YmlSetup("MIPI_DEVOPS_PATH").load_config()
+    assert sorted(config.environments) == ["lab", "lab2", "web"]
+    assert [(f.key, f.environments) for f in config.files] == [
+        ("setup.yml", ()), ("team_a/lab.yml", ("lab", "lab2")), ("team_b/web.yaml", ("web",))]
+
+
+def test_load_include(tmp_path, monkeypatch):
+    (tmp_path / "envs").mkdir()
+    (tmp_path / "envs" / "a.yml").write_text(env_yaml("a"))
+    (tmp_path / "envs" / "b.yml").write_text(env_yaml("b"))
+    (tmp_path / "root.yml").write_text("include:\n  - envs/*.yml\nsetup:\n  outpath: null\n" + env_yaml("root_env"))
+    monkeypatch.setenv("MIPI_DEVOPS_PATH", str(tmp_path / "root.yml"))
+
+    setup = YmlSetup("MIPI_DEVOPS_PATH")
+    assert sorted(setup.load_config().environments) == ["a", "b", "root_env"]
+    assert sorted(setup.get_config()["environments"]) == ["a", "b", "root_env"]
+    assert sorted(e.name for e in setup.iter_environments()) == ["a", "b", "root_env"]
+
+
+def test_cross_file_errors_reported_together(config_dir):
+    (config_dir / "team_b" / "web.yaml").write_text(env_yaml("web", "lab"))
+    (config_dir / "team_b" / "bad.yml").write_text("setup:\n  outpath: x\n" + env_yaml("bad").replace("3.12", "null"))
+    with pytest.raises(ConfigError) as e:
+        YmlSetup("MIPI_DEVOPS_PATH").load_config()
+    assert e.value.errors == [
+        "team_b/bad.yml: setup: only allowed in the root file",
+        "team_b/bad.yml: environments.bad.setup.py_version: required",
+        "team_b/web.yaml: environments.lab: already defined in team_a/lab.yml",
+    ]
+
+
+def test_stream_detects_duplicates(config_dir):
+    (config_dir / "team_b" / "web.yaml").write_text(env_yaml("lab"))
+    with pytest.raises(ConfigError, match="already defined in team_a/lab.yml"):
+        list(YmlSetup("MIPI_DEVOPS_PATH").iter_environments())
+
+
+def test_only_changed_files_are_parsed(config_dir, monkeypatch):
+    ConfigFiles(config_dir, workers=1).load()
+    parsed = []
+    parse = config_files._parse_file
+    monkeypatch.setattr(config_files, "_parse_file", lambda path: parsed.append(path.name) or parse(path))
+
+    ConfigFiles(config_dir, workers=1).load()
+    assert parsed == ["setup.yml"]
+
+    (config_dir / "team_b" / "web.yaml").write_text(env_yaml("web", py_version="3.11"))
+    del parsed[:]
+    config = ConfigFiles(config_dir, workers=1).load()
+    assert parsed == ["setup.yml", "web.yaml"]
+    assert config.environments["web"].py_version == "3.11"
+
+
+def test_parallel_parse(config_dir):
+    for i in range(4):
+        (config_dir / "team_a" / f"extra{i}.yml").write_text(env_yaml(f"extra{i}"))
+    config = ConfigFiles(config_dir, workers=2).load(use_cache=False)
+    assert len(config.environments) == 7
+
+
+def test_changed_environments(config_dir):
+    before = ConfigFiles(config_dir).load()
+    record = json.loads(json.dumps(fingerprint_record(before)))
+    assert changed_environments(before, None) is None
+    assert changed_environments(before, record) == set()
+
+    (config_dir / "team_a" / "lab.yml").write_text(env_yaml("lab", "lab2", py_version="3.11"))
+    (config_dir / "team_a" / "new.yml").write_text(env_yaml("new"))
+    assert changed_environments(ConfigFiles(config_dir).load(), record) == {"lab", "lab2", "new"}
+
+    (config_dir / "setup.yml").write_text((config_dir / "setup.yml").read_text() + "  installer: uv\n")
+    assert changed_environments(ConfigFiles(config_dir).load(), record) is None
+
+
+def test_publish_changed_only(config_dir):
+    runner = CliRunner()
+    runner.invoke(main, args=["--prod", "--master"], catch_exceptions=False)
+    assert METRICS.get("environments_total", status="rebuilt") == 3
+
+    runner.invoke(main, args=["--prod", "--master", "--changed"], catch_exceptions=False)
+    assert METRICS.get("environments_total", status="rebuilt") == 0
+
+    (config_dir / "team_b" / "web.yaml").write_text(env_yaml("web", py_version="3.11"))
+    runner.invoke(main, args=["--prod", "--master", "--changed"], catch_exceptions=False)
+    assert METRICS.get("environments_total", status="rebuilt") == 1
+    out = config_dir.parent / "out"
+    assert "python=3.11" in (out / "web" / "create_env.bat").read_text()
+    # the masters are still rebuilt with every environment
+    assert "lab2\\update_env.bat" in (out / "master_update_envs.bat").read_text()
+
+
+def test_has_include_checks_top_level_keys_once(tmp_path, monkeypatch):
+    path = tmp_path / "setup.yml"
+    path.write_text("setup:\n  outpath: null\n  include: x\n" + env_yaml("a"))
+    assert not config_files.has_include(path)
+
+    monkeypatch.setenv("MIPI_DEVOPS_PATH", str(path))
+    checked = []
+    monkeypatch.setattr("mipi_env_manager.main.has_include", lambda p: checked.append(p) or False)
+    setup = YmlSetup("MIPI_DEVOPS_PATH")
+    setup.get_setup_spec()
+    list(setup.iter_environments())
+    assert checked == [str(path)]
+
+
+def test_preview_leaves_config_cache_alone(config_dir):
+    from mipi_env_manager.main import preview
+    preview(YmlSetup("MIPI_DEVOPS_PATH"), record_history=False)
+    assert not (config_dir.parent / "out" / ".mipi" / config_files.CACHE_FILE).exists()
+
+
+def test_yaml_dates_are_not_cached(config_dir):
+    (config_dir / "team_b" / "web.yaml").write_text(env_yaml("web") + "reviewed: 2024-05-01\n")
+    ConfigFiles(config_dir, workers=1).load()
+    cache = json.loads((config_dir.parent / "out" / ".mipi" / config_files.CACHE_FILE).read_text())
+    assert sorted(cache) == ["team_a/lab.yml"]
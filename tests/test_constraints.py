@@ -0,0 +1,109 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.constraints import Constraints, constraints_by_package, constraints_sha256, merge_pins
+from mipi_env_manager.main import YmlSetup, PublishInstallers, PipInstaller, main, merge_shards
+
+
+@pytest.mark.parametrize("pins, expected", [
+    ({"==1.4.2": ["a", "b"]}, "numpy==1.4.2"),
+    ({"==1.4.2": ["a"], "~=1.4.0": ["b"], "": ["c"]}, "numpy==1.4.2"),
+    ({"~=1.4.0": ["a"], "": ["b"]}, "numpy~=1.4.0"),
+    ({"": ["a"]}, None),
+    ({"@ git+https://github.com/org/numpy.git": ["a"], "": ["b"]}, None),
+])
+def test_merge_pins(pins, expected):
+    assert merge_pins("numpy", pins) == (expected, None)
+
+
+@pytest.mark.parametrize("pins", [
+    {"==1.4.2": ["a"], "==2.0.0": ["b"]},
+    {"==1.3.0": ["a"], "~=1.4.0": ["b"]},
+    {"~=1.4.0": ["a"], ">=1.5": ["b"]},
+    {"@ git+https://github.com/org/numpy.git": ["a"], "==1.4.2": ["b"]},
+    {"@ git+https://github.com/org/numpy.git": ["a"], "@ git+https://github.com/fork/numpy.git": ["b"]},
+])
+def test_merge_pins_conflicts(pins):
+    line, conflict = merge_pins("numpy", pins)
+    assert line is None
+    assert sorted(pin for pin, _ in conflict.pins) == sorted(pins)
+
+
+def test_constraints_compare_canonical_names():
+    with Constraints() as constraints:
+        constraints.add("a", ["Scikit_Learn==1.5.0", "pandas==2.2.0", "tool @ git+https://github.com/org/tool.git"])
+        constraints.add("b", ["scikit-learn~=1.5.0", "pandas==2.1.0", "requests"])
+        lines, conflicts = constraints.render()
+    assert lines[-1:] == ["scikit-learn==1.5.0"]
+    assert [c.describe() for c in conflicts] == ["pandas: ==2.1.0 (b); ==2.2.0 (a)"]
+    assert "#   pandas: ==2.1.0 (b); ==2.2.0 (a)" in lines
+
+
+def test_installers_use_constraints(config, tmp_path):
+    config["environments"]["myenv2"]["packages"]["my_pkg7"] = {"source": "pypi", "version": "2.0.0",
+                                                               "version_policy": "exact"}
+    result = CliRunner().invoke(main, args=["--prod", "--test", "--master"], catch_exceptions=False)
+
+    lines = (tmp_path / "constraints.txt").read_text().splitlines()
+    assert [line for line in lines if not line.startswith("#")] == ["my-pkg6==1.0.0", "my-pkg8~=1.0.0"]
+    assert "#   my-pkg7: ==1.0.0 (myenv); ==2.0.0 (myenv2)" in lines
+    assert "warning: my-pkg7: ==1.0.0 (myenv); ==2.0.0 (myenv2), left out of constraints.txt" in result.output
+    for folder in ("myenv", "myenv2_test"):
+        assert '-r requirements.txt -c "..\\constraints.txt" --force-reinstall' in \
+            (tmp_path / folder / "create_env.bat").read_text()
+        assert '-r requirements.txt -c "..\\constraints.txt"\n' in (tmp_path / folder / "update_env.bat").read_text()
+    assert PipInstaller().install_commands("env", False) == ["python -m pip install --upgrade -r requirements.txt"]
+
+
+def test_selective_publish_writes_constraints_of_every_environment(config, tmp_path):
+    config["environments"]["myenv2"]["packages"]["numpy"] = {"source": "pypi", "version": "1.26.4"}
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, False, envs=["myenv"]).publish()
+    assert "numpy==1.26.4" in (tmp_path / "constraints.txt").read_text().splitlines()
+    assert not (tmp_path / "myenv2").exists()
+
+
+def test_constraints_change_the_stamp_of_the_environments_they_apply_to(config, tmp_path):
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, False).publish()
+    before = (tmp_path / "myenv" / "stamp.txt").read_text()
+    requirements = (tmp_path / "myenv" / "requirements.txt").read_text()
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+
+    # a constraint on a package myenv does not pin leaves its stamp alone
+    config["environments"]["myenv2"]["packages"]["numpy"] = {"source": "pypi", "version": "1.26.4"}
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, False).publish()
+    assert "numpy==1.26.4" in (tmp_path / "constraints.txt").read_text().splitlines()
+    assert (tmp_path / "myenv" / "stamp.txt").read_text() == before
+
+    # only myenv2 changes, but the constraint on my-pkg6, which myenv installs with, is dropped as a conflict
+    config["environments"]["myenv2"]["packages"]["my_pkg6"] = {"source": "pypi", "version": "2.0.0",
+                                                               "version_policy": "exact"}
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, False).publish()
+    assert (tmp_path / "myenv" / "requirements.txt").read_text() == requirements
+    after = (tmp_path / "myenv" / "stamp.txt").read_text()
+    assert after != before
+    assert manifest["environments"]["myenv"]["stamp"] == before
+    assert json.loads((tmp_path / "manifest.json").read_text())["environments"]["myenv"]["stamp"] == after
+
+
+def test_constraints_sha256_of_an_environments_packages():
+    by_package = constraints_by_package(["# a comment", "my-pkg6==1.0.0", "numpy==1.26.4"])
+    assert by_package == {"my-pkg6": "my-pkg6==1.0.0", "numpy": "numpy==1.26.4"}
+    assert constraints_sha256(by_package, ["My_Pkg6", "requests"]) == constraints_sha256(by_package, ["my-pkg6"])
+    assert constraints_sha256(by_package, ["my-pkg6"]) != constraints_sha256(by_package, ["my-pkg6", "numpy"])
+
+
+def test_shards_merge_constraints(config, tmp_path):
+    for index in (1, 2):
+        PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, True, shard=(index, 2)).publish()
+    assert not (tmp_path / "constraints.txt").exists()
+    merge_shards(str(tmp_path))
+    assert "my-pkg6==1.0.0" in (tmp_path / "constraints.txt").read_text()
+
+
+def test_constraints_can_be_turned_off(config, tmp_path):
+    config["setup"]["constraints"] = False
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, False).publish()
+    assert not (tmp_path / "constraints.txt").exists()
+    assert "-c " not in (tmp_path / "myenv" / "update_env.bat").read_text()
@@ -0,0 +1,45 @@
+import hashlib
+
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.main import SetEnvironBat, main
+
+
+@pytest.fixture
+def config(config):
+    config["setup"]["environment_variables"]["OTHER"] = "a=b"
+    return config
+
+
+def test_manifest_is_hashed(tmp_path):
+    SetEnvironBat(tmp_path).create(environment_variables={"A": "1", "B": "x=y"})
+    manifest = (tmp_path / "environment_variables.txt").read_text()
+    assert manifest == "A=1\nB=x=y"
+    expected = hashlib.sha256(manifest.encode()).hexdigest()
+    assert f'set "MIPI_ENVVARS_HASH={expected}"' in (tmp_path / "set_environ.bat").read_text()
+
+
+def test_set_environ_only_sets_changed_values(tmp_path):
+    SetEnvironBat(tmp_path).create(environment_variables={"A": "1"})
+    text = (tmp_path / "set_environ.bat").read_text()
+    assert text.count(" SETX %1 %2") == 1
+    assert 'if not "%MIPI_ENVVAR_CURRENT%"=="%~2" SETX %1 %2' in text
+    assert 'if "%MIPI_ENVVARS_APPLIED%"=="%MIPI_ENVVARS_HASH%" goto :eof' in text
+    # nothing recorded on the machine skips the registry comparison
+    assert "LOCALAPPDATA" not in text and text.count("goto :eof") == 3
+
+
+def test_installers_do_not_setx(config, tmp_path):
+    CliRunner().invoke(main, args=["--prod", "--test", "--master"], catch_exceptions=False)
+
+    for name in ["master_create_envs.bat", "master_update_envs_test.bat"]:
+        text = (tmp_path / name).read_text()
+        assert "SETX" not in text
+        assert text.count("set_environ.bat") == 1
+        assert text.index("set_environ.bat") < text.index("call ", text.index("set_environ.bat") + 1)
+
+    create = (tmp_path / "myenv" / "create_env.bat").read_text()
+    assert "SETX" not in create
+    assert 'call "%~dp0..\\set_environ.bat"' in create
+    assert "set_environ" not in (tmp_path / "myenv" / "update_env.bat").read_text()
@@ -0,0 +1,107 @@
+import datetime
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.history import ResolutionHistory, parse_pin
+from mipi_env_manager.main import cli
+
+DAY = datetime.datetime(2026, 1, 5, 2, 0)
+
+
+@pytest.mark.parametrize("line, expected", [
+    ("requests @ git+https://github.com/psf/requests.git@v2.32.3#egg=requests", ("requests", "v2.32.3")),
+    ("my_pkg @ git+https://github.com/psf/requests.git#egg=my_pkg", ("my-pkg", None)),
+    ("Foo.Bar==2.31.0", ("foo-bar", "2.31.0")),
+    ("foo~=1.0.0", ("foo", "~=1.0.0")),
+    ("foo", ("foo", None)),
+])
+def test_parse_pin(line, expected):
+    assert parse_pin(line) == expected
+
+
+@pytest.fixture
+def history(tmp_path):
+    with ResolutionHistory(str(tmp_path / "history.sqlite")) as history:
+        yield history
+
+
+def nightly(history, day, requirements, complete=True):
+    return history.record(requirements, complete=complete, started=DAY + datetime.timedelta(days=day))
+
+
+def test_unchanged_publish_adds_no_pins(history):
+    first = nightly(history, 0, {"lab": ["requests==2.31.0", "numpy"]})
+    second = nightly(history, 1, {"lab": ["requests==2.31.0", "numpy"]})
+    assert [(p["id"], p["added"], p["removed"]) for p in history.publishes()] == [(second, 0, 0), (first, 2, 0)]
+
+
+def test_log_diff_and_users(history):
+    nightly(history, 0, {"lab": ["requests==2.31.0", "numpy"], "etl": ["requests==2.31.0"]})
+    nightly(history, 1, {"lab": ["requests==2.31.0", "numpy"], "etl": ["requests==2.31.0"]})
+    moved = nightly(history, 2, {"lab": ["requests==2.32.0", "numpy"], "etl": ["requests==2.31.0"]})
+
+    log = history.log("lab", "Requests")
+    assert [(r["version"], r["removed_in"]) for r in log] == [("2.31.0", moved), ("2.32.0", None)]
+    assert log[1]["added"] == "2026-01-07T02:00:00"
+
+    assert history.diff(history.resolve("2026-01-06"), moved) == [
+        {"environment": "lab", "package": "requests", "change": "changed", "before": "2.31.0", "after": "2.32.0"}]
+    assert [r["environment"] for r in history.users("requests", "2.31.0", at="2026-01-06")] == ["etl", "lab"]
+    assert [r["environment"] for r in history.users("requests", "2.3*")] == ["etl", "lab"]
+    assert [r["environment"] for r in history.users("requests", "2.31.0")] == ["etl"]
+
+
+def test_partial_publish_keeps_other_environments(history):
+    nightly(history, 0, {"lab": ["numpy"], "etl": ["pandas"]})
+    nightly(history, 1, {"lab": ["numpy==2.0.0"]}, complete=False)
+    assert set(history.pins_at(history.resolve("latest"))) == {("lab", "numpy"), ("etl", "pandas")}
+
+    nightly(history, 2, {"lab": ["numpy==2.0.0"]})
+    assert set(history.pins_at(history.resolve("latest"))) == {("lab", "numpy")}
+    assert history.diff(1, 3) == [
+        {"environment": "etl", "package": "pandas", "change": "removed", "before": None, "after": None},
+        {"environment": "lab", "package": "numpy", "change": "changed", "before": None, "after": "2.0.0"}]
+
+
+def test_publish_is_rolled_back_if_it_fails(history):
+    nightly(history, 0, {"lab": ["requests==2.31.0"]})
+    with pytest.raises(RuntimeError):
+        with history.publishing() as publish:
+            publish.add("lab", ["requests==2.32.0"])
+            raise RuntimeError("verify failed")
+    assert len(history.publishes()) == 1
+    assert [p["version"] for p in history.log("lab")] == ["2.31.0"]
+
+
+def test_concurrent_publishes_do_not_lock_each_other_out(history, tmp_path):
+    # e.g. two shards publishing to the same outpath, each with its own connection
+    with ResolutionHistory(str(tmp_path / "history.sqlite")) as other:
+        with history.publishing() as first, other.publishing() as second:
+            first.add("lab", ["requests==2.31.0"])
+            second.add("etl", ["pandas==2.2.0"])
+    assert len(history.publishes()) == 2
+    assert set(history.pins_at(history.resolve("latest"))) == {("lab", "requests"), ("etl", "pandas")}
+
+
+def test_resolve(history):
+    nightly(history, 0, {"lab": ["numpy"]})
+    with pytest.raises(ValueError):
+        history.resolve("2025-12-31")
+    with pytest.raises(ValueError):
+        history.resolve("last tuesday")
+    assert history.resolve("2026-01-05") == history.resolve("latest") == history.resolve("1") == 1
+
+
+def test_publish_records_history(config):
+    runner = CliRunner()
+    assert runner.invoke(cli, ["publish-envs", "--prod", "--test"]).exit_code == 0
+    result = runner.invoke(cli, ["history", "who", "my_pkg4", "v1.0.1", "--json"])
+    assert [r["environment"] for r in json.loads(result.output)] == ["myenv"]
+
+    result = runner.invoke(cli, ["history", "log", "myenv", "--package", "my-pkg6"])
+    assert result.output.splitlines()[1].split()[:3] == ["my-pkg6", "1.0.0", "1"]
+
+    assert runner.invoke(cli, ["publish-envs", "--prod", "--no-history"]).exit_code == 0
+    assert len(json.loads(runner.invoke(cli, ["history", "publishes", "--json"]).output)) == 1
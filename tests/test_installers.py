@@ -0,0 +1,43 @@
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.config import Config, ConfigError
+from mipi_env_manager.main import CreateEnvBat, UpdateEnvBat, PipInstaller, UvSyncInstaller, main
+
+
+def test_pip_is_the_default(tmp_path):
+    CreateEnvBat(tmp_path, "env").create(py_version="3.12", env_name="env")
+    UpdateEnvBat(tmp_path, "env").create(py_version="3.12", env_name="env")
+    assert "python -m pip install --upgrade -r requirements.txt --force-reinstall" in \
+        (tmp_path / "env" / "create_env.bat").read_text()
+    update = (tmp_path / "env" / "update_env.bat").read_text()
+    assert "python -m pip install --upgrade -r requirements.txt\n" in update
+    assert "uv" not in update
+
+
+def test_uv_sync_compiles_then_syncs():
+    create, update = (UvSyncInstaller().install_commands("env", c) for c in (True, False))
+    assert create == update
+    assert "uv pip compile -" in create[1]
+    assert create[2].endswith('sync --python "%CONDA_PREFIX%\\python.exe" "%TEMP%\\mipi_env_lock.txt"')
+    assert PipInstaller().list_command() == "python -m pip list"
+
+
+def test_env_installer_overrides_setup(config, tmp_path):
+    config["setup"]["installer"] = "uv"
+    config["environments"]["myenv2"]["setup"]["installer"] = "uv-sync"
+    CliRunner().invoke(main, args=["--prod"], catch_exceptions=False)
+
+    myenv = (tmp_path / "myenv" / "update_env.bat").read_text()
+    assert 'python -m uv pip install --python "%CONDA_PREFIX%\\python.exe" --upgrade -r requirements.txt' in myenv
+    assert "--reinstall" in (tmp_path / "myenv" / "create_env.bat").read_text()
+    assert "uv pip sync" in (tmp_path / "myenv2" / "update_env.bat").read_text()
+
+
+def test_unknown_installer_rejected(config):
+    config["environments"]["myenv"]["setup"]["installer"] = "poetry"
+    config["setup"]["installer"] = "conda"
+    with pytest.raises(ConfigError) as e:
+        Config.from_dict(config)
+    assert len(e.value.errors) == 2
+    assert "environments.myenv.setup.installer: must be one of pip, uv, uv-sync, got 'poetry'" in e.value.errors
@@ -280,8 +280,9 @@ class TestSmoke:
         runner.invoke(main, args =["--prod", "--master"], catch_exceptions=False)
 
         env_text = (tmp_path / "set_environ.bat").read_text()
-        expected = "\nSETX env_key env_val\n"
-        assert env_text == expected
+        manifest = (tmp_path / "environment_variables.txt").read_text()
+        assert manifest == "env_key=env_val"
+        assert "environment_variables.txt" in env_text
 
     def test_masters_refrence_correct_test_prod_envs(self, tmp_path):
 
@@ -0,0 +1,104 @@
+import json
+import os
+import stat
+
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.main import GHRequest, PublishInstallers, ReleaseResolver, main
+from mipi_env_manager.metrics import PublishMetrics, METRICS
+
+
+@pytest.fixture
+def patch_setup_outpath(config, tmp_path):
+    config["setup"]["outpath"] = str(tmp_path / "out")
+
+
+@pytest.fixture
+def patch_gh_releases(monkeypatch):
+    monkeypatch.setattr(GHRequest, "get_repo_releases", lambda self: [{"tag_name": "v1.0.0"}, {"tag_name": "v1.0.1"}])
+
+
+class TestPublishMetrics:
+
+    def test_prometheus_counters(self):
+        metrics = PublishMetrics()
+        metrics.inc("github_requests_total", status=200)
+        metrics.inc("github_requests_total", status=200)
+        metrics.inc("github_requests_total", status=404)
+        text = metrics.to_prometheus()
+        assert "# TYPE mipi_publish_github_requests_total counter" in text
+        assert 'mipi_publish_github_requests_total{status="200"} 2' in text
+        assert 'mipi_publish_github_requests_total{status="404"} 1' in text
+
+    def test_prometheus_histogram(self):
+        metrics = PublishMetrics()
+        metrics.observe("resolution_seconds", 0.2, repo="psf/requests")
+        metrics.observe("resolution_seconds", 3, repo="psf/requests")
+        text = metrics.to_prometheus()
+        assert 'mipi_publish_resolution_seconds_bucket{repo="psf/requests",le="0.25"} 1' in text
+        assert 'mipi_publish_resolution_seconds_bucket{repo="psf/requests",le="+Inf"} 2' in text
+        assert 'mipi_publish_resolution_seconds_count{repo="psf/requests"} 2' in text
+
+    def test_written_with_the_umask_mode(self, tmp_path):
+        umask = os.umask(0o022)
+        try:
+            PublishMetrics().write_prometheus(tmp_path / "m.prom")
+        finally:
+            os.umask(umask)
+        assert stat.S_IMODE((tmp_path / "m.prom").stat().st_mode) == 0o644
+
+    def test_write_json(self, tmp_path):
+        metrics = PublishMetrics()
+        metrics.inc("files_total", status="written")
+        metrics.write_json(tmp_path / "metrics.json")
+        content = json.loads((tmp_path / "metrics.json").read_text())
+        assert content["counters"]["files_total"] == [{"labels": {"status": "written"}, "value": 1}]
+
+
+@pytest.mark.usefixtures("patch_gh_releases")
+def test_resolver_caches_releases():
+    METRICS.reset()
+    resolver = ReleaseResolver()
+    resolver.get_releases("psf", "requests")
+    resolver.get_releases("psf", "requests")
+    assert METRICS.get("release_cache_misses_total") == 1
+    assert METRICS.get("release_cache_hits_total") == 1
+
+
+@pytest.mark.usefixtures("patch_setup_outpath", "patch_gh_releases")
+def test_publish_exports_metrics(tmp_path):
+    runner = CliRunner()
+    args = ["--prod", "--test", "--master", "--metrics-json", str(tmp_path / "m.json"),
+            "--metrics-textfile", str(tmp_path / "m.prom")]
+    runner.invoke(main, args=args, catch_exceptions=False)
+
+    assert METRICS.get("release_cache_misses_total") == 1
+    assert METRICS.get("environments_total", status="rebuilt") == 2
+    assert METRICS.get("files_total", status="written") == 27
+    assert 'mipi_publish_duration_seconds{status="success"}' in (tmp_path / "m.prom").read_text()
+    assert json.loads((tmp_path / "m.json").read_text())["gauges"]["duration_seconds"]
+
+    # nothing changed, so the second run leaves every file alone
+    runner.invoke(main, args=args, catch_exceptions=False)
+    assert METRICS.get("files_total", status="written") == 0
+    assert METRICS.get("files_total", status="unchanged") == 27
+
+
+@pytest.mark.usefixtures("patch_setup_outpath", "patch_gh_releases")
+def test_publish_counts_skipped_envs():
+    runner = CliRunner()
+    runner.invoke(main, args=["--prod", "--env", "myenv"], catch_exceptions=False)
+    assert METRICS.get("environments_total", status="rebuilt") == 1
+    assert METRICS.get("environments_total", status="skipped") == 1
+
+
+@pytest.mark.usefixtures("patch_setup_outpath", "patch_gh_releases")
+def test_failed_publish_exports_metrics(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(PublishInstallers, "_build_env", fail)
+    result = CliRunner().invoke(main, args=["--prod", "--metrics-textfile", str(tmp_path / "m.prom")])
+    assert isinstance(result.exception, RuntimeError)
+    assert 'mipi_publish_last_run_timestamp_seconds{status="failed"}' in (tmp_path / "m.prom").read_text()
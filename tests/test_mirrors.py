@@ -0,0 +1,93 @@
+import subprocess
+from pathlib import Path
+
+import pytest
+import requests
+from click.testing import CliRunner
+
+from mipi_env_manager.config import Config, MirrorSpec
+from mipi_env_manager.main import (
+    YmlSetup
+    , GitMirrorRequest
+    , GHVersion
+    , ReleaseResolver
+    , refresh_mirrors
+    , main
+)
+
+
+def git(*args, cwd=None):
+    subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args], cwd=cwd,
+                   check=True, capture_output=True)
+
+
+@pytest.fixture
+def origin(tmp_path):
+    repo = tmp_path / "origin"
+    repo.mkdir()
+    git("init", "-q", cwd=repo)
+    git("commit", "-q", "--allow-empty", "-m", "init", cwd=repo)
+    for tag in ["v1.0.0", "v1.0.2", "v1.1.0", "not-a-version"]:
+        git("tag", tag, cwd=repo)
+    return repo
+
+
+@pytest.fixture
+def mirror_root(tmp_path, origin):
+    root = tmp_path / "mirrors"
+    git("clone", "-q", "--bare", str(origin), str(root / "psf" / "requests.git"))
+    return root
+
+
+@pytest.fixture
+def no_network(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("the GitHub API should not be called")
+    monkeypatch.setattr(requests, "get", fail)
+
+
+def test_mirror_request_lists_tags(mirror_root):
+    releases = GitMirrorRequest(str(mirror_root / "psf" / "requests.git")).get_repo_releases()
+    assert sorted(r["tag_name"] for r in releases) == ["not-a-version", "v1.0.0", "v1.0.2", "v1.1.0"]
+
+
+def test_mirror_spec_path_for():
+    spec = MirrorSpec(root="/mirrors", repos=(("https://github.com/org/special.git", "/other/special.git"),))
+    assert spec.path_for("org", "special") == "/other/special.git"
+    assert spec.path_for("psf", "requests") == str(Path("/mirrors") / "psf" / "requests.git")
+    assert MirrorSpec().path_for("psf", "requests") is None
+
+
+@pytest.mark.usefixtures("no_network")
+def test_resolver_uses_mirror(mirror_root):
+    resolver = ReleaseResolver(mirrors=MirrorSpec(root=str(mirror_root)))
+    assert GHVersion("psf", "requests", "compatible", "1.0.0", resolver).build() == "v1.0.2"
+
+
+def test_refresh_fetches_new_tags(mirror_root, origin):
+    mirror = str(mirror_root / "psf" / "requests.git")
+    git("tag", "v1.0.5", cwd=origin)
+    assert refresh_mirrors([mirror]) == {}
+    tags = [r["tag_name"] for r in GitMirrorRequest(mirror).get_repo_releases()]
+    assert "v1.0.5" in tags
+
+
+def test_refresh_reports_failures_and_continues(mirror_root, tmp_path):
+    broken = tmp_path / "broken.git"
+    git("init", "-q", "--bare", str(broken))
+    errors = refresh_mirrors([str(broken), str(mirror_root / "psf" / "requests.git")], workers=2)
+    assert list(errors) == [str(broken)]
+
+
+@pytest.mark.usefixtures("no_network")
+def test_publish_from_mirrors(mirror_root, origin, use_config, tmp_path):
+    config = use_config(YmlSetup("MIPI_DEVOPS_PATH").get_config())
+    config["setup"]["outpath"] = str(tmp_path / "out")
+    config["setup"]["mirrors"] = {"root": str(mirror_root), "workers": 2}
+    assert Config.from_dict(config).setup.mirrors == MirrorSpec(root=str(mirror_root), workers=2)
+
+    # published after the mirror was cloned, picked up by the refresh at the start of the publish
+    git("tag", "v1.0.3", cwd=origin)
+    CliRunner().invoke(main, args=["--prod"], catch_exceptions=False)
+    assert "my_pkg4 @ git+https://github.com/psf/requests.git@v1.0.3#egg=my_pkg4" in \
+           (tmp_path / "out" / "myenv" / "requirements.txt").read_text()
@@ -0,0 +1,55 @@
+import importlib.util
+import subprocess
+
+import pytest
+
+from mipi_env_manager.main import CreateEnvBat, ReconcileScript, UpdateEnvBat
+
+
+@pytest.fixture
+def reconcile(tmp_path):
+    ReconcileScript(tmp_path).create()
+    spec = importlib.util.spec_from_file_location("reconcile", tmp_path / "reconcile.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_reconcile_uninstalls_removed(reconcile, tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(subprocess, "call", lambda command: calls.append(command) or 0)
+    (tmp_path / "installed.txt").write_text("my_pkg @ git+https://github.com/psf/requests.git@v1.0.0#egg=my_pkg\n"
+                                            "Old.Pkg==1.0\nnumpy~=1.26\n")
+    (tmp_path / "requirements.txt").write_text("my-pkg @ git+https://github.com/psf/requests.git@v1.0.1#egg=my-pkg\n"
+                                               "numpy\n# comment\n")
+
+    assert reconcile.main(str(tmp_path / "installed.txt"), str(tmp_path / "requirements.txt")) == 0
+    assert calls[0][-2:] == ["-y", "old-pkg"]
+
+
+def test_reconcile_without_previous_install(reconcile, tmp_path, monkeypatch):
+    monkeypatch.setattr(subprocess, "call", lambda command: pytest.fail("nothing to uninstall"))
+    (tmp_path / "requirements.txt").write_text("numpy")
+    assert reconcile.main(str(tmp_path / "missing.txt"), str(tmp_path / "requirements.txt")) == 0
+
+
+def test_create_reuses_matching_python(tmp_path):
+    CreateEnvBat(tmp_path, "env").create(py_version="3.12", env_name="env")
+    create = (tmp_path / "env" / "create_env.bat").read_text()
+
+    assert "sys.exit(not v.startswith('3.12.'))" in create
+    assert 'if /i "%~1"=="--reset" set "MIPI_RESET=1"' in create
+    # a reused environment is reconciled like an update, a recreated one is force reinstalled
+    reconcile = create[create.index('python "%~dp0..\\reconcile.py"'):create.index(":mipi_install")]
+    assert "pip install --upgrade -r requirements.txt\n" in reconcile
+    assert "--force-reinstall" in create[create.index(":mipi_install"):]
+    assert create.index(":mipi_recreate") < create.index("call conda create")
+    assert 'copy /y requirements.txt "%CONDA_PREFIX%\\conda-meta\\mipi_requirements.txt"' in create
+
+
+def test_update_does_not_reconcile(tmp_path):
+    UpdateEnvBat(tmp_path, "env").create(py_version="3.12", env_name="env")
+    update = (tmp_path / "env" / "update_env.bat").read_text()
+    assert "reconcile.py" not in update
+    assert "conda create" not in update
+    assert "mipi_requirements.txt" in update
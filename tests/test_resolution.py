@@ -0,0 +1,186 @@
+import json
+import time
+
+import pytest
+import requests
+from click.testing import CliRunner
+
+from mipi_env_manager.config import Config, ConfigError, ResolutionSpec
+from mipi_env_manager.main import (
+    YmlSetup
+    , GHPatAuth
+    , GHRequest
+    , GHVersion
+    , ReleaseResolver
+    , ResolutionDeadlineExceeded
+    , main
+)
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body if body is not None else []
+        self.content = json.dumps(self._body).encode()
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    """
+    queue of responses (or exceptions) returned by requests.get, and a log of the calls made
+    """
+    queue, calls, sleeps = [], [], []
+
+    def fake_get(url, headers=None, timeout=None):
+        calls.append({"url": url, "timeout": timeout})
+        result = queue.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setenv("GH_TOKEN", "token")
+    monkeypatch.setattr(requests, "get", fake_get)
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    return queue, calls, sleeps
+
+
+def make_request(**settings):
+    return GHRequest("psf", "requests", GHPatAuth("GH_TOKEN"), ResolutionSpec(**settings))
+
+
+def test_passes_timeouts(responses):
+    queue, calls, _ = responses
+    queue.append(FakeResponse(200, [{"tag_name": "v1.0.0"}]))
+    assert make_request(connect_timeout=2, read_timeout=7).get_repo_releases() == [{"tag_name": "v1.0.0"}]
+    assert calls[0]["timeout"] == (2, 7)
+
+
+def test_retries_server_errors_with_jittered_backoff(responses):
+    queue, calls, sleeps = responses
+    queue.extend([FakeResponse(502), requests.ConnectionError(), FakeResponse(503), FakeResponse(200, [])])
+    assert make_request(retries=3, backoff=1, max_backoff=3).get_repo_releases() == []
+    assert len(calls) == 4
+    assert len(sleeps) == 3
+    for attempt, delay in enumerate(sleeps):
+        assert 0 <= delay <= min(3, 2 ** attempt)
+
+
+def test_gives_up_after_retries(responses):
+    queue, calls, _ = responses
+    queue.extend([requests.Timeout(), requests.Timeout()])
+    with pytest.raises(requests.Timeout):
+        make_request(retries=1).get_repo_releases()
+    assert len(calls) == 2
+
+
+def test_client_errors_are_not_retried(responses):
+    queue, calls, _ = responses
+    queue.append(FakeResponse(404))
+    with pytest.raises(requests.HTTPError):
+        make_request(retries=3).get_repo_releases()
+    assert len(calls) == 1
+
+
+def test_deadline_caps_timeouts_and_backoff(responses, monkeypatch):
+    queue, calls, sleeps = responses
+    queue.append(FakeResponse(500))
+    monkeypatch.setattr("random.uniform", lambda a, b: b)
+    request = GHRequest("psf", "requests", GHPatAuth("GH_TOKEN"), ResolutionSpec(backoff=10),
+                        deadline=time.monotonic() + 1)
+    with pytest.raises(ResolutionDeadlineExceeded):
+        request.get_repo_releases()
+    assert max(calls[0]["timeout"]) <= 1
+    assert sleeps == []
+
+
+def test_deadline_fails_fast(responses):
+    resolver = ReleaseResolver(settings=ResolutionSpec(deadline=0))
+    with pytest.raises(ResolutionDeadlineExceeded):
+        GHVersion("psf", "requests", "compatible", "1.0.0", resolver).build()
+    assert responses[1] == []
+
+
+def test_deadline_falls_back_to_last_resolved(responses, tmp_path):
+    queue, calls, _ = responses
+    state = tmp_path / "last_resolved.json"
+    queue.append(FakeResponse(200, [{"tag_name": "v1.0.3"}]))
+
+    resolver = ReleaseResolver(settings=ResolutionSpec(), state_path=state)
+    assert GHVersion("psf", "requests", "compatible", "1.0.0", resolver).build() == "v1.0.3"
+    resolver.save_state()
+
+    resolver = ReleaseResolver(settings=ResolutionSpec(deadline=0, on_deadline="last_known"), state_path=state)
+    assert GHVersion("psf", "requests", "compatible", "1.0.0", resolver).build() == "v1.0.3"
+    # never resolved before, so there is nothing to fall back to
+    with pytest.raises(ResolutionDeadlineExceeded):
+        GHVersion("psf", "requests", "compatible", "2.0.0", resolver).build()
+    assert len(calls) == 1
+
+
+def test_publish_records_and_uses_last_resolved(responses, use_config, tmp_path):
+    queue, calls, _ = responses
+    config = use_config(YmlSetup("MIPI_DEVOPS_PATH").get_config())
+
+    queue.append(FakeResponse(200, [{"tag_name": "v1.0.4"}]))
+    CliRunner().invoke(main, args=["--prod"], catch_exceptions=False)
+    assert json.loads((tmp_path / ".mipi" / "last_resolved.json").read_text()) == {"psf/requests@1.0.0": "1.0.4"}
+
+    config["setup"]["resolution"] = {"deadline": 0, "on_deadline": "last_known"}
+    (tmp_path / "myenv" / "requirements.txt").unlink()
+    CliRunner().invoke(main, args=["--prod"], catch_exceptions=False)
+    assert "my_pkg4 @ git+https://github.com/psf/requests.git@v1.0.4#egg=my_pkg4" in \
+           (tmp_path / "myenv" / "requirements.txt").read_text()
+    assert len(calls) == 1
+
+
+def test_resolution_config_is_validated():
+    raw = {"environments": {}, "setup": {"outpath": "out", "resolution": {
+        "read_timeout": -1, "on_deadline": "guess", "retry": 2}}}
+    with pytest.raises(ConfigError) as e:
+        Config.from_dict(raw)
+    assert e.value.errors == [
+        "setup.resolution.read_timeout: must be a number >= 0, got -1",
+        "setup.resolution.on_deadline: must be one of fail, last_known, got 'guess'",
+        "setup.resolution.retry: unknown option",
+    ]
+
+    raw["setup"]["resolution"] = {"deadline": 120, "on_deadline": "last_known"}
+    assert Config.from_dict(raw).setup.resolution == ResolutionSpec(deadline=120.0, on_deadline="last_known")
+
+
+def test_timeout_at_the_deadline_is_a_deadline_error(responses, monkeypatch, tmp_path):
+    queue, calls, _ = responses
+    queue.append(requests.Timeout())
+    request = GHRequest("psf", "requests", GHPatAuth("GH_TOKEN"), ResolutionSpec(retries=0),
+                        deadline=time.monotonic() + 1)
+    with pytest.raises(ResolutionDeadlineExceeded):
+        request.get_repo_releases()
+
+    # so the resolver falls back to the last known version
+    (tmp_path / "last_resolved.json").write_text(json.dumps({"psf/requests@1.0.0": "1.0.2"}))
+    queue.append(requests.Timeout())
+    resolver = ReleaseResolver(settings=ResolutionSpec(retries=0, deadline=1, on_deadline="last_known"),
+                               state_path=tmp_path / "last_resolved.json")
+    assert GHVersion("psf", "requests", "compatible", "1.0.0", resolver).build() == "v1.0.2"
+
+
+def test_shards_keep_their_own_resolved_state(tmp_path):
+    shard_paths = [tmp_path / f"last_resolved.shard-{i}-of-2.json" for i in (1, 2)]
+    for i, path in enumerate(shard_paths):
+        resolver = ReleaseResolver(state_path=path)
+        resolver.record_resolved("psf", f"repo{i}", "1.0.0", "1.0.1")
+        resolver.save_state()
+    assert [json.loads(p.read_text()) for p in shard_paths] == [{"psf/repo0@1.0.0": "1.0.1"},
+                                                               {"psf/repo1@1.0.0": "1.0.1"}]
+    # any run can fall back on what every shard resolved
+    resolver = ReleaseResolver(settings=ResolutionSpec(on_deadline="last_known"),
+                               state_path=tmp_path / "last_resolved.json")
+    assert resolver.fallback("psf", "repo1", "1.0.0", ResolutionDeadlineExceeded()) == "1.0.1"
@@ -0,0 +1,82 @@
+import json
+import xml.etree.ElementTree as ET
+
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.config import Config, ConfigError, ScheduleSpec
+from mipi_env_manager.main import main
+from mipi_env_manager.schedule import offset_in_window, plan_schedule
+
+TASK_NS = {"t": "http://schemas.microsoft.com/windows/2004/02/mit/task"}
+
+
+@pytest.fixture
+def config(config):
+    config["setup"]["schedule"] = {"hosts": ["PC-001", "PC-002", "LAB-01"],
+                                   "groups": {"lab": ["LAB-01", "LAB-02"]},
+                                   "update_window": "07:00-09:00", "create_window": "23:00-03:00"}
+    return config
+
+
+def test_offsets_spread_evenly_over_window():
+    window = (7 * 60, 9 * 60)
+    hosts = [f"PC-{i:04d}" for i in range(2000)]
+    offsets = [offset_in_window(h, window) for h in hosts]
+
+    assert all(7 * 3600 <= o < 9 * 3600 for o in offsets)
+    # 12 ten minute buckets should each hold about 2000 / 12 starts
+    buckets = [0] * 12
+    for o in offsets:
+        buckets[(o - 7 * 3600) // 600] += 1
+    assert min(buckets) > 120 and max(buckets) < 215
+    # deterministic, and case-insensitive like windows host names
+    assert offsets[0] == offset_in_window("pc-0000", window)
+
+
+def test_window_wraps_past_midnight():
+    offsets = [offset_in_window(f"PC-{i}", (23 * 60, 1 * 60)) for i in range(500)]
+    assert all(o >= 23 * 3600 or o < 3600 for o in offsets)
+    assert any(o < 3600 for o in offsets) and any(o >= 23 * 3600 for o in offsets)
+
+
+def test_groups_share_a_schedule():
+    spec = ScheduleSpec(True, hosts=("PC-1", "lab-1"), groups=(("lab", ("LAB-1", "LAB-2")),))
+    plan = {unit.unit: unit for unit in plan_schedule(spec)}
+    assert sorted(plan) == ["PC-1", "lab"]
+    assert plan["lab"].hosts == ("LAB-1", "LAB-2")
+    assert 60 * 60 <= plan["lab"].create_time < 5 * 60 * 60
+
+
+def test_publish_writes_schedules(config, tmp_path):
+    CliRunner().invoke(main, args=["--prod", "--master"], catch_exceptions=False)
+    schedules = tmp_path / "schedules"
+
+    manifest = json.loads((schedules / "schedule.json").read_text())
+    assert sorted(manifest) == ["LAB-01", "LAB-02", "PC-001", "PC-002"]
+    assert manifest["LAB-01"]["schedule"] == manifest["LAB-02"]["schedule"] == "lab"
+    assert "07:00:00" <= manifest["PC-001"]["update"] < "09:00:00"
+    assert (schedules / "hosts.txt").read_text().splitlines()[0] == "LAB-01 lab"
+
+    task = ET.parse(schedules / "PC-001-create.xml").getroot()
+    assert task.find(".//t:StartBoundary", TASK_NS).text.endswith(manifest["PC-001"]["create"])
+    assert task.find(".//t:DaysOfWeek/t:Sunday", TASK_NS) is not None
+    assert task.find(".//t:Arguments", TASK_NS).text == f'/c "{tmp_path / "master_create_envs.bat"}" < nul'
+    update = ET.parse(schedules / "PC-001-update.xml").getroot()
+    assert update.find(".//t:ScheduleByDay", TASK_NS) is not None
+
+    register = (schedules / "register_schedule.bat").read_text()
+    assert '"%~dp0%MIPI_SCHEDULE_UNIT%-update.xml"' in register
+
+
+def test_no_schedules_unless_configured(config, tmp_path):
+    del config["setup"]["schedule"]
+    CliRunner().invoke(main, args=["--prod", "--master"], catch_exceptions=False)
+    assert not (tmp_path / "schedules").exists()
+
+
+def test_invalid_schedule(config):
+    config["setup"]["schedule"] = {"update_window": "7am", "create_days": ["Funday"], "hosts": ["bad host"]}
+    with pytest.raises(ConfigError) as e:
+        Config.from_dict(config)
+    assert len(e.value.errors) == 3
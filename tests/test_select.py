@@ -0,0 +1,61 @@
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.config import Config, EnvironmentIndex
+from mipi_env_manager.main import EnvSelector, main
+from mipi_env_manager.metrics import METRICS
+
+
+@pytest.fixture
+def config(config):
+    config["environments"]["lab_a"] = {"setup": {"py_version": "3.11", "include_in_master": True},
+                                       "packages": {"Lab_Tools": {"source": "github", "version": "1.0.0",
+                                                                  "path": "https://github.com/Org/lab-tools.git"}}}
+    config["environments"]["lab_b"] = {"setup": {"py_version": "3.11", "include_in_master": False},
+                                       "packages": {"numpy": {"source": "pypi"}}}
+    return config
+
+
+def built(tmp_path):
+    return sorted(p.name for p in tmp_path.iterdir() if (p / "requirements.txt").exists())
+
+
+def test_index_by_package_and_repo(config):
+    index = EnvironmentIndex.from_environments(Config.from_dict(config).environments.values())
+    assert index.for_package("lab-tools") == {"lab_a"}
+    assert index.for_package("my_pkg") == {"myenv", "myenv2"}
+    assert index.for_repo("https://github.com/org/lab-tools/") == {"lab_a"}
+    assert index.for_repo("https://github.com/psf/requests") == {"myenv", "myenv2"}
+    assert index.for_package("missing") == set()
+
+
+def test_selector_without_criteria_selects_all(config):
+    assert EnvSelector().selects_all
+    assert EnvSelector(None).selects_all
+    assert EnvSelector("myenv").envs == ("myenv",)
+
+
+def test_selector_matches_each_environment_on_its_own(config):
+    environments = Config.from_dict(config).environments.values()
+    selector = EnvSelector(packages=["lab.tools"], repos=["https://github.com/PSF/requests.git"])
+    assert [env.name for env in environments if selector.matches(env)] == ["myenv", "myenv2", "lab_a"]
+    assert not EnvSelector(packages=["numpy"]).matches(Config.from_dict(config).environments["lab_a"])
+
+
+@pytest.mark.parametrize("args, envs", [
+    (["--env", "lab_*"], ["lab_a", "lab_b"]),
+    (["--env", "myenv", "--env", "lab_b"], ["lab_b", "myenv"]),
+    (["--package", "lab.tools"], ["lab_a"]),
+    (["--repo", "https://github.com/psf/requests"], ["myenv", "myenv2"]),
+    (["--package", "numpy", "--repo", "https://github.com/org/lab-tools"], ["lab_a", "lab_b"]),
+])
+def test_publish_selected(config, tmp_path, args, envs):
+    CliRunner().invoke(main, args=["--prod", "--master"] + args, catch_exceptions=False)
+    assert built(tmp_path) == envs
+    assert METRICS.get("environments_total", status="rebuilt") == len(envs)
+
+    # the master installers still include every environment marked include_in_master
+    master = (tmp_path / "master_update_envs.bat").read_text()
+    assert "myenv\\update_env.bat" in master
+    assert "lab_a\\update_env.bat" in master
+    assert "lab_b" not in master
@@ -0,0 +1,73 @@
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.main import (
+    YmlSetup
+    , parse_shard
+    , env_in_shard
+    , merge_shards
+    , main
+    , cli
+)
+
+
+@pytest.fixture
+def outpath(config, tmp_path):
+    for i in range(3, 9):
+        config["environments"][f"myenv{i}"] = config["environments"]["myenv"]
+    return tmp_path
+
+
+@pytest.mark.parametrize("value, expected", [("1/1", (1, 1)), ("2/4", (2, 4))])
+def test_parse_shard(value, expected):
+    assert parse_shard(value) == expected
+
+
+@pytest.mark.parametrize("value", ["0/4", "5/4", "1", "a/b", "1/0"])
+def test_parse_shard_raises(value):
+    with pytest.raises(ValueError):
+        parse_shard(value)
+
+
+def test_every_env_in_exactly_one_shard():
+    names = [f"env{i}" for i in range(500)]
+    owners = [[i for i in range(1, 5) if env_in_shard(name, i, 4)] for name in names]
+    assert all(len(o) == 1 for o in owners)
+    # roughly balanced
+    sizes = [sum(1 for o in owners if o == [i]) for i in range(1, 5)]
+    assert min(sizes) > 80
+
+
+def test_sharded_publish_then_merge_matches_single_run(outpath, tmp_path_factory, monkeypatch):
+    runner = CliRunner()
+    for i in (1, 2, 3):
+        runner.invoke(main, args=["--prod", "--test", "--master", "--shard", f"{i}/3"], catch_exceptions=False)
+
+    assert not (outpath / "master_create_envs.bat").exists()
+    result = runner.invoke(cli, args=["merge"], catch_exceptions=False)
+    assert result.exit_code == 0
+    sharded = {name: (outpath / name).read_text() for name in
+               ["master_create_envs.bat", "master_update_envs_test.bat", "set_environ.bat", "manifest.json"]}
+
+    # envs built across all shards
+    for i in ["", 2, 3, 4, 5, 6, 7, 8]:
+        assert (outpath / f"myenv{i}" / "create_env.bat").is_file()
+        assert (outpath / f"myenv{i}_test" / "requirements.txt").is_file()
+
+    single = tmp_path_factory.mktemp("single")
+    config = YmlSetup("MIPI_DEVOPS_PATH").get_config()
+    config["setup"]["outpath"] = single
+    runner.invoke(main, args=["--prod", "--test", "--master"], catch_exceptions=False)
+
+    for name, content in sharded.items():
+        assert content.replace(str(outpath), str(single)) == (single / name).read_text()
+
+
+def test_merge_reports_missing_shard(outpath):
+    runner = CliRunner()
+    runner.invoke(main, args=["--prod", "--master", "--shard", "1/2"], catch_exceptions=False)
+    with pytest.raises(ValueError, match=r"missing manifests for shards \[2\]"):
+        merge_shards(outpath)
+
+    result = runner.invoke(cli, args=["merge"])
+    assert result.exit_code != 0
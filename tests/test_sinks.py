@@ -0,0 +1,145 @@
+import os
+import stat
+import zipfile
+from pathlib import Path
+
+from mipi_env_manager.main import YmlSetup, PublishInstallers, preview
+from mipi_env_manager.sinks import (DiskSink, FanOutSink, MemorySink, ZipSink, diff_artifacts, read_tree,
+                                    write_if_changed)
+
+
+def test_preview_writes_nothing(config, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    artifacts = preview(YmlSetup("MIPI_DEVOPS_PATH"))
+
+    assert list(tmp_path.iterdir()) == []
+    assert "myenv/requirements.txt" in artifacts
+    assert "master_create_envs.bat" in artifacts
+    assert artifacts["environment_variables.txt"].text == "env_key=env_val"
+    assert len(artifacts) == 27
+
+
+def test_preview_matches_disk(config, tmp_path):
+    config["setup"]["outpath"] = str(tmp_path)
+    on_disk = PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True).publish()
+    in_memory = preview(YmlSetup("MIPI_DEVOPS_PATH"))
+
+    assert on_disk.keys() == in_memory.keys()
+    assert diff_artifacts(read_tree(tmp_path), in_memory) == {"added": (), "removed": (), "changed": ()}
+    assert on_disk["myenv/requirements.txt"].content is None
+
+
+def test_diff_after_config_change(config, tmp_path):
+    before = preview(YmlSetup("MIPI_DEVOPS_PATH"))
+    config["environments"]["myenv2"]["setup"]["py_version"] = "3.11"
+    del config["environments"]["myenv"]
+    after = preview(YmlSetup("MIPI_DEVOPS_PATH"))
+
+    diff = diff_artifacts(before, after)
+    assert "myenv/create_env.bat" in diff["removed"]
+    assert "myenv2/stamp.txt" in diff["changed"]
+    assert diff["added"] == ()
+
+
+def test_zip_sink(config, tmp_path):
+    sink = ZipSink(tmp_path / "out.zip")
+    artifacts = PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), False, True, False, sink=sink).publish()
+    with zipfile.ZipFile(tmp_path / "out.zip") as zf:
+        assert sorted(zf.namelist()) == sorted(artifacts)
+        assert zf.read("myenv/stamp.txt").decode() == preview(YmlSetup("MIPI_DEVOPS_PATH"), test=False,
+                                                                 master=False)["myenv/stamp.txt"].text
+
+
+def test_disk_sink_skips_unchanged(tmp_path):
+    sink = DiskSink(quiet=True)
+    path = tmp_path / "sub" / "file.txt"
+    sha = sink.write_lines(str(path), ["a", "b"])
+    mtime = path.stat().st_mtime_ns
+    assert sink.write_lines(str(path), iter(["a", "b"])) == sha
+    assert path.stat().st_mtime_ns == mtime
+    assert path.read_text() == "a\nb"
+    assert sha == MemorySink().write_lines("file.txt", ["a", "b"])
+
+
+def test_concurrent_writes_use_their_own_temp_files(tmp_path):
+    path = str(tmp_path / "constraints.txt")
+
+    def shard():
+        yield "first"
+        # another shard writes the same file while this one is half way through
+        write_if_changed(path, ["other"])
+        yield "\nsecond"
+
+    umask = os.umask(0o022)
+    try:
+        write_if_changed(path, shard())
+    finally:
+        os.umask(umask)
+    assert Path(path).read_text() == "first\nsecond"
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert os.listdir(tmp_path) == ["constraints.txt"]
+
+
+def test_prune_removes_files_not_kept(tmp_path):
+    for target in ("emea", "amer"):
+        (tmp_path / target / "bundles").mkdir(parents=True)
+        (tmp_path / target / "bundles" / "old.zip").write_text("old")
+    (tmp_path / "amer" / "bundles" / "stray.zip").write_text("stray")
+
+    sink = FanOutSink([str(tmp_path / "emea"), str(tmp_path / "amer")], quiet=True)
+    root = sink.begin(None)
+    sink.write_text(str(Path(root, "bundles", "new.zip")), "new")
+    sink.prune(str(Path(root, "bundles")), ["new.zip"])
+    assert (tmp_path / "emea" / "bundles" / "old.zip").exists()
+    sink.commit()
+    assert [s.removed for s in sink.statuses.values()] == [1, 2]
+    for target in ("emea", "amer"):
+        assert [p.name for p in (tmp_path / target / "bundles").iterdir()] == ["new.zip"]
+
+    sink = DiskSink(quiet=True)
+    sink.prune(str(tmp_path / "emea" / "bundles"), [])
+    assert not any((tmp_path / "emea" / "bundles").iterdir())
+
+
+def test_fan_out_to_several_outpaths(config, tmp_path):
+    targets = [str(tmp_path / "emea"), str(tmp_path / "amer")]
+    config["setup"]["outpath"] = targets
+    publisher = PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True)
+    artifacts = publisher.publish()
+
+    assert isinstance(publisher.sink, FanOutSink)
+    assert [(s.written, s.unchanged, s.ok) for s in publisher.sink.statuses.values()] == [(27, 0, True)] * 2
+    emea, amer = read_tree(targets[0]), read_tree(targets[1])
+    assert artifacts.keys() == emea.keys() == amer.keys()
+    # only the master installers differ, each calling the environments on its own target
+    assert diff_artifacts(emea, amer)["changed"] == ("master_create_envs.bat", "master_create_envs_test.bat",
+                                                     "master_update_envs.bat", "master_update_envs_test.bat")
+    assert str(Path(targets[1], "myenv")) in amer["master_create_envs.bat"].text
+    assert targets[0] not in amer["master_create_envs.bat"].text
+
+
+def test_fan_out_only_writes_changed_files(config, tmp_path):
+    targets = [str(tmp_path / "emea"), str(tmp_path / "amer")]
+    config["setup"]["outpath"] = targets
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True).publish()
+    (tmp_path / "amer" / "myenv" / "requirements.txt").write_text("edited")
+    mtime = (tmp_path / "emea" / "myenv" / "requirements.txt").stat().st_mtime_ns
+
+    publisher = PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True)
+    publisher.publish()
+    assert [(s.written, s.unchanged) for s in publisher.sink.statuses.values()] == [(0, 27), (1, 26)]
+    assert (tmp_path / "emea" / "myenv" / "requirements.txt").stat().st_mtime_ns == mtime
+    assert (tmp_path / "amer" / "myenv" / "requirements.txt").read_text() != "edited"
+
+
+def test_fan_out_target_failure_does_not_stop_others(config, tmp_path):
+    (tmp_path / "offline").write_text("not a folder")
+    targets = [str(tmp_path / "emea"), str(tmp_path / "offline" / "envs")]
+    config["setup"]["outpath"] = targets
+    publisher = PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True)
+    publisher.publish()
+
+    emea, offline = publisher.sink.statuses.values()
+    assert emea.ok and emea.written == 27
+    assert not offline.ok and offline.written == 0
+    assert len(read_tree(targets[0])) == 27
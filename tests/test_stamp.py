@@ -0,0 +1,48 @@
+from click.testing import CliRunner
+
+from mipi_env_manager.main import generation_stamp, main
+
+
+def test_generation_stamp_depends_on_inputs():
+    stamp = generation_stamp("3.12", "abc")
+    assert stamp == generation_stamp("3.12", "abc")
+    assert stamp != generation_stamp("3.11", "abc")
+    assert stamp != generation_stamp("3.12", "abd")
+    assert stamp != generation_stamp("3.12", "abc", installer="uv")
+    assert stamp != generation_stamp("3.12", "abc", constraints_sha256="def")
+
+
+def test_stamp_written_per_env(config, tmp_path):
+    CliRunner().invoke(main, args=["--prod", "--test"], catch_exceptions=False)
+    stamps = {env: (tmp_path / env / "stamp.txt").read_text() for env in ["myenv", "myenv_test", "myenv2"]}
+    assert len(stamps["myenv"]) == 64
+    # same packages and python, same stamp
+    assert stamps["myenv"] == stamps["myenv_test"]
+    assert stamps["myenv"] != stamps["myenv2"]
+
+
+def test_stamp_changes_with_requirements(config, tmp_path):
+    runner = CliRunner()
+    runner.invoke(main, args=["--prod"], catch_exceptions=False)
+    before = (tmp_path / "myenv2" / "stamp.txt").read_text()
+
+    runner.invoke(main, args=["--prod"], catch_exceptions=False)
+    assert (tmp_path / "myenv2" / "stamp.txt").read_text() == before
+
+    config["environments"]["myenv2"]["packages"]["my_pkg"]["version"] = "1.0.0"
+    runner.invoke(main, args=["--prod"], catch_exceptions=False)
+    assert (tmp_path / "myenv2" / "stamp.txt").read_text() != before
+
+
+def test_only_update_installer_exits_early(config, tmp_path):
+    CliRunner().invoke(main, args=["--prod"], catch_exceptions=False)
+    update = (tmp_path / "myenv" / "update_env.bat").read_text()
+    create = (tmp_path / "myenv" / "create_env.bat").read_text()
+
+    # the no-op exit comes before any conda or pip call
+    assert update.index("exit /b 0") < update.index("call conda")
+    assert "conda-meta\\mipi_stamp.txt" in update
+    assert "myenv is up to date" not in create
+    # both record the stamp after a successful install
+    for text in (update, create):
+        assert text.index("pip install") < text.index('copy /y "%~dp0stamp.txt"')
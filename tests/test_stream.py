@@ -0,0 +1,137 @@
+import io
+import json
+import tracemalloc
+from pathlib import Path
+
+import yaml
+from click.testing import CliRunner
+
+from mipi_env_manager.config import Config, iter_environments, read_setup
+from mipi_env_manager.main import YmlSetup, GHRequest, Dependancies, PublishInstallers, main, manifest_lines
+
+CONFIG_PATH = Path(__file__).parent / "test_dependencies.yml"
+
+
+def generate_config(n_envs, n_packages=20, n_versions=5) -> str:
+    lines = ["environments:"]
+    for e in range(n_envs):
+        lines += [f"  env{e}:", "    setup:", "      py_version: 3.12", f"      include_in_master: {e % 2 == 0}",
+                  "    packages:"]
+        for p in range(n_packages):
+            lines += [f"      pkg{p}:", "        source: pypi", f"        version: 1.{e % n_versions}.{p}"]
+    lines += ["setup:", "  outpath: out"]
+    return "\n".join(lines)
+
+
+def test_iter_environments_matches_config():
+    with open(CONFIG_PATH, "rb") as f:
+        streamed = list(iter_environments(f))
+    config = Config.from_dict(yaml.safe_load(CONFIG_PATH.read_text()))
+    assert streamed == list(config.environments.values())
+
+
+def test_read_setup_after_environments():
+    with open(CONFIG_PATH, "rb") as f:
+        setup = read_setup(f)
+    assert dict(setup.environment_variables) == {"env_key": "env_val"}
+
+
+def test_iter_environments_resolves_aliases():
+    text = """
+environments:
+  a:
+    setup: &base
+      py_version: 3.11
+      include_in_master: true
+    packages: {}
+  b:
+    setup: *base
+    packages:
+      requests: {source: pypi, version: 2.31.0}
+"""
+    envs = list(iter_environments(io.StringIO(text)))
+    assert [e.py_version for e in envs] == ["3.11", "3.11"]
+    assert envs[1].packages[0].version == "2.31.0"
+
+
+def _peak(func, n_envs):
+    text = generate_config(n_envs).encode()
+    tracemalloc.start()
+    func(io.BytesIO(text))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def _stream(f):
+    for _ in iter_environments(f):
+        pass
+
+
+def test_iter_environments_memory_does_not_grow():
+    streamed = _peak(_stream, 300)
+    loaded = _peak(lambda f: Config.from_dict(yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))), 300)
+    assert streamed < 2**20
+    assert streamed < loaded / 20
+
+
+def test_write_requirments_streams_to_file(tmp_path):
+    config = Config.from_dict(yaml.safe_load(generate_config(1))).environments["env0"]
+    deps = Dependancies(config)
+    path = tmp_path / "requirements.txt"
+    deps.write_requirments(path)
+    assert path.read_text() == deps.create_strings()
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_stream_publish_matches_in_memory(monkeypatch, tmp_path):
+    monkeypatch.setattr(GHRequest, "get_repo_releases", lambda self: [{"tag_name": "v1.0.1"}])
+    outputs = {}
+    for mode in ("memory", "stream"):
+        out = tmp_path / mode
+        config_path = tmp_path / f"{mode}.yml"
+        config_path.write_text(CONFIG_PATH.read_text().replace("outpath: null", f"outpath: {out}"))
+        monkeypatch.setenv("MIPI_DEVOPS_PATH", str(config_path))
+        args = ["--prod", "--test", "--master"] + (["--stream"] if mode == "stream" else [])
+        CliRunner().invoke(main, args=args, catch_exceptions=False)
+        # the resolution history is binary and timestamped, so it is left out of the comparison
+        assert (out / ".mipi" / "history.sqlite").is_file()
+        outputs[mode] = {p.relative_to(out): p.read_text().replace(str(out), "OUT") for p in out.rglob("*")
+                         if p.is_file() and p.suffix != ".sqlite"}
+
+    assert len(outputs["stream"]) == 27
+    # the streamed fingerprint is of the file's bytes, the loaded one of the parsed config
+    fingerprints = Path(".mipi/config_files.json")
+    assert outputs["stream"].pop(fingerprints) != outputs["memory"].pop(fingerprints)
+    assert outputs["stream"] == outputs["memory"]
+
+
+def _publish_peak(tmp_path, monkeypatch, n_envs) -> int:
+    out = tmp_path / f"out{n_envs}"
+    config_path = tmp_path / f"envs{n_envs}.yml"
+    # every environment pins the same versions, so constraints.txt lists no conflicts naming each environment
+    config_path.write_text(generate_config(n_envs, n_versions=1).replace("outpath: out", f"outpath: {out}"))
+    monkeypatch.setenv("MIPI_DEVOPS_PATH", str(config_path))
+    # the cli publishes with the resolution history and constraints.txt
+    tracemalloc.start()
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True, stream=True, record_history=True).publish()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert (out / "constraints.txt").is_file() and (out / ".mipi" / "history.sqlite").is_file()
+    assert len(json.loads((out / "manifest.json").read_text())["environments"]) == 2 * n_envs
+    return peak
+
+
+def test_stream_publish_memory_does_not_grow_with_environments(monkeypatch, tmp_path):
+    small = _publish_peak(tmp_path, monkeypatch, 60)
+    large = _publish_peak(tmp_path, monkeypatch, 240)
+    # nothing is kept per environment, so 180 more environments cost about what the first 60 did. Both configs are
+    # larger than the buffers they are read with. Keeping the file records alone takes some 500 KiB more
+    assert large - small < 128 * 2**10
+
+
+def test_manifest_lines_match_json_dump():
+    entries = [("env0", {"stamp": "v1", "include_in_master": True}), ("env1", {}), ("env1_test", {"stamp": None})]
+    assert "\n".join(manifest_lines(iter(entries))) == json.dumps({"environments": dict(entries)}, indent=2,
+                                                                sort_keys=True)
+    assert "\n".join(manifest_lines(iter([]))) == json.dumps({"environments": {}}, indent=2, sort_keys=True)
@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.main import YmlSetup, PublishInstallers, cli
+from mipi_env_manager.sync import BatRunner, CondaRunner, EnvRunner, SyncClient
+
+
+class FakeRunner(EnvRunner):
+    """
+    Records each install in to the environment's folder instead of running conda, and installs the environment in to
+    `envs_dir` as the installers would: conda-meta with its python and the published stamp. Folders in `fail` exit 1
+    """
+
+    def __init__(self, envs_dir, fail=()):
+        self.envs_dir = envs_dir
+        self.fail = set(fail)
+
+    def commands(self, folder, entry, action):
+        code = f"open('installed.txt', 'a').write('{action}\\n'); raise SystemExit({int(folder in self.fail)})"
+        meta = os.path.join(self.envs_dir, folder, "conda-meta")
+        install = (f"import os, shutil; os.makedirs({meta!r}, exist_ok=True); "
+                   f"shutil.copy('stamp.txt', os.path.join({meta!r}, 'mipi_stamp.txt'))")
+        if action == "create":
+            install = (f"import glob, os; [os.remove(p) for p in glob.glob(os.path.join({meta!r}, '*'))]; {install}; "
+                       f"open(os.path.join({meta!r}, 'python-{entry['py_version']}.1-h0_0.json'), 'w').close()")
+        return [[sys.executable, "-c", code], [sys.executable, "-c", install]]
+
+
+@pytest.fixture
+def config(config, tmp_path):
+    config["setup"]["outpath"] = str(tmp_path / "out")
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True).publish()
+    return config
+
+
+def client(tmp_path, fail=(), **kwargs):
+    kwargs.setdefault("runner", FakeRunner(str(tmp_path / "envs"), fail))
+    return SyncClient(str(tmp_path / "out"), str(tmp_path / "state"), envs_dirs=[str(tmp_path / "envs")], **kwargs)
+
+
+def installs(tmp_path, folder):
+    path = tmp_path / "out" / folder / "installed.txt"
+    return path.read_text().split() if path.exists() else []
+
+
+def test_manifest_lists_every_environment_folder(config, tmp_path):
+    manifest = client(tmp_path).manifest()
+    assert sorted(manifest) == ["myenv", "myenv2", "myenv2_test", "myenv_test"]
+    assert manifest["myenv"]["stamp"] == (tmp_path / "out" / "myenv" / "stamp.txt").read_text()
+    assert manifest["myenv_test"]["variant"] == "test"
+    assert manifest["myenv2"]["include_in_master"] is False
+
+
+def test_only_changed_environments_are_installed(config, tmp_path):
+    results = client(tmp_path).sync()
+    assert [(r.folder, r.action, r.status) for r in results] == [("myenv", "create", "ok")]
+    assert client(tmp_path).sync() == []
+
+    config["environments"]["myenv"]["packages"]["my_pkg5"]["version"] = "2.0.0"
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True).publish()
+    assert [(r.folder, r.action) for r in client(tmp_path).sync()] == [("myenv", "update")]
+
+    config["environments"]["myenv"]["setup"]["py_version"] = "3.11"
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True).publish()
+    assert [(r.folder, r.action) for r in client(tmp_path).sync()] == [("myenv", "create")]
+    assert installs(tmp_path, "myenv") == ["create", "update", "create"]
+
+
+def test_failed_install_is_recorded_and_retried(config, tmp_path):
+    results = client(tmp_path, envs=["myenv*"], fail={"myenv2"}, workers=3).sync()
+    assert {r.folder: r.status for r in results} == {"myenv": "ok", "myenv2": "failed", "myenv2_test": "ok",
+                                                     "myenv_test": "ok"}
+
+    state = json.loads((tmp_path / "state" / "state.json").read_text())
+    assert state["myenv2"]["status"] == "failed" and "stamp" not in state["myenv2"]
+    assert "> " in Path(state["myenv2"]["log"]).read_text()
+
+    assert [(r.folder, r.status) for r in client(tmp_path, envs=["myenv*"]).sync()] == [("myenv2", "ok")]
+    assert installs(tmp_path, "myenv2") == ["create", "create"]
+
+
+def test_plan_reads_the_installed_environments(config, tmp_path):
+    # installed by a master installer, not by a sync, so this machine has no state.json
+    meta = tmp_path / "envs" / "myenv" / "conda-meta"
+    meta.mkdir(parents=True)
+    (meta / "python-3.12.4-h14ffc60_0_cpython.json").write_text("{}")
+    (meta / "mipi_stamp.txt").write_text((tmp_path / "out" / "myenv" / "stamp.txt").read_text() + "\n")
+    assert client(tmp_path).plan() == []
+
+    (meta / "mipi_stamp.txt").write_text("an older stamp")
+    assert [(folder, action) for folder, _, action in client(tmp_path).plan()] == [("myenv", "update")]
+
+    (meta / "python-3.12.4-h14ffc60_0_cpython.json").rename(meta / "python-3.11.9-h0_0.json")
+    assert [(folder, action) for folder, _, action in client(tmp_path).plan()] == [("myenv", "create")]
+
+    # a sync installed it, then it was removed
+    client(tmp_path).sync()
+    shutil.rmtree(tmp_path / "envs" / "myenv")
+    assert [(folder, action) for folder, _, action in client(tmp_path).plan()] == [("myenv", "create")]
+
+
+def test_runners():
+    entry = {"py_version": "3.12"}
+    assert BatRunner().commands("myenv", entry, "update") == [["cmd", "/c", "update_env.bat"]]
+    create = CondaRunner("conda").commands("myenv", entry, "create")
+    assert create[0] == ["conda", "create", "--name", "myenv", "-y", "python=3.12", "pip"]
+    assert create[1][-1] == "--force-reinstall"
+    assert len(CondaRunner("conda").commands("myenv", entry, "update")) == 2
+    update = CondaRunner("conda").commands("myenv", dict(entry, constraints="constraints.txt"), "update")
+    assert update[0][-2:] == ["-c", os.path.join("..", "constraints.txt")]
+    assert "mipi_stamp.txt" in update[-1][-1]
+
+
+def test_cli_dry_run(config, tmp_path):
+    result = CliRunner().invoke(cli, ["sync", str(tmp_path / "out"), "--state-dir", str(tmp_path / "state"),
+                                      "--variant", "test", "--dry-run", "--json"])
+    assert result.exit_code == 0
+    assert json.loads(result.output)[0]["folder"] == "myenv_test"
+    assert installs(tmp_path, "myenv_test") == []
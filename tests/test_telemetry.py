@@ -0,0 +1,73 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.main import CreateEnvBat, UpdateEnvBat, cli
+from mipi_env_manager.telemetry import TimingRecord, TimingReport, format_rows, iter_records, percentile
+
+
+@pytest.fixture
+def drop_dir(tmp_path):
+    drop = tmp_path / "drop"
+    drop.mkdir()
+    for i in range(100):
+        lines = [f"myenv,update,install,ok,{(i + 1) * 100},PC{i}",
+                 f"myenv,update,total,{'fail' if i < 3 else 'ok'},{(i + 1) * 150},PC{i}",
+                 f"myenv2,update,install,ok,{i + 1},PC{i}"]
+        (drop / f"PC{i}_myenv_{i}.csv").write_text("\n".join(lines) + "\n")
+    (drop / "PC0_broken.csv").write_text("myenv,update,ins")
+    (drop / "notes.txt").write_text("not a timing file")
+    return drop
+
+
+def test_parse_record():
+    record = TimingRecord.parse("myenv,create,conda_create,ok,1234,PC1\r\n")
+    assert (record.env, record.step, record.seconds, record.host) == ("myenv", "conda_create", 12.34, "PC1")
+    assert TimingRecord.parse("myenv,create,conda_") is None
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert [percentile(values, p) for p in (50, 90, 99, 100)] == [50, 90, 99, 100]
+    assert percentile([7], 99) == 7
+
+
+def test_report_per_env(drop_dir):
+    rows = TimingReport().add(iter_records(drop_dir)).rows()
+    assert len(rows) == 3
+    # slowest p90 first
+    total = rows[0]
+    assert (total["env"], total["step"], total["count"], total["failures"]) == ("myenv", "total", 100, 3)
+    assert (total["p50"], total["p90"], total["max"]) == (75.0, 135.0, 150.0)
+
+
+def test_report_by_step(drop_dir):
+    rows = TimingReport().add(iter_records(drop_dir)).rows(by_env=False)
+    install = next(r for r in rows if r["step"] == "install")
+    assert (install["env"], install["count"]) == ("*", 200)
+    assert format_rows(rows).splitlines()[0].split() == ["env", "action", "step", "count", "failures", "p50", "p90",
+                                                         "p99", "max"]
+
+
+def test_timings_command(drop_dir):
+    result = CliRunner().invoke(cli, ["timings", str(drop_dir), "--step", "install", "--json"],
+                                catch_exceptions=False)
+    rows = json.loads(result.output)
+    assert [r["env"] for r in rows] == ["myenv", "myenv2"]
+
+
+def test_installers_record_steps(tmp_path):
+    CreateEnvBat(tmp_path, "env").create(py_version="3.12", env_name="env", telemetry_dir=r"\\server\mipi\timings")
+    UpdateEnvBat(tmp_path, "env").create(py_version="3.12", env_name="env")
+    create = (tmp_path / "env" / "create_env.bat").read_text()
+    assert r'if not defined MIPI_TELEMETRY_DIR set "MIPI_TELEMETRY_DIR=\\server\mipi\timings"' in create
+    for step in ("set_environ", "conda_create", "activate", "install"):
+        assert f"call :mipi_step {step} ok" in create
+    assert "echo env,create,%~1,%~2,%MIPI_ELAPSED%,%COMPUTERNAME%" in create
+
+    update = (tmp_path / "env" / "update_env.bat").read_text()
+    # can still be switched on per machine with MIPI_TELEMETRY_DIR
+    assert "set \"MIPI_TELEMETRY_DIR=" not in update
+    assert "call :mipi_step stamp_check up_to_date" in update
+    assert "conda_create" not in update
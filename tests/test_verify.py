@@ -0,0 +1,112 @@
+import json
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+from mipi_env_manager.config import VerifySpec
+from mipi_env_manager.main import YmlSetup, PublishInstallers, main, preview
+from mipi_env_manager.sinks import ZipSink
+from mipi_env_manager.verify import SmokeInstaller, VerificationError, Verifier
+
+
+class FakeInstaller(SmokeInstaller):
+    """
+    Fails requirements that mention "broken", without creating a virtualenv
+    """
+
+    def __init__(self, settings=VerifySpec(enabled=True)):
+        super().__init__(settings)
+        self.installed = []
+
+    def python(self, py_version):
+        return sys.executable
+
+    def commands(self, python, venv, requirements, constraints=None):
+        with open(requirements) as f:
+            self.installed.append(f.read())
+        check = f"import sys; sys.exit('broken' in open({requirements!r}).read())"
+        return [[python, "-c", check]]
+
+
+@pytest.fixture
+def config(config, tmp_path):
+    config["setup"]["outpath"] = str(tmp_path / "out")
+    config["setup"]["verify"] = {"workers": 2}
+    return config
+
+
+def publish(installer, **kwargs):
+    PublishInstallers(YmlSetup("MIPI_DEVOPS_PATH"), True, True, True, smoke_installer=installer, **kwargs).publish()
+
+
+def test_failed_smoke_install_publishes_nothing(config, tmp_path):
+    config["environments"]["myenv2"]["packages"]["broken"] = {"source": "pypi"}
+    installer = FakeInstaller()
+    with pytest.raises(VerificationError, match="smoke install failed for myenv2"):
+        publish(installer)
+
+    # both test and prod variants share the requirements, so each environment is installed once
+    assert len(installer.installed) == 2
+    out = tmp_path / "out"
+    assert sorted(p.relative_to(out).as_posix() for p in out.rglob("*") if p.is_file()) == [".mipi/verified.json"]
+    # only the environment that installed is remembered
+    assert [entry["environment"] for entry in json.loads((out / ".mipi" / "verified.json").read_text()).values()] \
+        == ["myenv"]
+
+
+def test_verified_requirements_are_not_installed_again(config, tmp_path):
+    publish(FakeInstaller())
+    assert (tmp_path / "out" / "myenv" / "requirements.txt").is_file()
+
+    installer = FakeInstaller()
+    publish(installer)
+    assert installer.installed == []
+
+    config["environments"]["myenv2"]["packages"]["numpy"] = {"source": "pypi"}
+    publish(installer)
+    assert len(installer.installed) == 1 and "numpy" in installer.installed[0]
+
+    # a new pin changes constraints.txt, which every environment installs with
+    config["environments"]["myenv2"]["packages"]["numpy"]["version"] = "1.26.4"
+    del installer.installed[:]
+    publish(installer)
+    assert len(installer.installed) == 2
+
+
+def test_preview_does_not_verify(config, tmp_path, monkeypatch):
+    monkeypatch.setattr(Verifier, "verify", lambda *args: pytest.fail("a preview ran a smoke install"))
+    assert "myenv/requirements.txt" in preview(YmlSetup("MIPI_DEVOPS_PATH"))
+    assert not (tmp_path / "out").exists()
+
+
+def test_verify_with_a_sink_that_cannot_read_back(config, tmp_path):
+    config["environments"]["myenv2"]["packages"]["broken"] = {"source": "pypi"}
+    installer = FakeInstaller()
+    with pytest.raises(VerificationError, match="myenv2"):
+        publish(installer, sink=ZipSink(str(tmp_path / "publish.zip")))
+    assert len(installer.installed) == 2
+    assert any("broken" in requirements for requirements in installer.installed)
+    # only a sink writing to the outpath remembers what passed
+    assert not (tmp_path / "out").exists()
+
+
+def test_no_verify(config, tmp_path):
+    config["environments"]["myenv"]["packages"]["broken"] = {"source": "pypi"}
+    result = CliRunner().invoke(main, args=["--prod"])
+    assert result.exit_code == 1
+    assert not (tmp_path / "out" / "myenv").exists()
+
+    result = CliRunner().invoke(main, args=["--prod", "--no-verify"])
+    assert result.exit_code == 0
+    assert (tmp_path / "out" / "myenv" / "requirements.txt").is_file()
+
+
+def test_installs_from_a_local_index(tmp_path):
+    # an empty local index stands in for pypi, so the install fails without touching the network
+    (tmp_path / "index").mkdir()
+    settings = VerifySpec(True, index_url=(tmp_path / "index").as_uri(), pythons=(("3", sys.executable),))
+    results = Verifier(settings, str(tmp_path / "verified.json")).verify([("env", "3", "mipi-not-a-package\n")])
+    assert results[0].status == "failed"
+    assert "mipi-not-a-package" in results[0].output
+    assert not (tmp_path / "verified.json").exists()
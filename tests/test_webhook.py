@@ -0,0 +1,120 @@
+import hashlib
+import hmac
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from mipi_env_manager.config import EnvironmentIndex
+from mipi_env_manager.main import YmlSetup, GHRequest, PublishInstallers
+from mipi_env_manager.webhook import Coalescer, WebhookListener, verify_signature
+
+SECRET = b"It's a Secret to Everybody"
+
+
+def sign(body, secret=SECRET):
+    return "sha256=" + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def release(repo, action="published", tag="v1.0.2"):
+    return {"action": action, "release": {"tag_name": tag}, "repository": {"html_url": repo}}
+
+
+def post(listener, payload, event="release", secret=SECRET):
+    body = json.dumps(payload).encode("utf-8")
+    host, port = listener.address
+    request = urllib.request.Request(f"http://{host}:{port}/", data=body, method="POST",
+                                     headers={"X-GitHub-Event": event, "X-Hub-Signature-256": sign(body, secret),
+                                              "Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_verify_signature():
+    # the example from github's documentation
+    body = b"Hello, World!"
+    header = "sha256=757107ea0eb2509fc211221cce984b8a37570b6d7586c22c46f4379c8b043e17"
+    assert verify_signature(SECRET, body, header)
+    assert not verify_signature(SECRET, body + b" ", header)
+    assert not verify_signature(SECRET, body, None)
+    assert not verify_signature(SECRET, body, header.replace("sha256=", "sha1="))
+
+
+def test_coalescer_batches_a_burst():
+    batches = []
+    coalescer = Coalescer(batches.append, delay=0.2, max_delay=5)
+    for repo in ("a", "b", "a"):
+        coalescer.add(repo)
+    assert coalescer.wait_idle(timeout=5)
+    coalescer.add("c")
+    coalescer.close()
+    assert batches == [{"a", "b"}, {"c"}]
+
+
+def test_coalescer_keeps_going_after_a_failed_publish():
+    calls = []
+
+    def publish(repos):
+        calls.append(repos)
+        if len(calls) == 1:
+            raise RuntimeError("github is down")
+
+    coalescer = Coalescer(publish, delay=0.01)
+    coalescer.add("a")
+    assert coalescer.wait_idle(timeout=5)
+    coalescer.add("a")
+    coalescer.close()
+    assert (coalescer.batches, coalescer.failures, len(calls)) == (2, 1, 2)
+
+
+@pytest.fixture
+def config(config, monkeypatch):
+    config["environments"]["other"] = {"setup": {"py_version": "3.12", "include_in_master": True},
+                                       "packages": {"pkg": {"source": "github", "path": "https://github.com/org/pkg"}}}
+    monkeypatch.setattr(GHRequest, "get_repo_releases", lambda self: [{"tag_name": "v1.0.2"}])
+    return config
+
+
+@pytest.fixture
+def listener(config):
+    setup = YmlSetup("MIPI_DEVOPS_PATH")
+    published = []
+    lock = threading.Lock()
+
+    def publish(repos):
+        with lock:
+            published.append(repos)
+        PublishInstallers(setup, False, True, True, repos=sorted(repos)).publish()
+
+    listener = WebhookListener(SECRET, publish,
+                               lambda: EnvironmentIndex.from_environments(setup.load_config().environments.values()),
+                               port=0, delay=0.3, quiet=True)
+    listener.published = published
+    listener.start()
+    yield listener
+    listener.stop()
+
+
+def test_release_events_republish_affected_environments(listener, tmp_path):
+    assert post(listener, {"zen": "Keep it logically awesome."}, event="ping") == (200, {"ok": "pong"})
+    assert post(listener, release("https://github.com/psf/requests"), secret=b"wrong")[0] == 401
+    assert post(listener, release("https://github.com/psf/other"))[1] == {
+        "ignored": "no environment uses https://github.com/psf/other"}
+    assert post(listener, release("https://github.com/psf/requests", action="edited"))[0] == 200
+
+    status, reply = post(listener, release("https://github.com/psf/requests"))
+    assert (status, reply["environments"]) == (202, ["myenv", "myenv2"])
+    assert post(listener, release("https://github.com/psf/requests", action="released"))[0] == 202
+    assert post(listener, release("https://github.com/PSF/requests.git"))[0] == 202
+
+    assert listener.coalescer.wait_idle(timeout=10)
+    assert listener.published == [{"https://github.com/psf/requests", "https://github.com/PSF/requests.git"}]
+    assert "v1.0.2" in (tmp_path / "myenv" / "requirements.txt").read_text()
+    assert not (tmp_path / "other").exists()
+    # the master installers still include every environment
+    assert "other" in (tmp_path / "master_update_envs.bat").read_text()